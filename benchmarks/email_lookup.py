@@ -0,0 +1,80 @@
+"""Compare ILIKE email lookups with the lower(email) index.
+
+Fills a scratch copy of the users table and prints the query plans of the old
+``email ILIKE :email`` lookup and of ``User.find_by_email``.
+
+    DATABASE_URL=postgresql://localhost/sampleapp_bench \\
+        python benchmarks/email_lookup.py --rows 10000000
+"""
+import os
+import time
+
+import click
+from sqlalchemy import create_engine
+from sqlalchemy import text
+
+TABLE = "bench_email_lookup_users"
+
+
+def explain(conn, sql, **params):
+    rows = conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {sql}"), params)
+    return "\n".join(row[0] for row in rows)
+
+
+@click.command()
+@click.option("--rows", default=10_000_000, help="Number of users to insert")
+@click.option("--batch", default=1_000_000, help="Rows inserted per statement")
+@click.option("--keep", is_flag=True, help="Keep the scratch table afterwards")
+def main(rows, batch, keep):
+    engine = create_engine(
+        os.environ.get("DATABASE_URL", "postgresql://localhost/sampleapp_bench")
+    )
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+        conn.execute(
+            text(
+                f"CREATE TABLE {TABLE} ("
+                "id uuid PRIMARY KEY DEFAULT gen_random_uuid(), "
+                "email varchar(80) NOT NULL UNIQUE)"
+            )
+        )
+        started_at = time.monotonic()
+        for start in range(0, rows, batch):
+            conn.execute(
+                text(
+                    f"INSERT INTO {TABLE} (email) "
+                    "SELECT 'User' || i || '@Example.com' "
+                    "FROM generate_series(:start, :stop) AS i"
+                ),
+                dict(start=start, stop=min(start + batch, rows) - 1),
+            )
+        conn.execute(text(f"ANALYZE {TABLE}"))
+        click.echo(f"Inserted {rows} rows in {time.monotonic() - started_at:.1f}s")
+
+        email = f"user{rows // 2}@example.com"
+        click.echo("\n== email ILIKE :email")
+        click.echo(
+            explain(
+                conn, f"SELECT * FROM {TABLE} WHERE email ILIKE :email", email=email
+            )
+        )
+
+        started_at = time.monotonic()
+        conn.execute(text(f"CREATE UNIQUE INDEX ON {TABLE} (lower(email))"))
+        conn.execute(text(f"ANALYZE {TABLE}"))
+        click.echo(
+            f"\nBuilt lower(email) index in {time.monotonic() - started_at:.1f}s"
+        )
+
+        click.echo("\n== lower(email) = :email")
+        click.echo(
+            explain(
+                conn, f"SELECT * FROM {TABLE} WHERE lower(email) = :email", email=email
+            )
+        )
+        if not keep:
+            conn.execute(text(f"DROP TABLE {TABLE}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Compare ranking every match of an email search with ranking capped
+candidates.
+
+Fills a scratch copy of the users table with a trigram index on email, and
+prints the query plans of the admin search ranked over every match and over
+the first ``--candidates`` matches, like ``UserModelView`` does, for a term
+matching nearly every user and for a rare one.
+
+    DATABASE_URL=postgresql://localhost/sampleapp_bench \\
+        python benchmarks/email_search.py --rows 5000000
+"""
+import os
+import time
+
+import click
+from sqlalchemy import create_engine
+from sqlalchemy import text
+
+TABLE = "bench_email_search_users"
+
+RANKING = (
+    "CASE WHEN email ILIKE :prefix THEN 0 ELSE 1 END, "
+    "strpos(lower(email), :term), length(email), email"
+)
+
+
+def explain(conn, sql, **params):
+    rows = conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {sql}"), params)
+    return "\n".join(row[0] for row in rows)
+
+
+def search(conn, term, candidates, limit):
+    params = dict(term=term, prefix=f"{term}%", pattern=f"%{term}%", limit=limit)
+    click.echo(f"\n== {term!r}, every match ranked")
+    click.echo(
+        explain(
+            conn,
+            f"SELECT * FROM {TABLE} WHERE email ILIKE :pattern "
+            f"ORDER BY {RANKING} LIMIT :limit",
+            **params,
+        )
+    )
+    click.echo(f"\n== {term!r}, {candidates} candidates ranked")
+    click.echo(
+        explain(
+            conn,
+            f"SELECT * FROM {TABLE} WHERE id IN ("
+            f"SELECT id FROM {TABLE} WHERE email ILIKE :pattern LIMIT :candidates) "
+            f"ORDER BY {RANKING} LIMIT :limit",
+            candidates=candidates,
+            **params,
+        )
+    )
+
+
+@click.command()
+@click.option("--rows", default=5_000_000, help="Number of users to insert")
+@click.option("--batch", default=1_000_000, help="Rows inserted per statement")
+@click.option("--candidates", default=1000, help="Matches ranked by capped searches")
+@click.option("--limit", default=50, help="Rows of the listed page")
+@click.option("--keep", is_flag=True, help="Keep the scratch table afterwards")
+def main(rows, batch, candidates, limit, keep):
+    engine = create_engine(
+        os.environ.get("DATABASE_URL", "postgresql://localhost/sampleapp_bench")
+    )
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+        conn.execute(
+            text(
+                f"CREATE TABLE {TABLE} ("
+                "id uuid PRIMARY KEY DEFAULT gen_random_uuid(), "
+                "email varchar(80) NOT NULL)"
+            )
+        )
+        started_at = time.monotonic()
+        for start in range(0, rows, batch):
+            conn.execute(
+                text(
+                    f"INSERT INTO {TABLE} (email) "
+                    "SELECT 'user' || i || '@example.com' "
+                    "FROM generate_series(:start, :stop) AS i"
+                ),
+                dict(start=start, stop=min(start + batch, rows) - 1),
+            )
+        conn.execute(text(f"CREATE INDEX ON {TABLE} USING gin (email gin_trgm_ops)"))
+        conn.execute(text(f"ANALYZE {TABLE}"))
+        click.echo(f"Inserted {rows} rows in {time.monotonic() - started_at:.1f}s")
+
+        search(conn, "example", candidates, limit)
+        search(conn, f"user{rows // 2}@", candidates, limit)
+        if not keep:
+            conn.execute(text(f"DROP TABLE {TABLE}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Measure the first render of templates in a fresh worker.
+
+Every run starts a new interpreter, like a gunicorn worker after a deploy or a
+recycle, and times the first request to the home and terms pages plus loading
+the Flask-Admin list and edit templates, without and with the bytecode cache written by
+``flask templates compile``.
+
+    python benchmarks/template_cold_start.py --runs 10
+"""
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+ADMIN_TEMPLATES = ("admin/model/list.html", "admin/model/edit.html")
+
+
+def first_render(cache_dir, queue):
+    from sampleapp.app import create_app
+    from sampleapp.settings import ProdConfig
+
+    class BenchConfig(ProdConfig):
+        SECRET_KEY = "benchmark" * 4
+        TEMPLATE_CACHE_DIR = cache_dir
+        PAGE_CACHE_ENABLED = False
+        RATELIMIT_BACKEND = "memory"
+
+    app = create_app(BenchConfig)
+    client = app.test_client()
+    timings = {}
+    for path in ("/", "/terms-of-service"):
+        started_at = time.perf_counter()
+        client.get(path)
+        timings[path] = time.perf_counter() - started_at
+    started_at = time.perf_counter()
+    for name in ADMIN_TEMPLATES:
+        app.jinja_env.get_template(name)
+    timings["admin templates"] = time.perf_counter() - started_at
+    queue.put(timings)
+
+
+def measure(cache_dir, runs):
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for _ in range(runs):
+        queue = context.Queue()
+        process = context.Process(target=first_render, args=(cache_dir, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+    return {
+        key: statistics.median(result[key] for result in results) * 1000
+        for key in results[0]
+    }
+
+
+@click.command()
+@click.option("--runs", default=10, help="Fresh processes per configuration")
+def main(runs):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        subprocess.run(
+            ["flask", "templates", "compile", "--directory", cache_dir],
+            env=dict(os.environ, FLASK_APP="autoapp.py"),
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        cold = measure(None, runs)
+        compiled = measure(cache_dir, runs)
+
+    click.echo(f"Median of {runs} fresh processes, in ms")
+    click.echo(f"{'':20} {'no cache':>10} {'compiled':>10}")
+    for key in cold:
+        click.echo(f"{key:20} {cold[key]:10.1f} {compiled[key]:10.1f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
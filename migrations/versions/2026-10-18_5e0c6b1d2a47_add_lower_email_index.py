@@ -0,0 +1,46 @@
+"""add lower(email) unique index
+
+Revision ID: 5e0c6b1d2a47
+Revises: 33bd0abf39b4
+Create Date: 2026-10-18 10:12:41.204118
+
+"""
+from alembic import op
+from sqlalchemy import text
+
+# revision identifiers, used by Alembic.
+revision = "5e0c6b1d2a47"
+down_revision = "33bd0abf39b4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    duplicates = [
+        row[0]
+        for row in op.get_bind().execute(
+            text(
+                "SELECT lower(email) FROM users GROUP BY 1 HAVING count(*) > 1 "
+                "ORDER BY 1 LIMIT 10"
+            )
+        )
+    ]
+    if duplicates:
+        raise RuntimeError(
+            "Cannot build the unique ix_users_email_lower index, users share "
+            f"emails differing only in case: {', '.join(duplicates)}"
+        )
+    # Build the index without blocking writes to users, CONCURRENTLY cannot run
+    # inside a transaction. A failed concurrent build leaves an invalid index
+    # behind, which is dropped so a rerun builds it again.
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_email_lower")
+        op.execute(
+            "CREATE UNIQUE INDEX CONCURRENTLY ix_users_email_lower "
+            "ON users (lower(email))"
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_email_lower")
@@ -0,0 +1,49 @@
+"""generate uuid7 user ids
+
+Revision ID: 7b2d4f9a1c36
+Revises: 3f7c9a1e5b28
+Create Date: 2026-10-18 18:05:12.481907
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7b2d4f9a1c36"
+down_revision = "3f7c9a1e5b28"
+branch_labels = None
+depends_on = None
+
+# Copy of sampleapp.models.base.UUID7_FUNCTION at this revision
+UUID7_FUNCTION = """
+CREATE OR REPLACE FUNCTION uuid_generate_v7() RETURNS uuid AS $$
+    SELECT encode(
+        set_bit(
+            set_bit(
+                overlay(
+                    uuid_send(gen_random_uuid())
+                    PLACING substring(
+                        int8send(
+                            floor(extract(epoch FROM clock_timestamp()) * 1000)::bigint
+                        ) FROM 3
+                    )
+                    FROM 1 FOR 6
+                ),
+                52, 1
+            ),
+            53, 1
+        ),
+        'hex'
+    )::uuid
+$$ LANGUAGE sql VOLATILE
+"""
+
+
+def upgrade():
+    # Only the default changes, existing random ids are kept
+    op.execute(UUID7_FUNCTION)
+    op.execute("ALTER TABLE users ALTER COLUMN id SET DEFAULT uuid_generate_v7()")
+
+
+def downgrade():
+    op.execute("ALTER TABLE users ALTER COLUMN id SET DEFAULT gen_random_uuid()")
+    op.execute("DROP FUNCTION uuid_generate_v7()")
@@ -0,0 +1,31 @@
+"""add users (created_at, id) index
+
+Revision ID: c41d7e9b2f63
+Revises: 9a3f4c2e7b10
+Create Date: 2026-10-18 14:03:17.551920
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c41d7e9b2f63"
+down_revision = "9a3f4c2e7b10"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Build the index without blocking writes to users, CONCURRENTLY cannot run
+    # inside a transaction. A failed concurrent build leaves an invalid index
+    # behind, which is dropped so a rerun builds it again.
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_created_at_id")
+        op.execute(
+            "CREATE INDEX CONCURRENTLY ix_users_created_at_id "
+            "ON users (created_at, id)"
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_created_at_id")
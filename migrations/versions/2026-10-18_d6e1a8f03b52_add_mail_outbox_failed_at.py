@@ -0,0 +1,49 @@
+"""add mail outbox failed_at
+
+Revision ID: d6e1a8f03b52
+Revises: 7b2d4f9a1c36
+Create Date: 2026-10-18 21:14:36.208413
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "d6e1a8f03b52"
+down_revision = "7b2d4f9a1c36"
+branch_labels = None
+depends_on = None
+
+# Default of MAIL_OUTBOX_MAX_ATTEMPTS at this revision
+MAX_ATTEMPTS = 8
+
+
+def upgrade():
+    op.add_column("mail_outbox", sa.Column("failed_at", sa.DateTime(), nullable=True))
+    # Messages which used up their attempts before this revision
+    op.execute(
+        "UPDATE mail_outbox SET failed_at = next_attempt_at "
+        f"WHERE sent_at IS NULL AND attempts >= {MAX_ATTEMPTS}"
+    )
+    # Swap the pending index for one leaving failed messages out, without
+    # blocking the workers. A failed concurrent build leaves an invalid index
+    # behind, which is dropped so a rerun builds it again.
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_mail_outbox_due")
+        op.execute(
+            "CREATE INDEX CONCURRENTLY ix_mail_outbox_due "
+            "ON mail_outbox (next_attempt_at) "
+            "WHERE sent_at IS NULL AND failed_at IS NULL"
+        )
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_mail_outbox_pending")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_mail_outbox_pending")
+        op.execute(
+            "CREATE INDEX CONCURRENTLY ix_mail_outbox_pending "
+            "ON mail_outbox (next_attempt_at) WHERE sent_at IS NULL"
+        )
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_mail_outbox_due")
+    op.drop_column("mail_outbox", "failed_at")
@@ -0,0 +1,32 @@
+"""add users email trigram index
+
+Revision ID: e8a2b5c7d913
+Revises: c41d7e9b2f63
+Create Date: 2026-10-18 15:21:09.318442
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e8a2b5c7d913"
+down_revision = "c41d7e9b2f63"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # Build the index without blocking writes to users, CONCURRENTLY cannot run
+    # inside a transaction. A failed concurrent build leaves an invalid index
+    # behind, which is dropped so a rerun builds it again.
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_email_trgm")
+        op.execute(
+            "CREATE INDEX CONCURRENTLY ix_users_email_trgm "
+            "ON users USING gin (email gin_trgm_ops)"
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_email_trgm")
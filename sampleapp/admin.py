@@ -1,17 +1,56 @@
+import csv
+import datetime
+import io
+import json
+import os
+import uuid
+
+from flask import abort
 from flask import current_app
 from flask import flash
+from flask import jsonify
 from flask import redirect
 from flask import request
+from flask import Response
+from flask import stream_with_context
 from flask import url_for
 from flask_admin import AdminIndexView
+from flask_admin import BaseView
 from flask_admin import expose
+from flask_admin._compat import csv_encode
+from flask_admin.actions import action
 from flask_admin.contrib.sqla import ModelView
+from flask_admin.helpers import flash_errors
+from flask_admin.helpers import get_redirect_target
 from flask_admin.model.template import EndpointLinkRowAction
+from flask_login import current_user
 from flask_login import login_user
 from flask_principal import Identity
 from flask_principal import identity_changed
+from flask_wtf import FlaskForm
+from sqlalchemy import DateTime
+from sqlalchemy import inspect
+from sqlalchemy import not_
+from sqlalchemy import text
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm import Query
+from werkzeug.utils import secure_filename
+from wtforms import FloatField
+from wtforms import IntegerField
+from wtforms.validators import InputRequired
+from wtforms.validators import NumberRange
+from wtforms.validators import ValidationError
 
+from .extensions import memory
+from .extensions import profiler
+from .models.sharding import merge_sorted
+from .models.sharding import shards
 from .permissions import admin_permission
+from .profiling import flame_graph
+from .queries import query_budget
 
 
 class SecureViewMixin:
@@ -23,11 +62,459 @@ class SecureViewMixin:
 
 
 class ProtectedAdminIndexView(SecureViewMixin, AdminIndexView):
-    pass
+    #: Number of days of signups and password resets on the dashboard
+    dashboard_days = 30
+
+    @expose()
+    @query_budget(3)
+    def index(self):
+        from .models.stats import UserDailyStats
+
+        stats = UserDailyStats.summary(days=self.dashboard_days)
+        return self.render(self._template, stats=stats)
 
 
 class BaseModelView(SecureViewMixin, ModelView):
-    extra_css = ["/static/vendor/fontawesome-free-5.14.0-web/css/all.min.css"]
+    export_types = ["csv", "jsonl"]
+    #: Rows fetched per round-trip from the server side cursor when exporting
+    export_batch_size = 1000
+    #: Size of the chunks of exported data sent to the client
+    export_chunk_size = 64 * 1024
+    list_template = "admin/model/keyset_list.html"
+    #: Columns of the keyset pagination, ordered like column_default_sort.
+    #: The list pages by seeking past the last row of the previous page
+    #: instead of an OFFSET when sorted by default, so it needs an index on
+    #: these columns. None pages with OFFSET
+    keyset_columns = None
+    #: Above this many rows, by the planner's estimate, the list shows the
+    #: estimate instead of counting rows, and no count when searched or
+    #: filtered. None always counts
+    estimated_count_threshold = 100_000
+    #: Searches list at most this many rows. None lists every match. Ranked
+    #: searches rank this many matches, in whichever order the index gives
+    #: them, instead of sorting every match of a frequent term
+    search_result_limit = None
+    #: Offer the actions on every row matching the search and filters of the
+    #: list, besides the selected rows. Handlers then get a query of primary
+    #: keys instead of a list, see _id_chunks
+    can_act_on_matching = False
+
+    @property
+    def extra_css(self):
+        return [
+            url_for(
+                "static", filename="vendor/fontawesome-free-5.14.0-web/css/all.min.css"
+            )
+        ]
+
+    def get_list(
+        self,
+        page,
+        sort_column,
+        sort_desc,
+        search,
+        filters,
+        execute=True,
+        page_size=None,
+    ):
+        """Return the count and rows of a list page, like Flask-Admin's
+        get_list, except that:
+
+        - the count is estimated on large tables, see estimated_count_threshold
+        - listed rows only load the listed columns
+        - the default sort pages with a keyset, see keyset_columns, returning
+          a :class:`KeysetPage`
+        - sharded models list the rows of every shard, merged in order
+        - rows are not counted when execute is False, the count is None
+        """
+        joins = {}
+        count_joins = {}
+        query = self.get_query()
+        count_query = self.get_count_query()
+        if self._search_supported and search:
+            query, count_query, joins, count_joins = self._apply_search(
+                query, count_query, joins, count_joins, search
+            )
+        if filters and self._filters:
+            query, count_query, joins, count_joins = self._apply_filters(
+                query, count_query, joins, count_joins, filters
+            )
+        count = None
+        if execute:
+            count = self._get_count(count_query, filtered=bool(search or filters))
+
+        ranking = None
+        if search and sort_column is None:
+            ranking = self._search_ranking(search)
+        if ranking is not None and self.search_result_limit:
+            query = self.get_query().filter(
+                self._search_candidates(query, self.search_result_limit)
+            )
+
+        for join in self._auto_joins:
+            query = query.options(joinedload(join))
+
+        if page_size is None:
+            page_size = self.page_size
+        keyset = (
+            self.keyset_columns is not None and sort_column is None and ranking is None
+        )
+        if keyset:
+            query, descending, backwards = self._apply_keyset(query)
+            # one more row tells if there is a next page
+            start, stop = 0, page_size + 1 if page_size else None
+            merge_key = self._keyset_key
+        else:
+            if ranking is not None:
+                query = query.order_by(*ranking)
+                merge_key, descending = self._search_ranking_key(search), False
+            else:
+                query, joins = self._apply_sorting(query, joins, sort_column, sort_desc)
+                merge_key, descending = self._sort_key(sort_column, sort_desc)
+            limit = None
+            if search and self.search_result_limit:
+                limit = self.search_result_limit
+                if count is not None:
+                    count = min(count, limit)
+            start, stop = _page_bounds(page, page_size, limit)
+
+        if not execute:
+            return count, query.slice(start, stop)
+        columns = self._list_load_columns()
+        if columns:
+            query = query.options(load_only(*columns))
+        shard_options = self._shards()
+        if len(shard_options) == 1:
+            rows = query.slice(start, stop).all()
+        else:
+            # the page is among the first rows of every shard
+            streams = [
+                query.slice(0, stop).execution_options(**options).all()
+                for options in shard_options
+            ]
+            rows = merge_sorted(streams, merge_key, descending, stop)[start:]
+        if keyset:
+            rows = self._keyset_page(rows, page_size, backwards)
+        return count, rows
+
+    @expose("/matching-action/", methods=("POST",))
+    def matching_action_view(self):
+        """Apply an action to every row matching the search and filters given
+        in the query string."""
+        if not self.can_act_on_matching:
+            abort(404)
+        form = self.action_form()
+        if self.validate_form(form):
+            name = form.action.data
+            handler = self._actions_data.get(name)
+            if handler and self.is_action_allowed(name):
+                response = handler[0](self._matching_ids())
+                if response is not None:
+                    return response
+        else:
+            flash_errors(form, message="Failed to perform action. %(error)s")
+        return redirect(get_redirect_target() or self.get_url(".index_view"))
+
+    def _matching_ids(self):
+        view_args = self._get_list_extra_args()
+        joins = {}
+        count_joins = {}
+        query = self.get_query()
+        if self._search_supported and view_args.search:
+            query, _, joins, count_joins = self._apply_search(
+                query, None, joins, count_joins, view_args.search
+            )
+        if view_args.filters and self._filters:
+            query, _, joins, count_joins = self._apply_filters(
+                query, None, joins, count_joins, view_args.filters
+            )
+        return query.with_entities(getattr(self.model, self._primary_key))
+
+    def _id_chunks(self, ids, chunk_size):
+        """Split ids, a list or a query of primary keys, in lists of at most
+        chunk_size ids. Queries are walked by primary key, one chunk at a
+        time and one shard after the other, so rows changed by the previous
+        chunks are not listed again."""
+        if not isinstance(ids, Query):
+            for start in range(0, len(ids), chunk_size):
+                yield ids[start : start + chunk_size]
+            return
+        pk = getattr(self.model, self._primary_key)
+        for options in self._shards():
+            shard_ids = ids.execution_options(**options)
+            last_id = None
+            while True:
+                query = shard_ids if last_id is None else shard_ids.filter(pk > last_id)
+                chunk = [row[0] for row in query.order_by(pk).limit(chunk_size)]
+                if not chunk:
+                    break
+                yield chunk
+                last_id = chunk[-1]
+
+    def _shards(self):
+        """Return the execution options running a query on each shard of the
+        model, a single empty one when it is not sharded."""
+        if not inspect(self.model).persist_selectable.info.get("sharded"):
+            return [{}]
+        return shards()
+
+    def _search_candidates(self, query, limit):
+        """Return a criterion matching the first limit rows of query, in no
+        particular order, to rank them instead of every row of query."""
+        pk = getattr(self.model, self._primary_key)
+        return pk.in_(query.with_entities(pk).order_by(None).limit(limit).statement)
+
+    def _search_ranking(self, search):
+        """Return the order of the rows matching search when the list is not
+        sorted, None to sort them as usual."""
+        return None
+
+    def _search_ranking_key(self, search):
+        """Return a function giving the rank of a row matching search, in the
+        order of _search_ranking, to merge the rows of several shards."""
+        return None
+
+    def _sort_key(self, sort_column, sort_desc):
+        """Return a function giving the sort key of a row, and whether rows
+        are sorted in descending order, to merge the rows of several shards.
+
+        NULLs sort last, then first in descending order, like in Postgres.
+        """
+        if sort_column is None or sort_column not in self._sortable_columns:
+            if not self.column_default_sort:
+                # unsorted rows are listed one shard after the other
+                return (lambda row: 0), False
+            sort_column, sort_desc = self._default_sort()
+
+        def key(row):
+            value = getattr(row, sort_column, None)
+            return value is None, value
+
+        return key, bool(sort_desc)
+
+    def _get_count(self, count_query, filtered):
+        if self.estimated_count_threshold is not None:
+            estimate = self._estimate_count()
+            if estimate >= self.estimated_count_threshold:
+                return None if filtered else estimate
+        return sum(
+            count_query.execution_options(**options).scalar()
+            for options in self._shards()
+        )
+
+    def _estimate_count(self):
+        """Return the planner's estimate of the number of rows, as of the
+        last VACUUM or ANALYZE, -1 when unknown."""
+        estimates = [
+            self.session.execute(
+                text("SELECT reltuples FROM pg_class WHERE oid = to_regclass(:name)"),
+                dict(name=self.model.__table__.fullname),
+                execution_options=options,
+            ).scalar()
+            for options in self._shards()
+        ]
+        if None in estimates:
+            return -1
+        return int(sum(estimates))
+
+    def _list_load_columns(self):
+        mapper = inspect(self.model)
+        names = [name for name, _ in self._list_columns]
+        names += self.keyset_columns or ()
+        if self.column_default_sort:
+            names.append(self._default_sort()[0])
+        return [
+            getattr(self.model, name)
+            for name in dict.fromkeys(names)
+            if name in mapper.column_attrs
+        ]
+
+    def _default_sort(self):
+        sort = self.column_default_sort
+        if isinstance(sort, list):
+            sort = sort[0]
+        if isinstance(sort, tuple):
+            return sort
+        return sort, False
+
+    def _apply_keyset(self, query):
+        columns = [getattr(self.model, name) for name in self.keyset_columns]
+        descending = bool(self.column_default_sort) and self._default_sort()[1]
+        cursor = self._keyset_cursor("before")
+        backwards = cursor is not None
+        if backwards:
+            # walk back from the first row of the page, reversed afterwards
+            descending = not descending
+        else:
+            cursor = self._keyset_cursor("after")
+        if cursor is not None:
+            key = tuple_(*columns)
+            query = query.filter(key < cursor if descending else key > cursor)
+        query = query.order_by(
+            *[column.desc() if descending else column.asc() for column in columns]
+        )
+        return query, descending, backwards
+
+    def _keyset_key(self, row):
+        return tuple(getattr(row, name) for name in self.keyset_columns)
+
+    def _keyset_cursor(self, name):
+        """Parse the keyset values of the ``after`` or ``before`` argument,
+        None when missing or invalid."""
+        value = request.args.get(name)
+        if not value:
+            return None
+        texts = value.split(",", len(self.keyset_columns) - 1)
+        if len(texts) != len(self.keyset_columns):
+            return None
+        try:
+            values = [
+                _parse_key_value(getattr(self.model, column_name).type, text_value)
+                for column_name, text_value in zip(self.keyset_columns, texts)
+            ]
+        except ValueError:
+            return None
+        return tuple_(*values)
+
+    def _keyset_url(self, name, row):
+        args = request.args.to_dict(flat=False)
+        for arg in ("page", "after", "before"):
+            args.pop(arg, None)
+        args[name] = ",".join(
+            value.isoformat() if isinstance(value, datetime.datetime) else str(value)
+            for value in (getattr(row, column) for column in self.keyset_columns)
+        )
+        return self.get_url(".index_view", **args)
+
+    def _keyset_page(self, rows, page_size, backwards):
+        has_more = bool(page_size) and len(rows) > page_size
+        page = KeysetPage(rows[:page_size] if page_size else rows)
+        if backwards:
+            page.reverse()
+        if not page:
+            return page
+        if has_more or backwards:
+            page.next_url = self._keyset_url("after", page[-1])
+        if (has_more and backwards) or (not backwards and request.args.get("after")):
+            page.prev_url = self._keyset_url("before", page[0])
+        return page
+
+    def _export_data(self):
+        """Return the exported rows as a query streamed through a server side
+        cursor, instead of a list of every row.
+
+        Only the exported columns are selected, so export formatters get
+        rows of these columns rather than model instances. Besides never
+        loading excluded columns, this avoids ORM ``yield_per``, which skips
+        rows in SQLAlchemy 1.4.2 when instances are collected while
+        iterating. Rows are not counted, the count is None.
+
+        Sharded models are exported one shard after the other, each shard
+        sorted and limited to ``export_max_rows`` on its own, so the export
+        is not sorted across shards.
+        """
+        view_args = self._get_list_extra_args()
+        sort_column = self._get_column_by_idx(view_args.sort)
+        if sort_column is not None:
+            sort_column = sort_column[0]
+        count, query = self.get_list(
+            0,
+            sort_column,
+            view_args.sort_desc,
+            view_args.search,
+            view_args.filters,
+            execute=False,
+            page_size=self.export_max_rows,
+        )
+        mapper = inspect(self.model)
+        columns = [
+            getattr(self.model, name)
+            for name, _ in self._export_columns
+            if name in mapper.column_attrs
+        ] or list(mapper.primary_key)
+        return count, query.with_entities(*columns).yield_per(self.export_batch_size)
+
+    def _export_csv(self, return_url):
+        _, data = self._export_data()
+
+        def generate():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow([csv_encode(c[1]) for c in self._export_columns])
+            for row in data:
+                writer.writerow(
+                    [
+                        csv_encode(self.get_export_value(row, c[0]))
+                        for c in self._export_columns
+                    ]
+                )
+                if buffer.tell() >= self.export_chunk_size:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+
+        return self._export_response(generate(), "csv", "text/csv")
+
+    def _export_tablib(self, export_type, return_url):
+        if export_type == "jsonl":
+            return self._export_jsonl(return_url)
+        return super()._export_tablib(export_type, return_url)
+
+    def _export_jsonl(self, return_url):
+        """Export one JSON object per line, keyed by column name."""
+        _, data = self._export_data()
+        names = [name for name, _ in self._export_columns]
+
+        def generate():
+            lines = []
+            size = 0
+            for row in data:
+                values = {name: self.get_export_value(row, name) for name in names}
+                line = json.dumps(values, default=str) + "\n"
+                lines.append(line)
+                size += len(line)
+                if size >= self.export_chunk_size:
+                    yield "".join(lines)
+                    lines = []
+                    size = 0
+            yield "".join(lines)
+
+        return self._export_response(generate(), "jsonl", "application/x-ndjson")
+
+    def _export_response(self, chunks, export_type, mimetype):
+        filename = secure_filename(self.get_export_name(export_type=export_type))
+        return Response(
+            stream_with_context(chunks),
+            headers={"Content-Disposition": f"attachment;filename={filename}"},
+            mimetype=mimetype,
+        )
+
+
+def _page_bounds(page, page_size, limit=None):
+    """Return the start and stop of the rows of a page in the whole list,
+    capped at limit rows."""
+    start = (page or 0) * page_size if page_size else 0
+    stop = start + page_size if page_size else None
+    if limit is not None:
+        stop = limit if stop is None else min(stop, limit)
+        start = min(start, stop)
+    return start, stop
+
+
+def _parse_key_value(column_type, value):
+    if isinstance(column_type, DateTime):
+        return datetime.datetime.fromisoformat(value)
+    if isinstance(column_type, UUID):
+        return uuid.UUID(value)
+    return column_type.python_type(value)
+
+
+class KeysetPage(list):
+    """Rows of a keyset paginated list, with the links to its neighbours."""
+
+    prev_url = None
+    next_url = None
 
 
 class UserModelView(BaseModelView):
@@ -64,6 +551,14 @@ class UserModelView(BaseModelView):
         "password",
     ]
     column_default_sort = ("created_at", True)
+    keyset_columns = ("created_at", "id")
+    search_result_limit = 1000
+    #: Number of suggestions of the autocomplete endpoint
+    autocomplete_limit = 10
+    can_act_on_matching = True
+    #: Users updated per transaction by bulk actions, bounds how long their
+    #: rows stay locked
+    bulk_update_chunk_size = 1000
     column_list = [
         "email",
         "plan_slug",
@@ -73,15 +568,140 @@ class UserModelView(BaseModelView):
     ]
     column_extra_row_actions = [
         EndpointLinkRowAction(
-            "fa fa-sign-in-alt", "admin.user.login_as", id_arg="user_id",
+            "fa fa-sign-in-alt",
+            "admin.user.login_as",
+            id_arg="user_id",
         )
     ]
 
+    def _apply_search(self, query, count_query, joins, count_joins, search):
+        from .models.accounts import User
+
+        criterion, _ = User.email_search(search)
+        query = query.filter(criterion)
+        if count_query is not None:
+            count_query = count_query.filter(criterion)
+        return query, count_query, joins, count_joins
+
+    def _search_ranking(self, search):
+        from .models.accounts import User
+
+        _, ranking = User.email_search(search)
+        return ranking
+
+    def _search_ranking_key(self, search):
+        from .models.accounts import User
+
+        return User.email_search_key(search)
+
+    def on_model_change(self, form, model, is_created):
+        from .models.accounts import User
+
+        shard = User.shard_options(email=model.email).get("shard")
+        if shard is not None and shard != User.shard_for_id(model.id):
+            # users are found on the shard of their email
+            raise ValidationError("The email belongs to another shard of users.")
+
+    @action("activate", "Activate", "Activate the users?")
+    def action_activate(self, ids):
+        self._bulk_update(ids, dict(is_active=True), "activated")
+
+    @action("deactivate", "Deactivate", "Deactivate the users?")
+    def action_deactivate(self, ids):
+        self._bulk_update(
+            ids, dict(is_active=False), "deactivated", skip_current_user=True
+        )
+
+    @action(
+        "force_password_reset",
+        "Force password reset",
+        "Clear the password of the users? They will have to reset it.",
+    )
+    def action_force_password_reset(self, ids):
+        values = dict(
+            password=None,
+            # expires the reset links sent so far, and allows sending one now
+            reset_password_at=datetime.datetime.utcnow(),
+            sent_reset_password_at=None,
+        )
+        self._bulk_update(
+            ids, values, "must reset their password", skip_current_user=True
+        )
+
+    @action("toggle_admin", "Toggle admin", "Toggle admin rights of the users?")
+    def action_toggle_admin(self, ids):
+        from .models.accounts import User
+
+        values = dict(is_admin=not_(User.__table__.c.is_admin))
+        self._bulk_update(ids, values, "toggled admin rights", skip_current_user=True)
+
+    def _bulk_update(self, ids, values, done, skip_current_user=False):
+        """Apply values to the users with given ids, a list of ids selected in
+        the list or a query of the matching ones, committing every
+        bulk_update_chunk_size users.
+
+        :param skip_current_user: Leave the logged in admin out, so that they
+            cannot lock themselves out
+        """
+        from .models.accounts import User
+
+        if not isinstance(ids, Query):
+            ids = [uuid.UUID(user_id) for user_id in ids]
+        updated = 0
+        try:
+            for chunk in self._id_chunks(ids, self.bulk_update_chunk_size):
+                if skip_current_user:
+                    chunk = [user_id for user_id in chunk if user_id != current_user.id]
+                chunk_updated = len(User.update_many(chunk, values))
+                self.session.commit()
+                updated += chunk_updated
+        except Exception as ex:
+            self.session.rollback()
+            if not self.handle_view_exception(ex):
+                raise
+            flash(
+                f"Failed to update users, {updated} users {done} before the "
+                f"failure. {ex}",
+                "error",
+            )
+            return
+        flash(f"{updated} users {done}.", "success")
+
+    @expose("/autocomplete")
+    def autocomplete(self):
+        """Suggest the users whose email contains the ``q`` argument, best
+        matches first."""
+        from .models.accounts import User
+
+        term = request.args.get("q", "").strip()
+        if not term:
+            return jsonify(results=[])
+        criterion, ranking = User.email_search(term)
+        candidates = self._search_candidates(
+            self.session.query(User.id).filter(criterion), self.search_result_limit
+        )
+        query = (
+            self.session.query(User.id, User.email)
+            .filter(candidates)
+            .order_by(*ranking)
+            .limit(self.autocomplete_limit)
+        )
+        rows = merge_sorted(
+            [query.execution_options(**options).all() for options in self._shards()],
+            User.email_search_key(term),
+            limit=self.autocomplete_limit,
+        )
+        return jsonify(
+            results=[dict(id=str(user_id), email=email) for user_id, email in rows]
+        )
+
     @expose("/login-as/<user_id>")
     def login_as(self, user_id):
         from .models.accounts import User
 
-        user = User.query.filter_by(id=user_id).first_or_404()
+        user = User.get_by_id(user_id)
+        if user is None:
+            abort(404)
         login_user(user, remember=False)
         identity_changed.send(
             current_app._get_current_object(), identity=Identity(user.id)
@@ -89,3 +709,95 @@ class UserModelView(BaseModelView):
         flash(f"You are logged in as {user.email}.", "success")
         redirect_url = url_for("public.home")
         return redirect(redirect_url)
+
+
+class ProfileForm(FlaskForm):
+    seconds = IntegerField(
+        "Seconds", default=30, validators=[InputRequired(), NumberRange(min=1)]
+    )
+    fraction = FloatField(
+        "Sampled requests",
+        default=1.0,
+        validators=[InputRequired(), NumberRange(min=0.001, max=1)],
+        description="Share of the requests profiled, between 0.001 and 1",
+    )
+
+
+class ProfilerView(SecureViewMixin, BaseView):
+    """Start profiles of the live workers and browse their flame graphs,
+    see :mod:`sampleapp.profiling`."""
+
+    @expose("/", methods=("GET", "POST"))
+    def index(self):
+        form = ProfileForm()
+        if form.validate_on_submit():
+            if not profiler.enabled:
+                abort(404)
+            try:
+                profile_id = profiler.start(
+                    form.seconds.data, form.fraction.data, started_by=current_user.email
+                )
+            except ValueError as error:
+                flash(str(error), "error")
+            else:
+                return redirect(self.get_url(".profile_view", profile_id=profile_id))
+        return self.render(
+            "admin/profiler/index.html",
+            form=form,
+            profiler=profiler,
+            profiles=profiler.profiles(),
+        )
+
+    @expose("/stop", methods=("POST",))
+    def stop_view(self):
+        profiler.stop()
+        flash("The profile is stopped.", "success")
+        return redirect(self.get_url(".index"))
+
+    @expose("/<profile_id>")
+    def profile_view(self, profile_id):
+        profile = profiler.profile(profile_id)
+        if profile is None:
+            abort(404)
+        samples = profiler.samples(profile_id)
+        return self.render(
+            "admin/profiler/profile.html",
+            profile=profile,
+            frames=flame_graph(samples),
+            total_samples=sum(samples.values()),
+        )
+
+    @expose("/<profile_id>/collapsed.txt")
+    def collapsed_view(self, profile_id):
+        """Samples in the collapsed stacks format of flamegraph.pl and
+        speedscope."""
+        if profiler.profile(profile_id) is None:
+            abort(404)
+        samples = profiler.samples(profile_id)
+        return Response(
+            "".join(f"{stack} {count}\n" for stack, count in sorted(samples.items())),
+            mimetype="text/plain",
+            headers={
+                "Content-Disposition": f"attachment; filename=profile-{profile_id}.txt"
+            },
+        )
+
+
+class MemoryView(SecureViewMixin, BaseView):
+    """Memory of the live workers and the allocation sites growing the most,
+    see :mod:`sampleapp.memory`."""
+
+    @expose("/")
+    def index(self):
+        return self.render(
+            "admin/memory/index.html", memory=memory, reports=memory.reports()
+        )
+
+    @expose("/snapshot", methods=("POST",))
+    def snapshot_view(self):
+        """Report the worker serving this request right away."""
+        if not memory.tracking:
+            abort(404)
+        memory.snapshot()
+        flash(f"Worker {os.getpid()} is reported.", "success")
+        return redirect(self.get_url(".index"))
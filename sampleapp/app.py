@@ -1,23 +1,36 @@
-from bugsnag.flask import handle_exceptions
+import os
+
 from flask import abort
 from flask import Flask
 from flask import render_template
+from flask import request
 from flask import Response
 from flask_admin import Admin
 from flask_login import current_user
 from flask_principal import identity_loaded
 from flask_principal import UserNeed
+from jinja2 import FileSystemBytecodeCache
 
 from . import commands
 from .blueprints import public
-from .extensions import bcrypt
+from .extensions import assets
+from .extensions import cache
 from .extensions import csrf_protect
 from .extensions import db
 from .extensions import debug_toolbar
+from .extensions import error_reporter
+from .extensions import hasher
+from .extensions import limiter
 from .extensions import login_manager
+from .extensions import logs
 from .extensions import mail
+from .extensions import memory
+from .extensions import metrics
 from .extensions import migrate
 from .extensions import principal
+from .extensions import profiler
+from .extensions import query_inspector
+from .extensions import user_cache
 from .models.accounts import User
 from .permissions import admin_role_need
 from .settings import DEFAULT_SECRET_KEY
@@ -37,6 +50,7 @@ def create_app(config_object=ProdConfig):
     register_shellcontext(app)
     register_commands(app)
     register_template_filters(app)
+    register_template_cache(app)
     register_admin_views(app)
     register_secret_key_check(app)
     register_principals_providers(app)
@@ -49,15 +63,24 @@ def create_app(config_object=ProdConfig):
 def register_extensions(app):
     """Register Flask extensions."""
 
-    bcrypt.init_app(app)
+    logs.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    memory.init_app(app)
+    query_inspector.init_app(app)
+    hasher.init_app(app)
     db.init_app(app)
     csrf_protect.init_app(app)
     debug_toolbar.init_app(app)
     migrate.init_app(app, db)
     mail.init_app(app)
+    limiter.init_app(app)
     login_manager.init_app(app)
     principal.init_app(app)
-    handle_exceptions(app)
+    user_cache.init_app(app)
+    cache.init_app(app)
+    assets.init_app(app)
+    error_reporter.init_app(app)
     return None
 
 
@@ -76,7 +99,7 @@ def register_errorhandlers(app):
         error_code = getattr(error, "code", 500)
         return render_template("{0}.html".format(error_code)), error_code
 
-    for errcode in [401, 404, 500]:
+    for errcode in [401, 404, 429, 500, 503]:
         app.errorhandler(errcode)(render_error)
     return None
 
@@ -88,6 +111,8 @@ def register_shellcontext(app):
         """Shell context objects."""
         return {
             "db": db,
+            "user_cache": user_cache,
+            "cache": cache,
             # TODO:
         }
 
@@ -100,6 +125,13 @@ def register_commands(app):
     app.cli.add_command(commands.lint)
     app.cli.add_command(commands.clean)
     app.cli.add_command(commands.urls)
+    app.cli.add_command(commands.mail_worker)
+    app.cli.add_command(commands.cache)
+    app.cli.add_command(commands.templates)
+    app.cli.add_command(commands.assets)
+    app.cli.add_command(commands.rollups)
+    app.cli.add_command(commands.shards)
+    app.cli.add_command(commands.memory)
 
 
 def register_secret_key_check(app):
@@ -125,15 +157,25 @@ def register_template_filters(app):
     return None
 
 
+def register_template_cache(app):
+    """Load template bytecode compiled by `flask templates compile`, so
+    workers skip compiling templates on their first requests."""
+    directory = app.config.get("TEMPLATE_CACHE_DIR")
+    if directory and os.path.isdir(directory):
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
 def register_admin_views(app):
     import flask_admin.consts
+    from .admin import MemoryView
+    from .admin import ProfilerView
     from .admin import ProtectedAdminIndexView
     from .admin import UserModelView
 
     url_prefix = app.config["ADMIN_DASHBOARD_PREFIX"]
     admin = Admin(
         app,
-        index_view=ProtectedAdminIndexView(url=url_prefix),
+        index_view=ProtectedAdminIndexView(url=url_prefix, template="admin/home.html"),
         url=url_prefix,
         template_mode="bootstrap3",
     )
@@ -148,6 +190,24 @@ def register_admin_views(app):
             menu_icon_value="user",
         ),
     )
+    admin.add_view(
+        ProfilerView(
+            name="Profiler",
+            url=f"{url_prefix}/profiler",
+            endpoint="admin.profiler",
+            menu_icon_type=flask_admin.consts.ICON_TYPE_FONT_AWESOME,
+            menu_icon_value="fire",
+        ),
+    )
+    admin.add_view(
+        MemoryView(
+            name="Memory",
+            url=f"{url_prefix}/memory",
+            endpoint="admin.memory",
+            menu_icon_type=flask_admin.consts.ICON_TYPE_FONT_AWESOME,
+            menu_icon_value="tachometer",
+        ),
+    )
 
 
 def register_principals_providers(app):
@@ -156,6 +216,12 @@ def register_principals_providers(app):
         # Set the identity user object
         identity.user = current_user
 
+        # Cached users come with their needs already computed
+        needs = getattr(current_user, "needs", None)
+        if needs is not None:
+            identity.provides.update(needs)
+            return
+
         if hasattr(current_user, "id"):
             identity.provides.add(UserNeed(current_user.id))
 
@@ -165,4 +231,7 @@ def register_principals_providers(app):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    # Admin rights revoked by another worker may still be cached by this one
+    if (request.blueprint or "").split(".")[0] == "admin":
+        return User.load_snapshot(user_id)
+    return user_cache.get(user_id, User.load_snapshot)
@@ -0,0 +1,181 @@
+"""Fingerprinted and precompressed static assets.
+
+``flask assets build`` copies every file of the static folder into
+``ASSETS_DIST_DIR``, twice: under its own name, and under a name carrying a
+hash of its content (``css/style.css`` becomes ``css/style.3f2a9c1b7d4e.css``).
+Compressible files also get ``.gz`` and, when the ``brotli`` package is
+installed, ``.br`` variants. ``manifest.json`` lists the hashed name and the
+available encodings of every file.
+
+With a manifest, ``url_for("static", filename=...)`` links to the hashed
+names, and the static view sends the smallest variant the client accepts.
+Hashed names change whenever the content does, so they are cached forever by
+browsers and CDNs. Unhashed copies are kept for URLs relative to other
+assets, like the fonts referenced by stylesheets.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+from flask import current_app
+from flask import request
+from flask import send_file
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+MANIFEST = "manifest.json"
+
+#: Served encodings by order of preference, with their file suffix
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+COMPRESSIBLE_TYPES = (
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+)
+
+#: Files smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 256
+
+
+def is_compressible(filename):
+    mimetype, encoding = mimetypes.guess_type(filename)
+    if mimetype is None or encoding is not None:
+        return False
+    return mimetype.startswith("text/") or mimetype in COMPRESSIBLE_TYPES
+
+
+def hashed_name(filename, digest):
+    base, ext = os.path.splitext(filename)
+    return f"{base}.{digest[:12]}{ext}"
+
+
+def build(static_folder, output_dir):
+    """Write fingerprinted and compressed copies of the files of
+    static_folder, plus the manifest, into output_dir.
+
+    :return: The manifest
+    """
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    manifest = dict(assets={}, encodings={})
+    for root, _, filenames in os.walk(static_folder):
+        for filename in filenames:
+            source = os.path.join(root, filename)
+            name = os.path.relpath(source, static_folder).replace(os.sep, "/")
+            with open(source, "rb") as f:
+                data = f.read()
+            hashed = hashed_name(name, hashlib.sha256(data).hexdigest())
+            manifest["assets"][name] = hashed
+            encodings = _write_variants(output_dir, name, data)
+            _write_variants(output_dir, hashed, data)
+            manifest["encodings"][name] = manifest["encodings"][hashed] = encodings
+    with open(os.path.join(output_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def _write_variants(output_dir, name, data):
+    path = os.path.join(output_dir, *name.split("/"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    encodings = []
+    if len(data) < MIN_COMPRESS_SIZE or not is_compressible(name):
+        return encodings
+    variants = [("gzip", ".gz", gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.insert(0, ("br", ".br", brotli.compress(data)))
+    for encoding, suffix, compressed in variants:
+        if len(compressed) < len(data):
+            with open(path + suffix, "wb") as f:
+                f.write(compressed)
+            encodings.append(encoding)
+    return encodings
+
+
+class Assets:
+    """Flask extension serving the assets written by ``flask assets build``.
+
+    Configuration:
+
+    - ``ASSETS_DIST_DIR``: output directory of the build, assets are served
+      from the static folder as usual when it has no manifest
+    - ``ASSETS_MAX_AGE``: cache lifetime of fingerprinted assets, in seconds
+    """
+
+    def __init__(self, app=None):
+        self.dist_dir = None
+        self.assets = {}
+        self.encodings = {}
+        self.immutable = frozenset()
+        self.max_age = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.dist_dir = app.config.get("ASSETS_DIST_DIR")
+        self.max_age = app.config.get("ASSETS_MAX_AGE", 365 * 24 * 60 * 60)
+        self.load_manifest()
+        app.url_defaults(self._url_defaults)
+        if "static" in app.view_functions:
+            app.view_functions["static"] = self.send_static
+
+    def load_manifest(self):
+        manifest = dict(assets={}, encodings={})
+        if self.dist_dir:
+            try:
+                with open(os.path.join(self.dist_dir, MANIFEST)) as f:
+                    manifest = json.load(f)
+            except FileNotFoundError:
+                pass
+        self.assets = manifest["assets"]
+        self.encodings = manifest["encodings"]
+        self.immutable = frozenset(self.assets.values())
+
+    def send_static(self, filename):
+        """Send a static file, precompressed when possible."""
+        encodings = self.encodings.get(filename)
+        if encodings is None:
+            return current_app.send_static_file(filename)
+
+        path = os.path.join(self.dist_dir, *filename.split("/"))
+        content_encoding = None
+        for encoding, suffix in ENCODINGS:
+            if encoding in encodings and encoding in request.accept_encodings:
+                path += suffix
+                content_encoding = encoding
+                break
+        immutable = filename in self.immutable
+        response = send_file(
+            path,
+            mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+            conditional=True,
+            cache_timeout=(
+                self.max_age
+                if immutable
+                else current_app.get_send_file_max_age(filename)
+            ),
+        )
+        if content_encoding is not None:
+            response.headers["Content-Encoding"] = content_encoding
+        if encodings:
+            response.vary.add("Accept-Encoding")
+        if immutable:
+            response.headers[
+                "Cache-Control"
+            ] = f"public, max-age={self.max_age}, immutable"
+        return response
+
+    def _url_defaults(self, endpoint, values):
+        if endpoint == "static":
+            hashed = self.assets.get(values.get("filename"))
+            if hashed is not None:
+                values["filename"] = hashed
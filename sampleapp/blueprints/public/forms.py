@@ -28,7 +28,7 @@ class LoginForm(FlaskForm):
         if not initial_validation:
             return False
 
-        self.user = User.query.filter(User.email.ilike(self.email.data)).first()
+        self.user = User.find_by_email(self.email.data)
         if not self.user or not self.user.check_password(self.password.data):
             self.email.errors.append("Invalid email or password")
             return False
@@ -69,7 +69,7 @@ class RegisterForm(FlaskForm):
         initial_validation = super(RegisterForm, self).validate()
         if not initial_validation:
             return False
-        user = User.query.filter(User.email.ilike(self.email.data)).first()
+        user = User.find_by_email(self.email.data)
         if user:
             self.email.errors.append("Email already registered")
             return False
@@ -8,14 +8,19 @@ from flask import flash
 from flask import redirect
 from flask import render_template
 from flask import request
-from flask import send_from_directory
 from flask import url_for
 from flask_login import login_required
 from flask_mail import Message
 
+from ...caching.pages import cache_page
+from ...extensions import assets
 from ...extensions import db
-from ...extensions import mail
+from ...extensions import limiter
+from ...mailer import queue_mail
+from ...models.accounts import normalize_email
 from ...models.accounts import User
+from ...queries import query_budget
+from ...utils import client_ip
 from ...utils import is_safe_url
 from ...utils import login_user
 from ...utils import logout_user
@@ -28,18 +33,23 @@ blueprint = Blueprint("public", __name__, static_folder="../../static")
 
 
 @blueprint.route("/", methods=["GET"])
+@query_budget(1)
+@cache_page()
 def home():
     """Home page."""
     return render_template("public/home.html")
 
 
 @blueprint.route("/terms-of-service")
+@query_budget(1)
+@cache_page()
 def terms():
     """TOS page."""
     return render_template("public/terms.html")
 
 
 @blueprint.route("/logout")
+@query_budget(1)
 @login_required
 def logout():
     """Logout."""
@@ -48,8 +58,32 @@ def logout():
     return redirect(url_for("public.home"))
 
 
+def check_login_rate_limit():
+    """Reject login attempts over the per IP or per email limits with 429,
+    before any database lookup or password check happens."""
+    config = current_app.config
+    if not limiter.hit(
+        "login-ip",
+        client_ip(),
+        config["LOGIN_RATELIMIT_IP_PER_MINUTE"],
+        config["LOGIN_RATELIMIT_IP_BURST"],
+    ):
+        abort(429)
+    email = normalize_email(request.form.get("email", ""))
+    if email and not limiter.hit(
+        "login-email",
+        email,
+        config["LOGIN_RATELIMIT_EMAIL_PER_MINUTE"],
+        config["LOGIN_RATELIMIT_EMAIL_BURST"],
+    ):
+        abort(429)
+
+
 @blueprint.route("/login", methods=["GET", "POST"])
+@query_budget(2)
 def login():
+    if request.method == "POST":
+        check_login_rate_limit()
     form = LoginForm(request.form)
     next_url = request.args.get("next")
     if form.validate_on_submit():
@@ -64,6 +98,7 @@ def login():
 
 
 @blueprint.route("/register", methods=["GET", "POST"])
+@query_budget(5)
 def register():
     """Register new user."""
     form = RegisterForm(request.form)
@@ -78,27 +113,31 @@ def register():
         flash("Thank you for registering.", "success")
         redirect_url = next_url or url_for("public.home")
         return redirect(redirect_url)
-    return render_template("public/register.html", form=form, next_url=next_url,)
+    return render_template(
+        "public/register.html",
+        form=form,
+        next_url=next_url,
+    )
 
 
 @blueprint.route("/forgot-password", methods=["GET", "POST"])
+@query_budget(3)
 def forgot_password():
     form = ForgotPasswordForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).with_for_update().first()
-        if user is not None:
-            now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
-            cooldown_time = current_app.config["FORGOT_PASSWORD_COOLDOWN_TIME_SECONDS"]
-            if cooldown_time > 0 and user.sent_reset_password_at is not None:
-                elapsed = now - user.sent_reset_password_at.replace(
-                    tzinfo=datetime.timezone.utc
+        now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+        cooldown_time = current_app.config["FORGOT_PASSWORD_COOLDOWN_TIME_SECONDS"]
+        # Cooldown check and update happen in one statement, so concurrent
+        # submissions cannot both pass it
+        user = User.mark_reset_password_sent(form.email.data, now, cooldown_time)
+        if user is None:
+            if User.find_by_email(form.email.data) is not None:
+                flash(
+                    "We just sent a reset password email to you, please try again later",
+                    "danger",
                 )
-                if elapsed.total_seconds() < cooldown_time:
-                    flash(
-                        "We just sent a reset password email to you, please try again later",
-                        "danger",
-                    )
-                    return redirect(url_for("public.forgot_password"))
+                return redirect(url_for("public.forgot_password"))
+        else:
             valid_period = current_app.config["RESET_PASSWORD_LINK_VALID_SECONDS"]
             token = jwt.encode(
                 dict(
@@ -120,20 +159,21 @@ def forgot_password():
             msg.body = f"To reset your password, please visit {reset_link}"
             # TODO: render email template here
             msg.html = f'To reset your password, please click this <a href="{reset_link}">link</a>'
-            mail.send(msg)
-            user.sent_reset_password_at = now
-            flash("Please check your mailbox for reset password email.", "success")
-            db.session.add(user)
+            queue_mail(msg)
             db.session.commit()
+            flash("Please check your mailbox for reset password email.", "success")
     return render_template("public/forgot_password.html", form=form)
 
 
 @blueprint.route("/reset-password", methods=["GET", "POST"])
+@query_budget(3)
 def reset_password():
     try:
         raw_token = request.args["token"]
         token = jwt.decode(
-            raw_token, key=current_app.config["SECRET_KEY"], algorithms=["HS256"],
+            raw_token,
+            key=current_app.config["SECRET_KEY"],
+            algorithms=["HS256"],
         )
         user_id = token["user_id"]
         expires_at = datetime.datetime.utcfromtimestamp(token["expires_at"]).replace(
@@ -146,7 +186,7 @@ def reset_password():
         flash("Invalid token.", "danger")
         return redirect(url_for("public.home"))
 
-    user = User.query.filter_by(id=user_id).with_for_update().first()
+    user = User.get_by_id(user_id, for_update=True)
 
     now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
     if now > expires_at or (
@@ -172,10 +212,10 @@ def reset_password():
 
 @blueprint.route("/__raise_error__")
 def raise_error():
-    # for testing bugsnag
+    # for testing error reporting
     raise RuntimeError("failed")
 
 
 @blueprint.route("/robots.txt")
 def static_from_root():
-    return send_from_directory(current_app.static_folder, request.path[1:])
+    return assets.send_static(request.path[1:])
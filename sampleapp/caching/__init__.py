@@ -0,0 +1,302 @@
+"""Application cache.
+
+:class:`Cache` stores pickled values in one of the backends of
+:mod:`sampleapp.caching.backends`, selected by ``CACHE_TYPE``:
+
+- ``simple``: an LRU map in the current worker
+- ``shm``: a memory mapped table shared by all workers on the host
+- ``filesystem``: one file per key in ``CACHE_DIR``
+- ``memcached``: memcached servers listed in ``CACHE_MEMCACHED_SERVERS``
+- ``null``: caching disabled
+- a dotted path (``package.module:Class``) to a custom
+  :class:`~sampleapp.caching.backends.CacheBackend`
+
+Keys live in namespaces. Every namespace has a generation stored in the
+backend next to its keys, and invalidating the namespace replaces the
+generation, which orphans all of its keys at once. Orphans are never read
+again and go away with the backend TTL or size eviction.
+"""
+import functools
+import hashlib
+import pickle
+import threading
+import time
+
+from flask import make_response
+from flask import request
+from werkzeug.utils import import_string
+
+from .backends import BACKENDS
+
+DEFAULT_NAMESPACE = "default"
+
+_MISSING = object()
+
+
+class Cache:
+    """Flask extension caching values in a configurable backend.
+
+    Configuration:
+
+    - ``CACHE_TYPE``: name of the backend or a dotted path to a backend class
+    - ``CACHE_DEFAULT_TIMEOUT``: TTL in seconds of entries set without an
+      explicit timeout, 0 never expires them
+    - ``CACHE_KEY_PREFIX``: prefix of all keys, to share a backend between
+      applications
+    - ``CACHE_LOCK_TIMEOUT_SECONDS``: how long other processes wait for the
+      one computing a missing value before computing it themselves
+    """
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.default_timeout = 0
+        self.key_prefix = ""
+        self.lock_timeout = 0
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.default_timeout = app.config.get("CACHE_DEFAULT_TIMEOUT", 300)
+        self.key_prefix = app.config.get("CACHE_KEY_PREFIX", "")
+        self.lock_timeout = app.config.get("CACHE_LOCK_TIMEOUT_SECONDS", 10)
+        backend = app.config.get("CACHE_TYPE", "simple")
+        backend_cls = BACKENDS.get(backend) or import_string(backend)
+        self.backend = backend_cls(app.config)
+        self._reset_stats()
+
+    def get(self, key, default=None, namespace=DEFAULT_NAMESPACE):
+        value = self._load(self._make_key(namespace, key))
+        self._record(namespace, value is not _MISSING)
+        return default if value is _MISSING else value
+
+    def set(self, key, value, timeout=None, namespace=DEFAULT_NAMESPACE):
+        self._store(self._make_key(namespace, key), value, timeout)
+
+    def delete(self, key, namespace=DEFAULT_NAMESPACE):
+        self.backend.delete(self._make_key(namespace, key))
+
+    def get_or_set(
+        self, key, func, timeout=None, namespace=DEFAULT_NAMESPACE, unless=None
+    ):
+        """Get the cached value of key, or compute it with ``func()`` and
+        cache it.
+
+        Only one thread per process computes a missing value, the others wait
+        for its result. Across processes a lock entry added to the backend
+        does the same, up to ``CACHE_LOCK_TIMEOUT_SECONDS``.
+
+        :param unless: Optional ``unless(value)`` predicate, the computed
+            value is not cached when it returns True
+        """
+        full_key = self._make_key(namespace, key)
+        value = self._load(full_key)
+        self._record(namespace, value is not _MISSING)
+        if value is not _MISSING:
+            return value
+
+        with self._single_flight(full_key):
+            # another thread may have computed it while we waited
+            value = self._load(full_key)
+            if value is not _MISSING:
+                return value
+            lock_key = f"{full_key}:lock"
+            locked = self.backend.add(lock_key, b"1", self.lock_timeout)
+            if not locked:
+                value = self._wait(full_key)
+                if value is not _MISSING:
+                    return value
+            try:
+                value = func()
+                if unless is None or not unless(value):
+                    self._store(full_key, value, timeout)
+            finally:
+                if locked:
+                    self.backend.delete(lock_key)
+            return value
+
+    def invalidate(self, namespace=DEFAULT_NAMESPACE):
+        """Drop all keys of namespace."""
+        self.backend.set(self._generation_key(namespace), _new_generation(), 0)
+
+    def generation(self, namespace=DEFAULT_NAMESPACE):
+        """Return the current generation of namespace, replaced by each
+        :meth:`invalidate`, for values cached outside of this cache."""
+        generation = self.backend.get(self._generation_key(namespace))
+        if generation is None:
+            # never start back from a previous generation, an evicted
+            # generation entry must not resurrect orphaned keys
+            generation = _new_generation()
+            if not self.backend.add(self._generation_key(namespace), generation, 0):
+                generation = self.backend.get(self._generation_key(namespace)) or (
+                    generation
+                )
+        return generation
+
+    @property
+    def shared(self):
+        """Whether every worker sees the same entries and generations."""
+        return self.backend is not None and self.backend.shared
+
+    def clear(self):
+        """Drop all keys of all namespaces."""
+        self.backend.clear()
+
+    def memoize(self, timeout=None, namespace=None):
+        """Decorator caching the results of a function by its arguments.
+
+        Arguments are part of the key through their ``repr``, so they must
+        have one identifying their value. Results of the function are
+        dropped by ``func.invalidate()``.
+
+        :param namespace: Defaults to the qualified name of the function
+        """
+
+        def decorator(func):
+            func_namespace = namespace or f"{func.__module__}.{func.__qualname__}"
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                key = _hash_key(repr((args, sorted(kwargs.items()))))
+                return self.get_or_set(
+                    key,
+                    lambda: func(*args, **kwargs),
+                    timeout=timeout,
+                    namespace=func_namespace,
+                )
+
+            wrapper.invalidate = lambda: self.invalidate(func_namespace)
+            wrapper.uncached = func
+            return wrapper
+
+        return decorator
+
+    def cached(self, timeout=None, namespace="views", key=None):
+        """Decorator caching the responses of a view.
+
+        Only successful GET responses not setting cookies are cached, keyed by
+        path and query string. The view must not depend on the current user.
+
+        :param key: Optional function returning the key of the current
+            request
+        """
+
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method not in ("GET", "HEAD"):
+                    return view(*args, **kwargs)
+
+                def render():
+                    response = make_response(view(*args, **kwargs))
+                    return (
+                        response.status_code,
+                        list(response.headers.items()),
+                        response.get_data(),
+                    )
+
+                status, headers, data = self.get_or_set(
+                    key() if key is not None else request.full_path,
+                    render,
+                    timeout=timeout,
+                    namespace=namespace,
+                    unless=_uncacheable_response,
+                )
+                return data, status, headers
+
+            return wrapper
+
+        return decorator
+
+    def stats(self):
+        """Return hit and miss counters and the hit rate of each namespace
+        used by this process."""
+        with self._stats_lock:
+            stats = {}
+            for namespace, (hits, misses) in self._stats.items():
+                stats[namespace] = dict(
+                    hits=hits, misses=misses, hit_rate=hits / ((hits + misses) or 1)
+                )
+            return stats
+
+    def _make_key(self, namespace, key):
+        generation = self.generation(namespace)
+        return f"{self.key_prefix}{namespace}:{generation.decode()}:{key}"
+
+    def _generation_key(self, namespace):
+        return f"{self.key_prefix}{namespace}:generation"
+
+    def _load(self, full_key):
+        data = self.backend.get(full_key)
+        if data is None:
+            return _MISSING
+        return pickle.loads(data)
+
+    def _store(self, full_key, value, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self.backend.set(full_key, data, timeout)
+
+    def _wait(self, full_key):
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            value = self._load(full_key)
+            if value is not _MISSING:
+                return value
+        return _MISSING
+
+    def _single_flight(self, full_key):
+        with self._flights_lock:
+            flight = self._flights.get(full_key)
+            if flight is None:
+                flight = self._flights[full_key] = _Flight(self, full_key)
+            flight.waiters += 1
+        return flight
+
+    def _record(self, namespace, hit):
+        with self._stats_lock:
+            hits, misses = self._stats.get(namespace, (0, 0))
+            self._stats[namespace] = (hits + 1, misses) if hit else (hits, misses + 1)
+
+    def _reset_stats(self):
+        with self._stats_lock:
+            self._stats = {}
+
+
+class _Flight:
+    """Lock of a key being computed, shared by the threads waiting for it."""
+
+    def __init__(self, cache, full_key):
+        self.cache = cache
+        self.full_key = full_key
+        self.lock = threading.Lock()
+        self.waiters = 0
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+        with self.cache._flights_lock:
+            self.waiters -= 1
+            if not self.waiters:
+                del self.cache._flights[self.full_key]
+
+
+def _uncacheable_response(value):
+    status, headers, data = value
+    return status != 200 or any(name == "Set-Cookie" for name, _ in headers)
+
+
+def _new_generation():
+    return str(time.time_ns()).encode()
+
+
+def _hash_key(value):
+    return hashlib.sha1(value.encode("utf-8")).hexdigest()
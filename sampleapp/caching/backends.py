@@ -0,0 +1,387 @@
+"""Cache storage backends.
+
+Backends store opaque bytes under string keys, serialization, namespaces and
+statistics are handled by :class:`~sampleapp.caching.Cache`. A ``timeout`` of
+0 means the entry does not expire.
+"""
+import collections
+import hashlib
+import logging
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+from ..shm import default_shm_path
+from ..shm import SharedTable
+
+logger = logging.getLogger(__name__)
+
+
+def _expires_at(timeout):
+    return time.time() + timeout if timeout else 0
+
+
+def _expired(expires_at):
+    return expires_at and expires_at <= time.time()
+
+
+class CacheBackend:
+    """Base class of cache backends, created with the application config."""
+
+    #: Whether the entries are seen by every worker, not only the one which
+    #: stored them
+    shared = True
+
+    def __init__(self, config):
+        self.config = config
+
+    def get(self, key):
+        """Return bytes stored for key, or None."""
+        raise NotImplementedError()
+
+    def set(self, key, value, timeout):
+        raise NotImplementedError()
+
+    def add(self, key, value, timeout):
+        """Store value only if key is not in the cache.
+
+        :return: True if the value was stored
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+
+class NullBackend(CacheBackend):
+    """Never caches anything."""
+
+    shared = False
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout):
+        pass
+
+    def add(self, key, value, timeout):
+        return True
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUBackend(CacheBackend):
+    """In-process cache keeping the ``CACHE_THRESHOLD`` most recently used
+    entries."""
+
+    shared = False
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.max_entries = config["CACHE_THRESHOLD"]
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if _expired(expires_at):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._set(key, value, timeout)
+
+    def add(self, key, value, timeout):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not _expired(entry[0]):
+                return False
+            self._set(key, value, timeout)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _set(self, key, value, timeout):
+        self._entries[key] = (_expires_at(timeout), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class SharedMemoryBackend(CacheBackend):
+    """Cache shared by all workers on the host, in a memory mapped table.
+
+    Configured by ``CACHE_SHM_PATH``, ``CACHE_SHM_SLOTS`` and
+    ``CACHE_SHM_VALUE_SIZE``. Values larger than the slot size are not cached,
+    and a key hashing to the slot of another key evicts it.
+    """
+
+    header = struct.Struct("<d")
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.table = SharedTable(
+            config.get("CACHE_SHM_PATH") or default_shm_path("sampleapp-cache"),
+            slots=config["CACHE_SHM_SLOTS"],
+            payload_size=self.header.size + config["CACHE_SHM_VALUE_SIZE"],
+        )
+
+    def get(self, key):
+        return self._unpack(self.table.get(key))
+
+    def set(self, key, value, timeout):
+        payload = self._pack(value, timeout)
+        if payload is not None:
+            self.table.set(key, payload)
+
+    def add(self, key, value, timeout):
+        payload = self._pack(value, timeout)
+        if payload is None:
+            return False
+        added = []
+
+        def update(current):
+            if self._unpack(current) is not None:
+                return current
+            added.append(True)
+            return payload
+
+        self.table.update(key, update)
+        return bool(added)
+
+    def delete(self, key):
+        self.table.delete(key)
+
+    def clear(self):
+        self.table.clear()
+
+    def _pack(self, value, timeout):
+        if self.header.size + len(value) > self.table.payload_size:
+            return None
+        return self.header.pack(_expires_at(timeout)) + value
+
+    def _unpack(self, payload):
+        if payload is None:
+            return None
+        (expires_at,) = self.header.unpack_from(payload)
+        if _expired(expires_at):
+            return None
+        return payload[self.header.size :]
+
+
+class FileSystemBackend(CacheBackend):
+    """Cache stored as one file per key in ``CACHE_DIR``, shared by all the
+    processes seeing that directory. Keeps at most ``CACHE_THRESHOLD``
+    files, dropping the least recently written ones."""
+
+    header = struct.Struct("<d")
+    #: Check the number of files once every that many writes
+    prune_interval = 100
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.directory = config.get("CACHE_DIR") or os.path.join(
+            tempfile.gettempdir(), "sampleapp-cache"
+        )
+        self.max_entries = config["CACHE_THRESHOLD"]
+        os.makedirs(self.directory, exist_ok=True)
+        self._writes = 0
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        (expires_at,) = self.header.unpack_from(data)
+        if _expired(expires_at):
+            return None
+        return data[self.header.size :]
+
+    def set(self, key, value, timeout):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.header.pack(_expires_at(timeout)) + value)
+        os.replace(tmp_path, self._path(key))
+        self._writes += 1
+        if self._writes % self.prune_interval == 0:
+            self.prune()
+
+    def add(self, key, value, timeout):
+        path = self._path(key)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except FileExistsError:
+                if self.get(key) is not None:
+                    return False
+                # expired entry, remove it and try again
+                self.delete(key)
+                continue
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.header.pack(_expires_at(timeout)) + value)
+            return True
+        return False
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def prune(self):
+        """Remove the oldest files above ``CACHE_THRESHOLD``."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+        entries.sort()
+        for _, path in entries[: max(len(entries) - self.max_entries, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name)
+
+
+class MemcachedBackend(CacheBackend):
+    """Cache on memcached servers listed in ``CACHE_MEMCACHED_SERVERS``,
+    speaking the text protocol directly. Keys are spread over the servers by
+    hash. Network errors are logged and treated as cache misses.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.servers = []
+        for server in config["CACHE_MEMCACHED_SERVERS"]:
+            host, _, port = server.rpartition(":")
+            self.servers.append((host, int(port)))
+        self.socket_timeout = config.get("CACHE_MEMCACHED_TIMEOUT", 0.5)
+        self._local = threading.local()
+
+    def get(self, key):
+        key = self._key(key)
+        return self._call(key, f"get {key}\r\n".encode(), read_value=True)
+
+    def set(self, key, value, timeout):
+        key = self._key(key)
+        self._store(b"set", key, value, timeout)
+
+    def add(self, key, value, timeout):
+        key = self._key(key)
+        return self._store(b"add", key, value, timeout) == b"STORED"
+
+    def delete(self, key):
+        key = self._key(key)
+        self._call(key, f"delete {key}\r\n".encode())
+
+    def clear(self):
+        for server in self.servers:
+            self._request(server, b"flush_all\r\n")
+
+    def _key(self, key):
+        # memcached keys are limited to 250 bytes without spaces or controls
+        if len(key) > 200 or any(c.isspace() or ord(c) < 33 for c in key):
+            return hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return key
+
+    def _store(self, command, key, value, timeout):
+        request = b"%s %s 0 %d %d\r\n%s\r\n" % (
+            command,
+            key.encode(),
+            int(timeout),
+            len(value),
+            value,
+        )
+        return self._call(key, request)
+
+    def _call(self, key, request, read_value=False):
+        digest = hashlib.sha1(key.encode("utf-8")).digest()
+        server = self.servers[int.from_bytes(digest[:4], "big") % len(self.servers)]
+        return self._request(server, request, read_value)
+
+    def _request(self, server, request, read_value=False):
+        try:
+            sock, reader = self._connection(server)
+            sock.sendall(request)
+            if not read_value:
+                return reader.readline().rstrip(b"\r\n")
+            value = None
+            while True:
+                line = reader.readline()
+                if not line:
+                    raise ConnectionError("Connection closed by memcached")
+                if line.startswith(b"VALUE"):
+                    length = int(line.split()[3])
+                    value = reader.read(length + 2)[:-2]
+                elif line.startswith(b"END"):
+                    return value
+                else:
+                    raise ConnectionError(f"Unexpected memcached reply {line!r}")
+        except (OSError, ValueError) as e:
+            logger.warning("Memcached %s:%s failed: %r", *server, e)
+            self._disconnect(server)
+            return None
+
+    def _sockets(self):
+        if not hasattr(self._local, "sockets"):
+            self._local.sockets = {}
+        return self._local.sockets
+
+    def _connection(self, server):
+        sockets = self._sockets()
+        if server not in sockets:
+            sock = socket.create_connection(server, timeout=self.socket_timeout)
+            sockets[server] = (sock, sock.makefile("rb"))
+        return sockets[server]
+
+    def _disconnect(self, server):
+        sock, reader = self._sockets().pop(server, (None, None))
+        if sock is not None:
+            reader.close()
+            sock.close()
+
+
+BACKENDS = dict(
+    null=NullBackend,
+    simple=LRUBackend,
+    lru=LRUBackend,
+    shm=SharedMemoryBackend,
+    filesystem=FileSystemBackend,
+    memcached=MemcachedBackend,
+)
@@ -0,0 +1,109 @@
+"""Full page cache for public views.
+
+Pages are cached as rendered bytes with a strong ETag. A request carrying a
+matching ``If-None-Match`` gets a 304 straight from the cache, without
+rendering anything.
+
+Pages only depend on the visitor through the navigation, the greeting of the
+logged in user and the pending flash messages, so a page is cached for the
+variant rendered to anonymous visitors with no pending flash message.
+Requests of logged in users, or with flash messages waiting in the session,
+are rendered as usual.
+"""
+import functools
+import hashlib
+
+from flask import current_app
+from flask import make_response
+from flask import request
+from flask import session
+from flask_login import current_user
+
+from ..extensions import cache
+
+NAMESPACE = "pages"
+
+
+def cache_page(timeout=None):
+    """Decorator caching the anonymous variant of a GET view.
+
+    Configuration:
+
+    - ``PAGE_CACHE_ENABLED``: render every page when False
+    - ``PAGE_CACHE_TIMEOUT``: how long a rendered page is kept, used when
+      timeout is None
+    - ``PAGE_CACHE_MAX_AGE``: ``max-age`` sent to browsers, 0 makes them
+      revalidate with ``If-None-Match`` on every visit
+
+    Clear cached pages with ``flask cache purge``.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not cacheable_request():
+                return view(*args, **kwargs)
+
+            rendered = []
+
+            def render():
+                response = make_response(view(*args, **kwargs))
+                rendered.append(response)
+                if response.status_code != 200 or "Set-Cookie" in response.headers:
+                    return None
+                data = response.get_data()
+                etag = hashlib.sha256(data).hexdigest()[:32]
+                return response.mimetype, data, etag
+
+            config = current_app.config
+            page = cache.get_or_set(
+                page_key(),
+                render,
+                timeout=config["PAGE_CACHE_TIMEOUT"] if timeout is None else timeout,
+                namespace=NAMESPACE,
+                unless=lambda page: page is None,
+            )
+            if page is None:
+                # not cacheable, rendered for this request only
+                return rendered[0]
+
+            mimetype, data, etag = page
+            response = current_app.response_class(mimetype=mimetype)
+            response.set_etag(etag)
+            response.vary.add("Cookie")
+            max_age = config["PAGE_CACHE_MAX_AGE"]
+            if max_age:
+                response.cache_control.public = True
+                response.cache_control.max_age = max_age
+            else:
+                response.cache_control.no_cache = True
+            if request.if_none_match.contains(etag):
+                response.status_code = 304
+            else:
+                response.set_data(data)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def cacheable_request():
+    return (
+        current_app.config["PAGE_CACHE_ENABLED"]
+        and request.method in ("GET", "HEAD")
+        and not current_user.is_authenticated
+        and not session.get("_flashes")
+    )
+
+
+def page_key():
+    """Cache key of the current page, the path and query string plus the
+    variant, "anonymous" and no pending flash message being the only one
+    cached."""
+    return f"{request.full_path}|anonymous|no-flash"
+
+
+def purge():
+    """Drop all cached pages."""
+    cache.invalidate(NAMESPACE)
@@ -1,5 +1,6 @@
 """Click commands."""
 import os
+import time
 from glob import glob
 from subprocess import call
 
@@ -69,6 +70,230 @@ def clean():
                 os.remove(full_pathname)
 
 
+@click.command("mail-worker")
+@click.option("--batch-size", default=None, type=int, help="Messages per batch")
+@click.option(
+    "--poll-interval", default=None, type=float, help="Seconds between outbox polls"
+)
+@click.option("--once", is_flag=True, help="Exit once the outbox is drained")
+@with_appcontext
+def mail_worker(batch_size, poll_interval, once):
+    """Deliver emails queued in the mail outbox."""
+    from .mailer import run_worker
+
+    run_worker(batch_size=batch_size, poll_interval=poll_interval, once=once)
+
+
+@click.group()
+def cache():
+    """Manage the application cache."""
+
+
+@cache.command()
+@click.option(
+    "--all", "purge_all", is_flag=True, help="Clear the whole cache, not only pages"
+)
+@with_appcontext
+def purge(purge_all):
+    """Clear cached pages, run on deploy so pages are rendered with the new
+    templates.
+
+    Only reaches caches shared between processes, per worker "simple" caches
+    start empty when the workers restart.
+    """
+    from .caching.pages import purge as purge_pages
+    from .extensions import cache as app_cache
+
+    if purge_all:
+        app_cache.clear()
+        click.echo("Cache cleared")
+    else:
+        purge_pages()
+        click.echo("Page cache purged")
+
+
+@click.group()
+def rollups():
+    """Manage the rollups of the admin dashboard."""
+
+
+@rollups.command("rebuild")
+@with_appcontext
+def rebuild_rollups():
+    """Recompute the user rollups from the users table, run periodically to
+    correct changes made outside of the application."""
+    from .extensions import db
+    from .models.stats import UserDailyStats
+
+    started_at = time.monotonic()
+    UserDailyStats.rebuild()
+    db.session.commit()
+    elapsed = time.monotonic() - started_at
+    click.echo(f"User rollups rebuilt in {elapsed:.1f} s")
+
+
+@click.group()
+def shards():
+    """Manage the user shards, see USER_SHARD_URLS."""
+
+
+@shards.command("migrate")
+@click.option("--batch-size", default=1000, help="Users moved per transaction")
+@with_appcontext
+def migrate_shards(batch_size):
+    """Move the users of the default database to their shards, run when
+    setting USER_SHARD_URLS, see sampleapp.models.sharding.
+
+    Moved users get new ids, so they have to sign in again.
+    """
+    from .models.accounts import User
+    from .models.sharding import shard_count
+
+    if not shard_count():
+        raise click.UsageError("USER_SHARD_URLS is not configured")
+    started_at = time.monotonic()
+    moved, conflicts = User.move_to_shards(batch_size=batch_size)
+    elapsed = time.monotonic() - started_at
+    click.echo(f"Moved {moved} users to {shard_count()} shards in {elapsed:.1f} s")
+    for email in conflicts:
+        click.echo(
+            f"Left {email} in the default database, their email is taken on "
+            "their shard",
+            err=True,
+        )
+    if conflicts:
+        exit(1)
+
+
+@click.group()
+def memory():
+    """Inspect the memory of the workers, see MEMORY_TRACKING_ENABLED."""
+
+
+@memory.command("report")
+@click.option("--top", default=10, help="Allocation sites listed by worker")
+@click.option(
+    "--since",
+    type=click.Choice(["start", "last"]),
+    default="start",
+    help="Growth since the first or the previous snapshot (default: start)",
+)
+@with_appcontext
+def memory_report(top, since):
+    """List the allocation sites growing the most in each live worker, and
+    the memory retained by the requests of each endpoint."""
+    from .extensions import memory as tracker
+
+    reports = tracker.reports()
+    if not reports:
+        click.echo(f"No worker reported in {tracker.directory}")
+        return
+    for report in reports:
+        minutes = (report["updated_at"] - report["started_at"]) / 60
+        click.echo(
+            f"Worker {report['pid']}: {report['rss_bytes'] / 2 ** 20:.1f} MiB "
+            f"resident, {report['traced_bytes'] / 2 ** 20:.1f} MiB traced, "
+            f"{report['snapshots']} snapshots in {minutes:.1f} min"
+        )
+        for grower in report[f"growers_since_{since}"][:top]:
+            click.echo(
+                f"  {grower['size_diff'] / 1024:+10.1f} KiB "
+                f"{grower['count_diff']:+8d} blocks  {grower['traceback'][-1]}"
+            )
+        endpoints = sorted(
+            report["endpoints"].items(),
+            key=lambda item: item[1]["retained_bytes"],
+            reverse=True,
+        )
+        for endpoint, stats in endpoints[:top]:
+            click.echo(
+                f"  {stats['retained_bytes'] / stats['requests'] / 1024:+10.1f} KiB "
+                f"by request, {stats['requests']} requests  {endpoint}"
+            )
+
+
+@click.group()
+def assets():
+    """Manage static assets."""
+
+
+@assets.command("build")
+@click.option(
+    "--output", default=None, help="Output directory (default: ASSETS_DIST_DIR)"
+)
+@with_appcontext
+def build_assets(output):
+    """Write fingerprinted and compressed copies of the static files, served
+    by the application with far future cache headers."""
+    from .assets import brotli
+    from .assets import build
+
+    output = output or current_app.config["ASSETS_DIST_DIR"]
+    if not output:
+        raise click.UsageError("ASSETS_DIST_DIR is not configured")
+    started_at = time.monotonic()
+    manifest = build(current_app.static_folder, output)
+    elapsed = time.monotonic() - started_at
+    compressed = sum(1 for name in manifest["assets"] if manifest["encodings"][name])
+    click.echo(
+        f"Built {len(manifest['assets'])} assets ({compressed} compressed) into "
+        f"{output} in {elapsed:.1f} s"
+    )
+    if brotli is None:
+        click.echo("brotli is not installed, only gzip variants were written")
+
+
+@click.group()
+def templates():
+    """Manage Jinja templates."""
+
+
+@templates.command("compile")
+@click.option(
+    "--directory",
+    default=None,
+    help="Bytecode cache directory (default: TEMPLATE_CACHE_DIR)",
+)
+@with_appcontext
+def compile_templates(directory):
+    """Compile all templates, including the Flask-Admin ones, into the
+    bytecode cache loaded by the application at startup."""
+    from jinja2 import FileSystemBytecodeCache
+    from jinja2 import TemplateSyntaxError
+
+    directory = directory or current_app.config["TEMPLATE_CACHE_DIR"]
+    if not directory:
+        raise click.UsageError("TEMPLATE_CACHE_DIR is not configured")
+    os.makedirs(directory, exist_ok=True)
+    env = current_app.jinja_env
+    env.bytecode_cache = FileSystemBytecodeCache(directory)
+    env.bytecode_cache.clear()
+    env.cache.clear()
+
+    timings = []
+    errors = 0
+    started_at = time.monotonic()
+    for name in sorted(env.list_templates()):
+        template_started_at = time.monotonic()
+        try:
+            env.get_template(name)
+        except TemplateSyntaxError as e:
+            errors += 1
+            click.echo(f"Failed to compile {name}: {e}", err=True)
+            continue
+        timings.append((time.monotonic() - template_started_at, name))
+    elapsed = time.monotonic() - started_at
+
+    click.echo(
+        f"Compiled {len(timings)} templates into {directory} in "
+        f"{elapsed * 1000:.0f} ms"
+    )
+    for seconds, name in sorted(timings, reverse=True)[:5]:
+        click.echo(f"  {seconds * 1000:7.1f} ms  {name}")
+    if errors:
+        exit(1)
+
+
 @click.command()
 @click.option("--url", default=None, help="Url to test (ex. /static/image.png)")
 @click.option(
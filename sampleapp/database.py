@@ -0,0 +1,534 @@
+"""Database engines configured from the settings.
+
+Each worker has its own pool of ``DATABASE_POOL_SIZE`` connections, plus up
+to ``DATABASE_MAX_OVERFLOW`` more under load, so the database sees up to
+``processes * (pool size + overflow)`` connections. Size them against the
+connection limit of the database plan, minus the connections of one-off
+dynos and migrations.
+
+Behind PgBouncer in transaction pooling mode, set ``DATABASE_PGBOUNCER``:
+server connections are shared between transactions of different clients, so
+session settings like ``statement_timeout`` are set for each transaction
+instead of when connecting.
+
+Pools are replaced in forked processes, like gunicorn workers of an app
+loaded with ``--preload``, so that children never use the connections of
+their parent.
+
+With ``DATABASE_REPLICA_URLS``, reads are spread over read replicas, see
+:class:`RoutingSession`. With ``USER_SHARD_URLS``, users are spread over
+several databases, see :mod:`sampleapp.models.sharding`.
+"""
+import logging
+import os
+import threading
+import time
+import weakref
+
+from flask import has_request_context
+from flask import session as flask_session
+from flask_sqlalchemy import SignallingSession
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy import exc
+from sqlalchemy import inspect
+from sqlalchemy import orm
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import Select
+
+logger = logging.getLogger(__name__)
+
+#: Key of the Flask session holding the time until which reads of the
+#: browser go to the primary
+STICKY_SESSION_KEY = "_db_primary_until"
+
+#: Prefix of the binds of the shard databases, followed by the shard number
+SHARD_BIND_PREFIX = "user-shard-"
+
+#: Replication lag of a replica in seconds, 0 when it replayed everything it
+#: received, NULL on a primary
+REPLICATION_LAG_SQL = """
+SELECT CASE
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+#: Pools of engines created by the parent process. A forked process keeps
+#: them referenced without using them: garbage collecting their connections
+#: would close them, and with them the connections of the parent.
+_inherited_pools = []
+
+_engines = weakref.WeakSet()
+
+
+class PoolStats:
+    """Counters of the time spent getting connections from a pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, seconds, timed_out):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                checkouts=self.checkouts,
+                timeouts=self.timeouts,
+                wait_seconds=self.wait_seconds,
+                max_wait_seconds=self.max_wait_seconds,
+            )
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool timing how long checkouts take to get a connection, be it
+    waiting for a connection to be returned or opening a new one."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self.stats.record(time.perf_counter() - started_at, timed_out)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def engine_options(config):
+    """Return the options of :func:`sqlalchemy.create_engine` given by the
+    ``DATABASE_*`` settings."""
+    options = dict(
+        poolclass=InstrumentedQueuePool,
+        pool_size=config["DATABASE_POOL_SIZE"],
+        max_overflow=config["DATABASE_MAX_OVERFLOW"],
+        pool_timeout=config["DATABASE_POOL_TIMEOUT"],
+        pool_recycle=config["DATABASE_POOL_RECYCLE"],
+        pool_pre_ping=config["DATABASE_POOL_PRE_PING"],
+    )
+    timeout = config["DATABASE_STATEMENT_TIMEOUT_MS"]
+    if timeout and not config["DATABASE_PGBOUNCER"]:
+        options["connect_args"] = dict(options=f"-c statement_timeout={int(timeout)}")
+    return options
+
+
+def pool_stats(engine):
+    """Return the number of connections of the pool of engine, by state, and
+    the counters of its checkouts."""
+    pool = engine.pool
+    stats = dict(
+        size=pool.size(),
+        checked_in=pool.checkedin(),
+        checked_out=pool.checkedout(),
+        overflow=max(pool.overflow(), 0),
+    )
+    if isinstance(pool, InstrumentedQueuePool):
+        stats.update(pool.stats.snapshot())
+    return stats
+
+
+class Database(SQLAlchemy):
+    """Flask-SQLAlchemy extension creating engines configured by
+    :func:`engine_options`.
+
+    Configuration:
+
+    - ``DATABASE_POOL_SIZE``: connections kept open by each process
+    - ``DATABASE_MAX_OVERFLOW``: connections opened above the pool size under
+      load, and closed once returned
+    - ``DATABASE_POOL_TIMEOUT``: how long to wait for a connection when all
+      of them are in use, in seconds
+    - ``DATABASE_POOL_RECYCLE``: age in seconds after which connections are
+      replaced, -1 keeps them
+    - ``DATABASE_POOL_PRE_PING``: test connections before using them, to
+      replace the ones closed by the server
+    - ``DATABASE_STATEMENT_TIMEOUT_MS``: ``statement_timeout`` of
+      connections, 0 disables it
+    - ``DATABASE_PGBOUNCER``: connect through PgBouncer in transaction pooling
+      mode
+
+    - ``DATABASE_REPLICA_URLS``: read replicas, see :class:`RoutingSession`
+    - ``DATABASE_REPLICA_STICKY_SECONDS``: how long the reads of a browser go
+      to the primary after it committed a write
+    - ``DATABASE_REPLICA_MAX_LAG_SECONDS``: replicas lagging behind the
+      primary by more than this are not read from
+    - ``DATABASE_REPLICA_CHECK_SECONDS``: how often the lag of replicas is
+      checked, and unreachable replicas retried
+    - ``DATABASE_REPLICA_CONNECT_TIMEOUT``: seconds to wait for a replica to
+      accept a connection
+
+    - ``USER_SHARD_URLS``: databases of the sharded tables, added to the
+      binds as ``user-shard-<n>``, see :class:`RoutingSession`
+
+    ``SQLALCHEMY_ENGINE_OPTIONS`` still overrides these options.
+    """
+
+    def init_app(self, app):
+        shard_urls = [url for url in app.config.get("USER_SHARD_URLS", ()) if url]
+        if shard_urls:
+            binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+            for shard, url in enumerate(shard_urls):
+                binds[f"{SHARD_BIND_PREFIX}{shard}"] = url
+            app.config["SQLALCHEMY_BINDS"] = binds
+        super().init_app(app)
+        app.extensions["database_replicas"] = Replicas(self, app)
+        #: Binds of the shards, by shard number
+        app.extensions["database_shards"] = [
+            f"{SHARD_BIND_PREFIX}{shard}" for shard in range(len(shard_urls))
+        ]
+
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(factory, "after_flush", _mark_written)
+        event.listen(factory, "after_commit", _stick_to_primary)
+        event.listen(factory, "after_soft_rollback", _forget_writes)
+        event.listen(factory, "do_orm_execute", _route_to_shards)
+        return factory
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        rv = super().apply_driver_hacks(app, sa_url, options)
+        options.update(engine_options(app.config))
+        if app.config["DATABASE_PGBOUNCER"]:
+            options["_transaction_statement_timeout"] = app.config[
+                "DATABASE_STATEMENT_TIMEOUT_MS"
+            ]
+        return rv
+
+    def create_engine(self, sa_url, engine_opts):
+        timeout = engine_opts.pop("_transaction_statement_timeout", None)
+        engine = super().create_engine(sa_url, engine_opts)
+        if timeout:
+            _set_statement_timeout_per_transaction(engine, int(timeout))
+        _engines.add(engine)
+        return engine
+
+    def create_replica_engine(self, app, url):
+        sa_url = make_url(url)
+        options = {}
+        self.apply_driver_hacks(app, sa_url, options)
+        options.update(app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+        # an unreachable replica must not hold a worker for the TCP timeout
+        connect_args = options["connect_args"] = dict(options.get("connect_args", {}))
+        connect_args.setdefault(
+            "connect_timeout", app.config["DATABASE_REPLICA_CONNECT_TIMEOUT"]
+        )
+        return self.create_engine(sa_url, options)
+
+    def pool_stats(self, app=None):
+        """Return :func:`pool_stats` of the engines of app, by bind, None
+        being the default database, ``user-shard-<n>`` the shards and
+        ``replica-<n>`` the replicas."""
+        app = self.get_app(app)
+        binds = [None] + list(app.config.get("SQLALCHEMY_BINDS") or ())
+        stats = {bind: pool_stats(self.get_engine(app, bind)) for bind in binds}
+        replicas = app.extensions["database_replicas"]
+        for index, engine in enumerate(replicas.engines):
+            stats[f"replica-{index}"] = pool_stats(engine)
+        return stats
+
+
+class Replicas:
+    """Read replicas of the default database of an app, picked in turn.
+
+    Each process checks the replicas from a thread of its own, started when
+    it first picks one, and then every ``DATABASE_REPLICA_CHECK_SECONDS``.
+    Only the first pick waits for the first check, at most that long.
+    Unreachable replicas and the ones lagging behind the primary by more than
+    ``DATABASE_REPLICA_MAX_LAG_SECONDS`` are skipped
+    until a check finds them healthy again, as are replicas failing a read,
+    see :class:`RoutingSession`.
+    """
+
+    def __init__(self, db, app):
+        self.db = db
+        self.app = app
+        self.urls = [url for url in app.config["DATABASE_REPLICA_URLS"] if url]
+        self.max_lag = app.config["DATABASE_REPLICA_MAX_LAG_SECONDS"]
+        self.check_interval = app.config["DATABASE_REPLICA_CHECK_SECONDS"]
+        self._engines = None
+        self._lock = threading.Lock()
+        self._checker_lock = threading.Lock()
+        self._checker_pid = None
+        self._stopped = threading.Event()
+        self._next = 0
+        self._checked = threading.Event()
+        self._healthy = [False] * len(self.urls)
+
+    @property
+    def engines(self):
+        if self._engines is None and self.urls:
+            with self._lock:
+                if self._engines is None:
+                    self._engines = [
+                        self.db.create_replica_engine(self.app, url)
+                        for url in self.urls
+                    ]
+        return self._engines or []
+
+    def pick(self):
+        """Return the engine of the next healthy replica, None when there is
+        none."""
+        engines = self.engines
+        if not engines:
+            return None
+        self._start_checker()
+        with self._lock:
+            start = self._next
+            self._next = (start + 1) % len(engines)
+        for offset in range(len(engines)):
+            index = (start + offset) % len(engines)
+            if self._healthy[index]:
+                return engines[index]
+        return None
+
+    def is_healthy(self, index):
+        """Whether the last check of replica index found it healthy."""
+        return self._healthy[index]
+
+    def check(self):
+        """Check every replica now."""
+        for index in range(len(self.urls)):
+            self._healthy[index] = self._check(index)
+        self._checked.set()
+
+    def mark_unhealthy(self, engine):
+        """Skip the replica of engine until its next check."""
+        self._healthy[self.engines.index(engine)] = False
+
+    def close(self):
+        """Stop checking the replicas and close their connections."""
+        self._stopped.set()
+        for engine in self.engines:
+            engine.dispose()
+
+    def _start_checker(self):
+        if self._checker_pid == os.getpid():
+            return
+        with self._checker_lock:
+            if self._checker_pid == os.getpid():
+                return
+            thread = threading.Thread(
+                target=self._run, name="replica-checks", daemon=True
+            )
+            thread.start()
+            self._checker_pid = os.getpid()
+        self._checked.wait(self.check_interval)
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Could not check the replicas")
+            if self._stopped.wait(self.check_interval):
+                return
+
+    def _check(self, index):
+        try:
+            with self.engines[index].connect() as connection:
+                lag = connection.exec_driver_sql(REPLICATION_LAG_SQL).scalar()
+        except exc.DBAPIError as e:
+            logger.warning("Replica %d is unreachable: %s", index, e)
+            return False
+        if lag is not None and lag > self.max_lag:
+            logger.warning("Replica %d is %.1f s behind, skipping it", index, lag)
+            return False
+        return True
+
+
+class RoutingSession(SignallingSession):
+    """Session reading from the replicas of the default database, and
+    writing sharded tables to their shards.
+
+    SELECTs go to a replica, unless:
+
+    - they lock rows, with ``with_for_update()``
+    - the transaction already wrote something, so that it reads its own
+      writes
+    - the browser committed a write in the last
+      ``DATABASE_REPLICA_STICKY_SECONDS``, so that users see their own writes
+      even if replicas lag behind
+
+    Everything else goes to the primary, as do models with a ``__bind_key__``.
+    A SELECT failing on a replica with an ``OperationalError``, the replica
+    going down since its last check, marks the replica unhealthy and runs
+    again on the primary, unless the session has changes the rollback of the
+    broken transaction would lose.
+
+    Tables with ``info={"sharded": True}`` live in the ``USER_SHARD_URLS``
+    databases instead, when there are some. Their models tell the shard of a
+    row from its primary key with a ``shard_for_id`` class method. Statements
+    run on the shard given by their ``shard`` execution option, flushes write
+    every row to its own shard, and ORM SELECTs without a shard run on every
+    shard, their rows concatenated.
+    """
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.db = db
+        self.wrote = False
+        #: Replica the last statement was sent to
+        self._replica = None
+        self._primary_only = False
+        self.shard_binds = self.app.extensions["database_shards"]
+        if self.shard_binds:
+            self.connection_callable = self._connection_for_instance
+
+    def get_bind(self, mapper=None, clause=None, shard=None, **kwargs):
+        if shard is not None:
+            return self.db.get_engine(self.app, self.shard_binds[shard])
+        if self.shard_binds and _is_sharded(mapper, clause):
+            raise exc.UnboundExecutionError(
+                f"No shard given to run {clause if clause is not None else mapper}"
+            )
+        if isinstance(clause, Select) and clause._for_update_arg is None:
+            if self._reads_from_replica(mapper):
+                replica = self.app.extensions["database_replicas"].pick()
+                if replica is not None:
+                    self._replica = replica
+                    return replica
+        elif clause is not None:
+            # locking reads, and writes run with session.execute like bulk
+            # UPDATEs, the rest of the transaction reads from the primary
+            self.wrote = True
+        return super().get_bind(mapper, clause)
+
+    def execute(self, *args, **kwargs):
+        self._replica = None
+        try:
+            return super().execute(*args, **kwargs)
+        except exc.OperationalError as e:
+            replica, self._replica = self._replica, None
+            if replica is None or self._has_changes():
+                raise
+            logger.warning("Read from a replica failed, retrying on the primary: %s", e)
+            self.app.extensions["database_replicas"].mark_unhealthy(replica)
+            # the transaction may hold the broken connection of the replica
+            self.rollback()
+            self._primary_only = True
+            try:
+                return super().execute(*args, **kwargs)
+            finally:
+                self._primary_only = False
+
+    def _has_changes(self):
+        return bool(
+            self.wrote or self._flushing or self.new or self.dirty or self.deleted
+        )
+
+    def _connection_for_instance(self, mapper, instance):
+        shard = None
+        if _is_sharded(mapper, None):
+            shard = _shard_of_state(inspect(instance))
+        return self.get_transaction().connection(mapper, shard=shard)
+
+    def _reads_from_replica(self, mapper):
+        if self._flushing or self.wrote or self._primary_only:
+            return False
+        if mapper is not None and mapper.persist_selectable.info.get("bind_key"):
+            return False
+        return not _sticky_to_primary()
+
+
+def _is_sharded(mapper, clause):
+    if mapper is not None:
+        return mapper.persist_selectable.info.get("sharded", False)
+    # INSERT, UPDATE and DELETE statements of tables
+    table = getattr(clause, "table", None)
+    return table is not None and table.info.get("sharded", False)
+
+
+def _shard_of_state(state):
+    if state.key is not None:
+        identity = state.identity
+    else:
+        identity = state.mapper.primary_key_from_instance(state.obj())
+    return state.class_.shard_for_id(*identity)
+
+
+def _route_to_shards(orm_context):
+    session = orm_context.session
+    if not session.shard_binds or "shard" in orm_context.bind_arguments:
+        return None
+    shard = orm_context.execution_options.get("shard")
+    if shard is None and orm_context.is_select and orm_context.is_orm_statement:
+        refreshed = orm_context.load_options._refresh_state
+        if refreshed is not None and _is_sharded(refreshed.mapper, None):
+            shard = _shard_of_state(refreshed)
+    if shard is not None:
+        orm_context.bind_arguments["shard"] = shard
+        return None
+    if not (
+        orm_context.is_select
+        and orm_context.is_orm_statement
+        and _is_sharded(orm_context.bind_mapper, None)
+    ):
+        return None
+    results = [
+        orm_context.invoke_statement(bind_arguments=dict(shard=shard))
+        for shard in range(len(session.shard_binds))
+    ]
+    return results[0].merge(*results[1:])
+
+
+def _sticky_to_primary():
+    return (
+        has_request_context() and flask_session.get(STICKY_SESSION_KEY, 0) > time.time()
+    )
+
+
+def _mark_written(session, flush_context):
+    session.wrote = True
+
+
+def _stick_to_primary(session):
+    if session.wrote and has_request_context():
+        sticky_seconds = session.app.config["DATABASE_REPLICA_STICKY_SECONDS"]
+        if sticky_seconds and session.app.extensions["database_replicas"].urls:
+            flask_session[STICKY_SESSION_KEY] = time.time() + sticky_seconds
+    session.wrote = False
+
+
+def _forget_writes(session, previous_transaction):
+    session.wrote = False
+
+
+def _set_statement_timeout_per_transaction(engine, timeout):
+    @event.listens_for(engine, "begin")
+    def set_statement_timeout(conn):
+        # the DBAPI cursor opens the transaction the setting is local to
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(f"SET LOCAL statement_timeout = {timeout}")
+        finally:
+            cursor.close()
+
+
+def _replace_inherited_pools():
+    for engine in list(_engines):
+        _inherited_pools.append(engine.pool)
+        engine.pool = engine.pool.recreate()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_replace_inherited_pools)
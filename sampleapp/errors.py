@@ -0,0 +1,335 @@
+"""Report unhandled exceptions of requests to Bugsnag, without letting an
+exception storm slow requests down.
+
+Exceptions are grouped by fingerprint, their class and the functions of their
+traceback, named by module, so the same error raised with different messages,
+from different lines of a function or by a release deployed to another
+directory is one error. Each fingerprint gets a token
+bucket: a failing request only builds and queues a report when its bucket
+has a token, other occurrences are counted. Reports carry the number of
+occurrences they stand for, and occurrences counted since the last report
+of a fingerprint are sent every ``ERROR_REPORTER_FLUSH_SECONDS``.
+
+Reports are built and delivered by the Bugsnag client, from a thread of the
+worker reading a bounded queue. When the queue is full, the report is
+dropped and its occurrences are counted with the next one.
+"""
+import collections
+import datetime
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+import traceback
+import urllib.request
+
+import bugsnag
+from bugsnag.delivery import default_headers
+from bugsnag.delivery import Delivery
+from flask import _request_ctx_stack
+from flask import got_request_exception
+from flask import has_request_context
+from flask import request
+
+from .ratelimit import refill
+
+logger = logging.getLogger(__name__)
+
+_FLUSH = object()
+
+
+def fingerprint(exc_type, frames):
+    """Return the fingerprint of an exception.
+
+    :param exc_type: Class of the exception
+    :param frames: Frames of its traceback, as ``(file, line, function,
+        module)``
+    """
+    digest = hashlib.sha1(f"{exc_type.__module__}.{exc_type.__qualname__}".encode())
+    for _, _, function, module in frames:
+        digest.update(f"\n{module}:{function}".encode())
+    return digest.hexdigest()[:16]
+
+
+def extract_frames(exc):
+    """Return the frames of the traceback of exc, outermost first, without
+    reading source lines."""
+    return [
+        (
+            frame.f_code.co_filename,
+            lineno,
+            frame.f_code.co_name,
+            # code run outside of a module, by exec, falls back to its file
+            frame.f_globals.get("__name__") or frame.f_code.co_filename,
+        )
+        for frame, lineno in traceback.walk_tb(exc.__traceback__)
+    ]
+
+
+def _isoformat(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).isoformat() + "Z"
+
+
+class TimeoutDelivery(Delivery):
+    """Delivery of the Bugsnag client giving up after a timeout, so an
+    unreachable endpoint doesn't block the queue for good."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def deliver(self, config, payload, options=None):
+        http_request = urllib.request.Request(
+            config.endpoint,
+            data=payload.encode("utf-8"),
+            headers=default_headers(config.api_key),
+        )
+        with urllib.request.urlopen(http_request, timeout=self.timeout) as response:
+            response.read()
+
+
+class Report:
+    """Sampled occurrence of an exception, waiting to be delivered."""
+
+    def __init__(self, key, exc, details, occurrences):
+        self.key = key
+        self.exc = exc
+        #: Request of the occurrence, captured in the request thread
+        self.details = details
+        self.occurrences = occurrences
+
+    def again(self, state, count):
+        """Return this report standing for count other occurrences."""
+        return Report(self.key, self.exc, self.details, state.occurrences(count))
+
+
+class Fingerprint:
+    """Occurrences of a fingerprint and its token bucket."""
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated_at = now
+        #: Occurrences not reported yet
+        self.pending = 0
+        self.first_seen = now
+        self.last_seen = now
+        #: Last report, sent again with the pending occurrences
+        self.report = None
+
+    def occurrences(self, count):
+        return dict(
+            count=count,
+            firstSeen=_isoformat(self.first_seen),
+            lastSeen=_isoformat(self.last_seen),
+        )
+
+
+class ErrorReporter:
+    """Flask extension reporting the unhandled exceptions of requests.
+
+    Configuration:
+
+    - ``ERROR_REPORTER_API_KEY``: Bugsnag API key, nothing is reported
+      without it
+    - ``ERROR_REPORTER_URL``: endpoint of the reports
+    - ``ERROR_REPORTER_SAMPLES_PER_MINUTE``: reports of each fingerprint by
+      minute, after a burst of ``ERROR_REPORTER_BURST``
+    - ``ERROR_REPORTER_QUEUE_SIZE``: reports waiting to be sent, more are
+      dropped
+    - ``ERROR_REPORTER_FLUSH_SECONDS``: time between reports of the
+      occurrences counted since the last report of their fingerprint
+    - ``ERROR_REPORTER_MAX_FINGERPRINTS``: fingerprints counted by worker,
+      the least recently seen are forgotten
+    - ``ERROR_REPORTER_TIMEOUT``: timeout of the requests to the endpoint
+    """
+
+    def __init__(self, app=None):
+        self.api_key = None
+        self.url = None
+        self.rate = 1 / 60
+        self.burst = 3
+        self.flush_seconds = 60
+        self.max_fingerprints = 1000
+        self.timeout = 5
+        self.release_stage = None
+        self.root_path = None
+        #: Reports dropped because the queue was full
+        self.dropped = 0
+        #: Bugsnag client building and delivering the reports
+        self.client = None
+        self._queue = None
+        self._fingerprints = collections.OrderedDict()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.api_key = config.get("ERROR_REPORTER_API_KEY")
+        self.url = config.get("ERROR_REPORTER_URL", "https://notify.bugsnag.com")
+        self.rate = config.get("ERROR_REPORTER_SAMPLES_PER_MINUTE", 1) / 60
+        self.burst = config.get("ERROR_REPORTER_BURST", 3)
+        self.flush_seconds = config.get("ERROR_REPORTER_FLUSH_SECONDS", 60)
+        self.max_fingerprints = config.get("ERROR_REPORTER_MAX_FINGERPRINTS", 1000)
+        self.timeout = config.get("ERROR_REPORTER_TIMEOUT", 5)
+        self.release_stage = config.get("ENV")
+        self.root_path = os.path.dirname(app.root_path)
+        self.dropped = 0
+        self._queue = queue.Queue(config.get("ERROR_REPORTER_QUEUE_SIZE", 100))
+        self._fingerprints.clear()
+        self._thread = None
+        self.client = None
+        if self.api_key:
+            self.client = bugsnag.Client(
+                api_key=self.api_key,
+                endpoint=self.url,
+                release_stage=self.release_stage or "production",
+                project_root=self.root_path,
+                # delivered from the thread of the reporter
+                asynchronous=False,
+                delivery=TimeoutDelivery(self.timeout),
+                auto_capture_sessions=False,
+                install_sys_hook=False,
+            )
+            got_request_exception.connect(self._log_exception, app)
+
+    def report(self, exc):
+        """Count an occurrence of exc, and queue a report of it when its
+        fingerprint has a token.
+
+        :return: Fingerprint of exc
+        """
+        now = time.time()
+        frames = extract_frames(exc)
+        key = fingerprint(type(exc), frames)
+        with self._lock:
+            state = self._fingerprints.get(key)
+            if state is None:
+                state = self._fingerprints[key] = Fingerprint(self.burst, now)
+                if len(self._fingerprints) > self.max_fingerprints:
+                    self._fingerprints.popitem(last=False)
+            else:
+                self._fingerprints.move_to_end(key)
+            state.pending += 1
+            state.last_seen = now
+            allowed, state.tokens = refill(
+                state.tokens, state.updated_at, self.rate, self.burst, now
+            )
+            state.updated_at = now
+            if not allowed:
+                return key
+            count, state.pending = state.pending, 0
+        report = Report(key, exc, self._details(), state.occurrences(count))
+        with self._lock:
+            state.report = report
+        self._enqueue(report)
+        return key
+
+    def flush(self):
+        """Send the queued reports and the occurrences not reported yet,
+        and wait until they are sent."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._queue.put(_FLUSH)
+        self._queue.join()
+
+    def _log_exception(self, sender, exception, **extra):
+        try:
+            self.report(exception)
+        except Exception:
+            logger.exception("Could not report exception")
+
+    def _start_thread(self):
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            if self._pid is not None and self._pid != os.getpid():
+                # the queue may be locked by a thread of the parent
+                self._queue = queue.Queue(self._queue.maxsize)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name="error-reporter", daemon=True
+            )
+            self._thread.start()
+
+    def _enqueue(self, report):
+        self._start_thread()
+        try:
+            self._queue.put_nowait(report)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                state = self._fingerprints.get(report.key)
+                if state is not None:
+                    state.pending += report.occurrences["count"]
+
+    def _run(self):
+        flush_at = time.monotonic() + self.flush_seconds
+        while True:
+            try:
+                item = self._queue.get(timeout=max(flush_at - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+            reports = [item] if isinstance(item, Report) else []
+            try:
+                if item is _FLUSH or time.monotonic() >= flush_at:
+                    reports.extend(self._pending_reports())
+                    flush_at = time.monotonic() + self.flush_seconds
+                for report in reports:
+                    self._notify(report)
+            except Exception:
+                logger.exception("Could not send %d error reports", len(reports))
+            finally:
+                if item is not None:
+                    self._queue.task_done()
+
+    def _pending_reports(self):
+        reports = []
+        with self._lock:
+            for state in self._fingerprints.values():
+                if state.pending and state.report is not None:
+                    reports.append(state.report.again(state, state.pending))
+                    state.pending = 0
+        return reports
+
+    def _notify(self, report):
+        exc = report.exc
+        self.client.notify(
+            exc,
+            traceback=exc.__traceback__,
+            grouping_hash=report.key,
+            severity="error",
+            unhandled=True,
+            severity_reason=dict(
+                type="unhandledExceptionMiddleware", attributes=dict(framework="Flask")
+            ),
+            context=report.details.get("context"),
+            user=dict(report.details.get("user", {})),
+            meta_data=dict(
+                request=report.details.get("request", {}),
+                occurrences=report.occurrences,
+            ),
+        )
+        # the report is kept for the pending occurrences of its fingerprint,
+        # which don't need the locals of its frames
+        traceback.clear_frames(exc.__traceback__)
+
+    def _details(self):
+        """Return what a report needs from the current request."""
+        if not has_request_context():
+            return {}
+        details = dict(
+            context=request.endpoint,
+            request=dict(
+                url=request.base_url,
+                httpMethod=request.method,
+                clientIp=request.headers.get("X-Forwarded-For", request.remote_addr),
+            ),
+        )
+        user = getattr(_request_ctx_stack.top, "user", None)
+        if getattr(user, "id", None) is not None:
+            details["user"] = dict(id=str(user.id))
+        return details
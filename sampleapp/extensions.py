@@ -2,20 +2,41 @@
 Extensions module. Each extension is initialized in the app factory located
 in app.py.
 """
-from flask_bcrypt import Bcrypt
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_migrate import Migrate
 from flask_principal import Principal
-from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.csrf import CSRFProtect
 
+from .assets import Assets
+from .caching import Cache
+from .database import Database
+from .errors import ErrorReporter
+from .hashing import PasswordHasher
+from .logs import StructuredLogging
+from .memory import MemoryTracker
+from .metrics import Metrics
+from .profiling import Profiler
+from .queries import QueryInspector
+from .ratelimit import RateLimiter
+from .user_cache import UserCache
+
 csrf_protect = CSRFProtect()
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+hasher = PasswordHasher()
+db = Database()
 migrate = Migrate()
 debug_toolbar = DebugToolbarExtension()
 login_manager = LoginManager()
 principal = Principal()
 mail = Mail()
+limiter = RateLimiter()
+user_cache = UserCache()
+cache = Cache()
+assets = Assets()
+error_reporter = ErrorReporter()
+logs = StructuredLogging()
+metrics = Metrics()
+profiler = Profiler()
+memory = MemoryTracker()
+query_inspector = QueryInspector()
@@ -0,0 +1,274 @@
+"""Password hashing executor.
+
+bcrypt is slow on purpose, so running it on the request thread lets a burst of
+logins starve every other page served by the same worker. The
+:class:`PasswordHasher` extension runs hashing in a process pool with a bounded
+number of pending jobs; when the pool is saturated it fails fast with a 503
+instead of queueing the request behind everybody else.
+
+Each gunicorn worker has a pool of its own, while bcrypt competes for the
+cores of the whole host, so the running and waiting jobs of all workers are
+also counted together in a :class:`~sampleapp.shm.SharedTable`, see
+:class:`HostSlots`.
+"""
+import concurrent.futures.process
+import hmac
+import os
+import struct
+import threading
+import time
+
+import bcrypt
+from werkzeug.exceptions import ServiceUnavailable
+
+from .metrics import HASHING_LATENCY
+from .metrics import timed
+from .shm import default_shm_path
+from .shm import pid_alive
+from .shm import SharedTable
+
+
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check_password(pw_hash, password):
+    return hmac.compare_digest(bcrypt.hashpw(password, pw_hash), pw_hash)
+
+
+def _to_bytes(value):
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    return bytes(value)
+
+
+class HashingPoolSaturated(ServiceUnavailable):
+    """Raised when no hashing slot is available or a hashing job timed out."""
+
+    description = "We are receiving too many requests, please try again later."
+
+
+class HostSlots:
+    """Hashing jobs of all the workers of a host, bounded by capacity.
+
+    A single record of a :class:`~sampleapp.shm.SharedTable` holds the jobs
+    of each worker by pid, jobs of workers which exited without giving their
+    slots back are dropped by the next acquire.
+    """
+
+    entry = struct.Struct("<II")
+    max_workers = 256
+    key = "jobs"
+
+    def __init__(self, path, capacity):
+        self.capacity = capacity
+        self.table = SharedTable(
+            path, slots=1, payload_size=self.entry.size * self.max_workers
+        )
+
+    def acquire(self):
+        """Take a slot for the current process, return False when all of them
+        are taken."""
+        acquired = []
+
+        def update(payload):
+            jobs = {
+                pid: count
+                for pid, count in self._parse(payload).items()
+                if pid_alive(pid)
+            }
+            acquired.append(sum(jobs.values()) < self.capacity)
+            if acquired[0]:
+                jobs[os.getpid()] = jobs.get(os.getpid(), 0) + 1
+            return self._pack(jobs)
+
+        self.table.update(self.key, update)
+        return acquired[0]
+
+    def release(self):
+        def update(payload):
+            jobs = self._parse(payload)
+            jobs[os.getpid()] = jobs.get(os.getpid(), 0) - 1
+            return self._pack(jobs)
+
+        self.table.update(self.key, update)
+
+    def in_flight(self):
+        """Return the number of jobs of all workers."""
+        return sum(self._parse(self.table.get(self.key)).values())
+
+    def close(self):
+        self.table.close()
+
+    def _parse(self, payload):
+        if not payload:
+            return {}
+        return dict(self.entry.iter_unpack(payload))
+
+    def _pack(self, jobs):
+        return b"".join(
+            self.entry.pack(pid, count) for pid, count in jobs.items() if count > 0
+        )
+
+
+class PasswordHasher:
+    """Flask extension hashing and verifying passwords in a process pool.
+
+    Configuration:
+
+    - ``BCRYPT_LOG_ROUNDS``: bcrypt cost factor
+    - ``HASHING_POOL_SIZE``: number of hashing processes, 0 hashes inline in
+      the calling thread
+    - ``HASHING_QUEUE_SIZE``: jobs allowed to wait for a free process
+    - ``HASHING_HOST_SLOTS``: running and waiting jobs of all the workers of
+      the host, 0 only bounds each worker
+    - ``HASHING_SHM_PATH``: file counting the jobs of the host, defaults to a
+      file on ``/dev/shm``
+    - ``HASHING_TIMEOUT_SECONDS``: how long a caller waits for its result
+    """
+
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.pool_size = 0
+        self.queue_size = 0
+        self.timeout = None
+        self._executor = None
+        self._executor_pid = None
+        self._slots = threading.BoundedSemaphore(1)
+        self._host_slots = None
+        self._lock = threading.Lock()
+        self._reset_stats()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.shutdown()
+        self.rounds = app.config.get("BCRYPT_LOG_ROUNDS", 12)
+        self.pool_size = app.config.get("HASHING_POOL_SIZE", os.cpu_count() or 1)
+        self.queue_size = app.config.get("HASHING_QUEUE_SIZE", 0)
+        self.timeout = app.config.get("HASHING_TIMEOUT_SECONDS")
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        host_slots = app.config.get("HASHING_HOST_SLOTS", 0)
+        if host_slots:
+            self._host_slots = HostSlots(
+                app.config.get("HASHING_SHM_PATH")
+                or default_shm_path("sampleapp-hashing"),
+                host_slots,
+            )
+        self._reset_stats()
+
+    @property
+    def capacity(self):
+        """Maximum number of running plus waiting hashing jobs."""
+        return max(self.pool_size, 1) + self.queue_size
+
+    def generate_password_hash(self, password):
+        """Hash given password with bcrypt, returns the hash as bytes."""
+        with timed("bcrypt"):
+            return self._run(_hash_password, _to_bytes(password), self.rounds)
+
+    def check_password_hash(self, pw_hash, password):
+        """Check given password against the bcrypt hash."""
+        if not pw_hash:
+            return False
+        with timed("bcrypt"):
+            return self._run(_check_password, _to_bytes(pw_hash), _to_bytes(password))
+
+    def stats(self):
+        """Return a snapshot of queue depth and hashing latency counters."""
+        with self._lock:
+            return dict(self._stats)
+
+    def shutdown(self):
+        executor, self._executor = self._executor, None
+        if executor is not None and self._executor_pid == os.getpid():
+            # on Python 3.8, a pool shut down without waiting for a running
+            # job can leave its processes idle, and the interpreter hangs at
+            # exit joining them
+            executor.shutdown(wait=True)
+        # after the jobs of the pool gave their slots back
+        host_slots, self._host_slots = self._host_slots, None
+        if host_slots is not None:
+            host_slots.close()
+
+    def _reset_stats(self):
+        self._stats = dict(
+            in_flight=0,
+            max_in_flight=0,
+            completed=0,
+            rejected=0,
+            timeouts=0,
+            total_seconds=0.0,
+            max_seconds=0.0,
+        )
+
+    def _get_executor(self):
+        # Process pools do not survive fork, so each gunicorn worker gets its
+        # own pool, created lazily on the first hashing call
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.pool_size
+                )
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            self._reject()
+        host_slots = self._host_slots
+        if host_slots is not None and not host_slots.acquire():
+            self._slots.release()
+            self._reject()
+        with self._lock:
+            self._stats["in_flight"] += 1
+            self._stats["max_in_flight"] = max(
+                self._stats["max_in_flight"], self._stats["in_flight"]
+            )
+
+        started_at = time.monotonic()
+
+        def release(_=None):
+            from .extensions import metrics
+
+            elapsed = time.monotonic() - started_at
+            metrics.observe(HASHING_LATENCY, elapsed)
+            with self._lock:
+                self._stats["in_flight"] -= 1
+                self._stats["completed"] += 1
+                self._stats["total_seconds"] += elapsed
+                self._stats["max_seconds"] = max(self._stats["max_seconds"], elapsed)
+            if host_slots is not None:
+                host_slots.release()
+            self._slots.release()
+
+        if not self.pool_size:
+            try:
+                return func(*args)
+            finally:
+                release()
+
+        try:
+            future = self._get_executor().submit(func, *args)
+        except BaseException:
+            release()
+            raise
+        # The slot is only given back once the job is done, so abandoned jobs
+        # still count against the queue bound
+        future.add_done_callback(release)
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.process.BrokenProcessPool:
+            # A hashing process died, start a fresh pool on the next call
+            self.shutdown()
+            raise
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise HashingPoolSaturated()
+
+    def _reject(self):
+        with self._lock:
+            self._stats["rejected"] += 1
+        raise HashingPoolSaturated()
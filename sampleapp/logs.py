@@ -0,0 +1,259 @@
+"""Structured logging that never blocks requests.
+
+Records of all loggers are put on a bounded queue by the threads emitting
+them, and written to stdout by a listener thread of the worker, so a slow log
+sink only delays the listener. When the queue is full the oldest record is
+dropped, the listener logs how many records were dropped.
+
+Records emitted while handling a request carry its ``request_id``, taken from
+the ``X-Request-Id`` header of the request or generated, its ``endpoint`` and
+the ``user_id`` of the logged in user. Every request also emits one access
+record, on the ``sampleapp.access`` logger, with its status, size and the
+time it spent in the database, bcrypt, templates and mail, replacing the
+access log of gunicorn.
+"""
+import copy
+import datetime
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import time
+import uuid
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+
+from flask import _request_ctx_stack
+from flask import has_request_context
+from flask import request
+from flask.logging import default_handler
+
+from .metrics import RequestTimings
+
+access_logger = logging.getLogger("sampleapp.access")
+
+#: Request ids accepted from the ``X-Request-Id`` header
+REQUEST_ID = re.compile(r"^[\w.:-]{1,128}$")
+
+#: Attributes of all records, the others are extra fields
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object by line, with their extra fields."""
+
+    def format(self, record):
+        fields = dict(
+            time=datetime.datetime.utcfromtimestamp(record.created).isoformat() + "Z",
+            level=record.levelname,
+            logger=record.name,
+            message=record.getMessage(),
+        )
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES and not name.startswith("_"):
+                fields[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            fields["exception"] = record.exc_text
+        if record.stack_info:
+            fields["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(fields, default=str)
+
+
+class RequestFilter(logging.Filter):
+    """Add the request id, endpoint and user id of the current request to
+    records."""
+
+    def filter(self, record):
+        if has_request_context():
+            ctx = _request_ctx_stack.top
+            record.request_id = getattr(ctx, "request_id", None)
+            record.endpoint = request.endpoint
+            # only a user already loaded, logging must not run queries
+            record.user_id = getattr(getattr(ctx, "user", None), "id", None)
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue handler dropping the oldest record when the queue is full."""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # formatted by the listener, only what depends on the emitting
+        # thread, or keeps its frames alive, is resolved here
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                pass
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+
+
+class DropReportingListener(QueueListener):
+    """Queue listener logging the records dropped by its handler."""
+
+    def __init__(self, queue_handler, *handlers):
+        super().__init__(queue_handler.queue, *handlers, respect_handler_level=True)
+        self.queue_handler = queue_handler
+        self.reported = 0
+
+    def handle(self, record):
+        dropped = self.queue_handler.dropped
+        if dropped != self.reported:
+            super().handle(
+                logging.makeLogRecord(
+                    dict(
+                        name=__name__,
+                        levelno=logging.WARNING,
+                        levelname="WARNING",
+                        msg=f"{dropped - self.reported} log records dropped, "
+                        f"the log queue is full",
+                    )
+                )
+            )
+            self.reported = dropped
+        super().handle(record)
+
+    def enqueue_sentinel(self):
+        # waits for room, the listener is draining the queue
+        self.queue.put(self._sentinel)
+
+
+class StructuredLogging:
+    """Flask extension sending the records of all loggers through a queue,
+    and logging an access record by request.
+
+    Configuration:
+
+    - ``LOGGING_ENABLED``: leave logging alone when False
+    - ``LOG_LEVEL``: level of the root logger
+    - ``LOG_FORMAT``: ``json``, or ``text`` for humans
+    - ``LOG_QUEUE_SIZE``: records waiting for the listener, the oldest are
+      dropped beyond
+    - ``ACCESS_LOG_ENABLED``: log a record by request
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.handler = None
+        self.queue_handler = None
+        self.listener = None
+        self._listener_pid = None
+        self._root_level = None
+        os.register_at_fork(after_in_child=self._after_fork)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.stop()
+        self.enabled = app.config.get("LOGGING_ENABLED", True)
+        if not self.enabled:
+            return
+        if app.config.get("LOG_FORMAT", "json") == "json":
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter(
+                "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+            )
+        self.handler = logging.StreamHandler(sys.stdout)
+        self.handler.setFormatter(formatter)
+        self.queue_handler = DroppingQueueHandler(
+            queue.Queue(app.config.get("LOG_QUEUE_SIZE", 10000))
+        )
+        self.queue_handler.addFilter(RequestFilter())
+        root = logging.getLogger()
+        self._root_level = root.level
+        root.setLevel(app.config.get("LOG_LEVEL", "INFO"))
+        root.addHandler(self.queue_handler)
+        # records of the app logger propagate to the queue
+        app.logger.removeHandler(default_handler)
+        self._start_listener()
+        if app.config.get("ACCESS_LOG_ENABLED", True):
+            app.before_request(self._start_request)
+            app.after_request(self._log_request)
+
+    def stop(self):
+        """Write the queued records and stop the listener."""
+        if self.listener is None:
+            return
+        root = logging.getLogger()
+        root.removeHandler(self.queue_handler)
+        root.setLevel(self._root_level)
+        if self._listener_pid == os.getpid():
+            self.listener.stop()
+        self.handler.flush()
+        self.listener = None
+
+    def _start_listener(self):
+        self.listener = DropReportingListener(self.queue_handler, self.handler)
+        self.listener.start()
+        self._listener_pid = os.getpid()
+
+    def _after_fork(self):
+        # the listener thread is not forked, and the queue may be locked by
+        # a thread of the parent
+        if self.listener is not None:
+            self.queue_handler.queue = queue.Queue(self.queue_handler.queue.maxsize)
+            self.queue_handler.dropped = 0
+            self._start_listener()
+
+    def _start_request(self):
+        ctx = _request_ctx_stack.top
+        request_id = request.headers.get("X-Request-Id", "")
+        ctx.request_id = (
+            request_id if REQUEST_ID.match(request_id) else uuid.uuid4().hex
+        )
+        # the time spent by component is recorded even without metrics
+        if getattr(ctx, "metrics_timings", None) is None:
+            ctx.metrics_timings = RequestTimings()
+
+    def _log_request(self, response):
+        ctx = _request_ctx_stack.top
+        timings = getattr(ctx, "metrics_timings", None)
+        request_id = getattr(ctx, "request_id", None)
+        if timings is None or request_id is None:
+            return response
+        response.headers["X-Request-Id"] = request_id
+        duration_ms = (time.perf_counter() - timings.started_at) * 1000
+        fields = dict(
+            method=request.method,
+            path=request.full_path if request.query_string else request.path,
+            status=response.status_code,
+            bytes=response.content_length,
+            duration_ms=round(duration_ms, 2),
+            queries=timings.queries,
+            remote_addr=request.headers.get("X-Forwarded-For", request.remote_addr),
+            user_agent=request.user_agent.string,
+            referrer=request.referrer,
+        )
+        for component, seconds in timings.seconds.items():
+            fields[f"{component}_ms"] = round(seconds * 1000, 2)
+        access_logger.info(
+            "%s %s %s %.1fms",
+            fields["method"],
+            fields["path"],
+            fields["status"],
+            duration_ms,
+            extra=fields,
+        )
+        return response
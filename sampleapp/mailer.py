@@ -0,0 +1,179 @@
+"""Transactional mail outbox.
+
+Views never talk to the SMTP server. :func:`queue_mail` inserts the message
+into the ``mail_outbox`` table as part of the current transaction, and the
+``flask mail-worker`` process delivers it. Workers claim rows with
+``FOR UPDATE SKIP LOCKED``, so running more worker processes scales delivery
+without sending anything twice.
+
+Messages still failing after ``MAIL_OUTBOX_MAX_ATTEMPTS`` are marked failed
+and no longer claimed. The worker deletes sent and failed messages older than
+``MAIL_OUTBOX_RETENTION_DAYS``, so the outbox does not grow without bound.
+"""
+import contextlib
+import datetime
+import logging
+import time
+
+from flask import current_app
+
+from .extensions import db
+from .extensions import mail
+from .metrics import timed
+from .models.mail import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+#: Seconds between two purges of the outbox by the worker
+PURGE_INTERVAL = 60 * 60
+
+
+def queue_mail(message):
+    """Add a Flask-Mail message to the outbox, it is sent once the current
+    transaction commits.
+
+    :param message: Flask-Mail message
+    :return: The outbox row
+    """
+    with timed("mail"):
+        record = OutboxMessage.from_message(message)
+        db.session.add(record)
+    return record
+
+
+def retry_delay(attempts):
+    """Exponential backoff delay after given number of failed attempts."""
+    base = current_app.config["MAIL_OUTBOX_RETRY_BASE_SECONDS"]
+    limit = current_app.config["MAIL_OUTBOX_RETRY_MAX_SECONDS"]
+    return datetime.timedelta(seconds=min(base * 2 ** (attempts - 1), limit))
+
+
+def claim_pending(batch_size):
+    """Lock and return the next batch of due messages, skipping rows locked
+    by other workers."""
+    now = datetime.datetime.utcnow()
+    return (
+        OutboxMessage.query.filter(
+            OutboxMessage.sent_at.is_(None),
+            OutboxMessage.failed_at.is_(None),
+            OutboxMessage.next_attempt_at <= now,
+        )
+        .order_by(OutboxMessage.next_attempt_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+
+
+def purge_outbox(retention_days=None):
+    """Delete the messages sent or failed more than retention_days ago, and
+    commit.
+
+    :return: Number of deleted messages
+    """
+    if retention_days is None:
+        retention_days = current_app.config["MAIL_OUTBOX_RETENTION_DAYS"]
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+    deleted = OutboxMessage.query.filter(
+        db.or_(OutboxMessage.sent_at < cutoff, OutboxMessage.failed_at < cutoff)
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def send_pending(connection=None, batch_size=None):
+    """Send one batch of due messages and commit the result.
+
+    :param connection: Open Flask-Mail connection to reuse, a new one is opened
+        for this batch if not given
+    :param batch_size: Maximum number of messages to send
+    :return: Tuple of (sent, failed) message counts
+    """
+    if batch_size is None:
+        batch_size = current_app.config["MAIL_OUTBOX_BATCH_SIZE"]
+    records = claim_pending(batch_size)
+    if not records:
+        db.session.commit()
+        return 0, 0
+    if connection is None:
+        with mail.connect() as connection:
+            return _send_records(connection, records)
+    return _send_records(connection, records)
+
+
+def _send_records(connection, records):
+    max_attempts = current_app.config["MAIL_OUTBOX_MAX_ATTEMPTS"]
+    sent = failed = 0
+    for record in records:
+        now = datetime.datetime.utcnow()
+        record.attempts += 1
+        try:
+            connection.send(record.to_message())
+        except Exception as e:
+            record.last_error = repr(e)
+            if record.attempts >= max_attempts:
+                logger.error(
+                    "Giving up on outbox message %s to %s after %s attempts: %r",
+                    record.id,
+                    ", ".join(record.recipients),
+                    record.attempts,
+                    e,
+                )
+                record.failed_at = now
+            else:
+                logger.warning("Failed to send outbox message %s: %r", record.id, e)
+                record.next_attempt_at = now + retry_delay(record.attempts)
+            failed += 1
+        else:
+            record.sent_at = now
+            sent += 1
+    db.session.commit()
+    return sent, failed
+
+
+def run_worker(batch_size=None, poll_interval=None, once=False):
+    """Deliver outbox messages until interrupted.
+
+    The SMTP connection is opened when there is something to send, and kept
+    open while batches keep coming. It is closed when the outbox is drained
+    or a send fails. Old messages are purged every ``PURGE_INTERVAL`` seconds,
+    once the outbox is drained.
+
+    :param once: Return once the outbox is drained instead of polling
+    """
+    if poll_interval is None:
+        poll_interval = current_app.config["MAIL_WORKER_POLL_SECONDS"]
+    if batch_size is None:
+        batch_size = current_app.config["MAIL_OUTBOX_BATCH_SIZE"]
+    purge_at = time.monotonic()
+    while True:
+        drained = False
+        try:
+            with contextlib.ExitStack() as stack:
+                connection = None
+                while True:
+                    records = claim_pending(batch_size)
+                    if not records:
+                        db.session.commit()
+                        drained = True
+                        break
+                    if connection is None:
+                        connection = stack.enter_context(mail.connect())
+                    sent, failed = _send_records(connection, records)
+                    logger.info("Sent %s outbox messages, %s failed", sent, failed)
+                    if failed:
+                        break
+            if drained and time.monotonic() >= purge_at:
+                deleted = purge_outbox()
+                if deleted:
+                    logger.info("Purged %s old outbox messages", deleted)
+                purge_at = time.monotonic() + PURGE_INTERVAL
+        except Exception:
+            logger.exception("Mail worker failed, retrying in %ss", poll_interval)
+            db.session.rollback()
+            time.sleep(poll_interval)
+            continue
+        if drained:
+            if once:
+                return
+            time.sleep(poll_interval)
@@ -0,0 +1,243 @@
+"""Opt in memory diagnostics of live workers.
+
+With ``MEMORY_TRACKING_ENABLED``, each worker starts :mod:`tracemalloc` on its
+first request and a thread taking a snapshot of its allocations every
+``MEMORY_SNAPSHOT_SECONDS``. Snapshots are compared, by allocation site, to the
+first one and to the previous one. The sites that grew the most, the memory of
+the worker and the memory retained by the requests of each endpoint are
+written to a report of the worker in ``MEMORY_DIR``, read by the admin view
+and ``flask memory report``.
+
+Memory retained by a request is the growth of the memory traced by the
+worker while it ran, so requests running concurrently in other threads of
+the worker are counted too.
+
+tracemalloc slows allocations down and takes memory of its own, keep it for
+hunting leaks.
+"""
+import json
+import linecache
+import os
+import re
+import threading
+import time
+import tracemalloc
+
+from flask import _request_ctx_stack
+from flask import request
+
+from .shm import default_shm_path
+from .shm import pid_alive
+
+WORKER_FILE = re.compile(r"^worker-(\d+)\.json$")
+
+#: Allocations of the diagnostics themselves, left out of the reports
+IGNORED_FILES = (tracemalloc.__file__, __file__, linecache.__file__, "<frozen *>")
+
+
+def rss_bytes():
+    """Return the resident memory of the current process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        # peak resident memory, in kilobytes on Linux and bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def top_growers(snapshot, reference, limit):
+    """Return the allocation sites which grew the most from reference to
+    snapshot.
+
+    :return: List of dicts with the ``traceback`` of the site, most recent
+        frame last, the ``size`` and ``count`` of its allocations and their
+        growth, ``size_diff`` and ``count_diff``
+    """
+    growers = []
+    for stat in snapshot.compare_to(reference, "traceback")[:limit]:
+        if stat.size_diff <= 0:
+            break
+        growers.append(
+            dict(
+                traceback=[
+                    f"{frame.filename}:{frame.lineno}" for frame in stat.traceback
+                ],
+                size=stat.size,
+                count=stat.count,
+                size_diff=stat.size_diff,
+                count_diff=stat.count_diff,
+            )
+        )
+    return growers
+
+
+class MemoryTracker:
+    """Flask extension tracing the allocations of workers.
+
+    Configuration:
+
+    - ``MEMORY_TRACKING_ENABLED``: trace allocations when True
+    - ``MEMORY_DIR``: directory of the reports, shared by the workers of a
+      host, defaults to a directory on ``/dev/shm``
+    - ``MEMORY_SNAPSHOT_SECONDS``: time between two snapshots
+    - ``MEMORY_TRACEBACK_FRAMES``: frames kept by allocation site, more tell
+      apart callers of the same code but cost more memory
+    - ``MEMORY_TOP``: number of allocation sites in reports
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.directory = None
+        self.interval = 300
+        self.frames = 10
+        self.top = 20
+        self._lock = threading.Lock()
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.stop()
+        self.enabled = app.config.get("MEMORY_TRACKING_ENABLED", False)
+        self.directory = app.config.get("MEMORY_DIR") or default_shm_path(
+            "sampleapp-memory"
+        )
+        self.interval = app.config.get("MEMORY_SNAPSHOT_SECONDS", 300)
+        self.frames = app.config.get("MEMORY_TRACEBACK_FRAMES", 10)
+        self.top = app.config.get("MEMORY_TOP", 20)
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        app.before_request(self._start_request)
+        app.teardown_request(self._end_request)
+
+    @property
+    def tracking(self):
+        """Whether this worker traces its allocations."""
+        return self._pid == os.getpid() and tracemalloc.is_tracing()
+
+    def start(self):
+        """Start tracing the allocations of this worker and taking
+        snapshots."""
+        with self._lock:
+            if self.tracking:
+                return
+            self._reset()
+            self._pid = os.getpid()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+            self._started_at = time.time()
+            self._first = self._previous = self._take_snapshot()
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run, name="memory-snapshots", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        """Stop tracing the allocations of this worker."""
+        with self._lock:
+            if not self.tracking:
+                return
+            self._stopped.set()
+            thread = self._thread
+        if thread is not threading.current_thread():
+            thread.join()
+        tracemalloc.stop()
+        self._reset()
+
+    def snapshot(self):
+        """Take a snapshot and write the report of this worker.
+
+        :return: The report
+        """
+        # taking a snapshot is slow, requests ending meanwhile must not wait
+        # for the lock
+        snapshot = self._take_snapshot()
+        with self._lock:
+            first, previous, self._previous = self._first, self._previous, snapshot
+            self._snapshots += 1
+            snapshots = self._snapshots
+            endpoints = {name: dict(stats) for name, stats in self._endpoints.items()}
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        report = dict(
+            pid=os.getpid(),
+            started_at=self._started_at,
+            updated_at=time.time(),
+            snapshots=snapshots,
+            interval=self.interval,
+            rss_bytes=rss_bytes(),
+            traced_bytes=traced,
+            traced_peak_bytes=traced_peak,
+            tracemalloc_bytes=tracemalloc.get_tracemalloc_memory(),
+            growers_since_start=top_growers(snapshot, first, self.top),
+            growers_since_last=top_growers(snapshot, previous, self.top),
+            endpoints=endpoints,
+        )
+        path = os.path.join(self.directory, f"worker-{os.getpid()}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(report, f)
+        os.replace(f"{path}.tmp", path)
+        return report
+
+    def reports(self):
+        """Return the reports of the live workers, the reports of exited ones
+        are deleted."""
+        reports = []
+        if not self.directory or not os.path.isdir(self.directory):
+            return reports
+        for filename in os.listdir(self.directory):
+            match = WORKER_FILE.match(filename)
+            if match is None:
+                continue
+            path = os.path.join(self.directory, filename)
+            if not pid_alive(int(match.group(1))):
+                os.remove(path)
+                continue
+            with open(path) as f:
+                reports.append(json.load(f))
+        reports.sort(key=lambda report: report["pid"])
+        return reports
+
+    def _reset(self):
+        self._pid = None
+        self._thread = None
+        self._stopped = None
+        self._started_at = None
+        self._first = self._previous = None
+        self._snapshots = 0
+        #: Requests by endpoint, with the memory they retained
+        self._endpoints = {}
+
+    def _take_snapshot(self):
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces(
+            [tracemalloc.Filter(False, pattern) for pattern in IGNORED_FILES]
+        )
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.snapshot()
+
+    def _start_request(self):
+        if not self.tracking:
+            self.start()
+        _request_ctx_stack.top.memory_traced = tracemalloc.get_traced_memory()[0]
+
+    def _end_request(self, exc):
+        traced_before = getattr(_request_ctx_stack.top, "memory_traced", None)
+        if traced_before is None or not self.tracking:
+            return
+        retained = tracemalloc.get_traced_memory()[0] - traced_before
+        endpoint = request.endpoint or "unmatched"
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = dict(
+                    requests=0, retained_bytes=0, max_retained_bytes=0
+                )
+            stats["requests"] += 1
+            stats["retained_bytes"] += retained
+            stats["max_retained_bytes"] = max(stats["max_retained_bytes"], retained)
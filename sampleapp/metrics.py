@@ -0,0 +1,621 @@
+"""Prometheus metrics shared by the gunicorn workers of a host.
+
+Every request records, by endpoint, its latency and how much of it was spent
+in the database, in bcrypt, rendering templates and queueing mail, plus the
+number of SQL queries it ran. Components can overlap, a template lazy loading
+a relationship counts as both template and database time.
+
+Workers are separate processes, so each one writes its samples to its own
+memory mapped file in ``METRICS_DIR``, and ``/metrics`` sums the files of all
+of them into the Prometheus text format. Recording is a dict lookup and a
+memory write, nothing is shared between processes until a scrape.
+
+Workers also record the state of their database pools, password hashing and
+caches, at most every second while serving requests and on scrapes.
+
+Files of exited workers are merged into ``archive.db`` by the next scrape, so
+counters and histograms keep counting across worker restarts. Gauges, like
+the connections of the database pools, only cover live workers.
+"""
+import bisect
+import collections
+import contextlib
+import fcntl
+import hmac
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from flask import _request_ctx_stack
+from flask import abort
+from flask import before_render_template
+from flask import request
+from flask import Response
+from flask import template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .shm import default_shm_path
+from .shm import pid_alive
+
+#: Size of the header and of the values of :class:`ValueFile`
+_USED = struct.Struct("<Q")
+_VALUE = struct.Struct("<d")
+_KEY_LENGTH = struct.Struct("<I")
+
+WORKER_FILE = re.compile(r"^worker-(\d+)\.db$")
+ARCHIVE_FILE = "archive.db"
+LOCK_FILE = "collect.lock"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+#: Parts of a request timed separately
+COMPONENTS = ("db", "bcrypt", "template", "mail")
+
+#: Workers refresh their pool, hashing and cache metrics at most this often
+WORKER_STATS_INTERVAL_SECONDS = 1.0
+
+
+def _padded(offset):
+    return (offset + 7) // 8 * 8
+
+
+def _entries(data):
+    """Yield the keys of a :class:`ValueFile` with the offset of their
+    value."""
+    used = max(_USED.unpack_from(data, 0)[0], _USED.size)
+    offset = _USED.size
+    while offset < used:
+        (length,) = _KEY_LENGTH.unpack_from(data, offset)
+        start = offset + _KEY_LENGTH.size
+        key = bytes(data[start : start + length]).decode("utf-8")
+        offset = _padded(start + length)
+        yield key, offset
+        offset += _VALUE.size
+
+
+def read_values(path):
+    """Return the values of the :class:`ValueFile` at path, by key."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < _USED.size:
+        return {}
+    return {key: _VALUE.unpack_from(data, offset)[0] for key, offset in _entries(data)}
+
+
+class ValueFile:
+    """Float values by key, in a memory mapped file written by a single
+    process.
+
+    Entries are appended and never removed: the length of the key, the key,
+    padding up to 8 bytes and the value. The number of bytes used, in the
+    header, is written after the entry, so readers never see a partial entry.
+    """
+
+    initial_size = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = os.fstat(self._fd).st_size
+        if size < self.initial_size:
+            os.ftruncate(self._fd, self.initial_size)
+            size = self.initial_size
+        self._mmap = mmap.mmap(self._fd, size)
+        self._offsets = dict(_entries(self._mmap))
+        self._used = max(_USED.unpack_from(self._mmap, 0)[0], _USED.size)
+
+    def get(self, key):
+        offset = self._offsets.get(key)
+        if offset is None:
+            return 0.0
+        return _VALUE.unpack_from(self._mmap, offset)[0]
+
+    def add(self, key, amount):
+        with self._lock:
+            offset = self._offset(key)
+            value = _VALUE.unpack_from(self._mmap, offset)[0]
+            _VALUE.pack_into(self._mmap, offset, value + amount)
+
+    def set(self, key, value):
+        with self._lock:
+            _VALUE.pack_into(self._mmap, self._offset(key), value)
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+
+    def _offset(self, key):
+        offset = self._offsets.get(key)
+        if offset is not None:
+            return offset
+        encoded = key.encode("utf-8")
+        start = self._used
+        offset = _padded(start + _KEY_LENGTH.size + len(encoded))
+        end = offset + _VALUE.size
+        if end > len(self._mmap):
+            size = len(self._mmap)
+            while size < end:
+                size *= 2
+            os.ftruncate(self._fd, size)
+            self._mmap.close()
+            self._mmap = mmap.mmap(self._fd, size)
+        _KEY_LENGTH.pack_into(self._mmap, start, len(encoded))
+        self._mmap[
+            start + _KEY_LENGTH.size : start + _KEY_LENGTH.size + len(encoded)
+        ] = encoded
+        _VALUE.pack_into(self._mmap, offset, 0.0)
+        _USED.pack_into(self._mmap, 0, end)
+        self._used = end
+        self._offsets[key] = offset
+        return offset
+
+
+def _sample_key(name, suffix, labels):
+    return json.dumps([name, suffix, labels], sort_keys=True)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+class Metric:
+    """A metric family, recorded into the :class:`ValueFile` of the current
+    worker."""
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def key(self, suffix, labels):
+        return _sample_key(self.name, suffix, labels)
+
+    def expose(self, samples):
+        """Return the lines of the text format of this metric.
+
+        :param samples: ``(suffix, labels, value)`` of the recorded samples
+        """
+        samples = sorted(samples, key=lambda s: (sorted(s[1].items()), s[0]))
+        return self._lines(samples)
+
+    def _lines(self, samples):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in samples:
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(sorted(labels.items()))} "
+                f"{_format_value(value)}"
+            )
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, values, amount=1, **labels):
+        values.add(self.key("", labels), amount)
+
+    def set(self, values, value, **labels):
+        """Set the count of the current worker, for counts it keeps itself
+        from its start."""
+        values.set(self.key("", labels), value)
+
+
+class Gauge(Metric):
+    """Gauge combining the values of live workers by ``mode``, ``sum`` or
+    ``max``."""
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labels=(), mode="sum"):
+        super().__init__(name, documentation, labels)
+        self.mode = mode
+
+    def set(self, values, value, **labels):
+        values.set(self.key("", labels), value)
+
+
+class Histogram(Metric):
+    """Histogram, buckets are stored as counts of their own observations
+    only, and made cumulative when exposed."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=()):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, values, value, **labels):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            bucket_labels = dict(labels, le=_format_value(self.buckets[index]))
+            values.add(self.key("_bucket", bucket_labels), 1)
+        values.add(self.key("_sum", labels), value)
+        values.add(self.key("_count", labels), 1)
+
+    def expose(self, samples):
+        series = collections.defaultdict(dict)
+        buckets = collections.defaultdict(dict)
+        for suffix, labels, value in samples:
+            if suffix == "_bucket":
+                labels = dict(labels)
+                le = float(labels.pop("le"))
+                buckets[json.dumps(labels, sort_keys=True)][le] = value
+            else:
+                series[json.dumps(labels, sort_keys=True)][suffix] = value
+        exposed = []
+        for encoded, values in sorted(series.items()):
+            labels = json.loads(encoded)
+            total = 0
+            for le in self.buckets:
+                total += buckets[encoded].get(le, 0)
+                exposed.append(("_bucket", dict(labels, le=_format_value(le)), total))
+            exposed.append(("_bucket", dict(labels, le="+Inf"), values["_count"]))
+            exposed.append(("_sum", labels, values["_sum"]))
+            exposed.append(("_count", labels, values["_count"]))
+        return self._lines(exposed)
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+REQUESTS = Counter(
+    "http_requests_total", "Requests by endpoint and status.", ("endpoint", "status")
+)
+LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling requests, by endpoint.",
+    ("endpoint",),
+    LATENCY_BUCKETS,
+)
+COMPONENT_LATENCY = Histogram(
+    "http_request_component_seconds",
+    "Time requests spent in the database, bcrypt, templates and mail.",
+    ("endpoint", "component"),
+    LATENCY_BUCKETS,
+)
+QUERIES = Histogram(
+    "http_request_sql_queries",
+    "SQL statements executed by requests.",
+    ("endpoint",),
+    QUERY_BUCKETS,
+)
+POOL_STATS = {
+    stat: Gauge(
+        f"db_pool_{stat}",
+        f"{stat.replace('_', ' ').capitalize()} of the database pools.",
+        ("bind",),
+        mode="max" if stat.startswith("max_") else "sum",
+    )
+    for stat in ("size", "checked_in", "checked_out", "overflow", "max_wait_seconds")
+}
+# counted by the pools since the worker started, archived with the other
+# counters when it exits
+POOL_STATS.update(
+    {
+        stat: Counter(
+            f"db_pool_{stat}_total",
+            f"{stat.replace('_', ' ').capitalize()} of the database pools.",
+            ("bind",),
+        )
+        for stat in ("checkouts", "timeouts", "wait_seconds")
+    }
+)
+HASHING_JOBS = Gauge(
+    "password_hashing_jobs", "Password hashing jobs running or waiting for a process."
+)
+HASHING_OUTCOMES = Counter(
+    "password_hashing_jobs_total",
+    "Password hashing jobs completed, rejected or timed out.",
+    ("outcome",),
+)
+HASHING_LATENCY = Histogram(
+    "password_hashing_seconds",
+    "Time password hashing jobs took, waiting for a process included.",
+    (),
+    LATENCY_BUCKETS,
+)
+USER_CACHE_REQUESTS = Counter(
+    "user_cache_requests_total", "Lookups of the user cache, by result.", ("result",)
+)
+USER_CACHE_EVICTIONS = Counter(
+    "user_cache_evictions_total", "Users evicted from full user caches."
+)
+USER_CACHE_INVALIDATIONS = Counter(
+    "user_cache_invalidations_total", "Users dropped from the user caches by writes."
+)
+USER_CACHE_SIZE = Gauge("user_cache_size", "Users in the user caches.")
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Lookups of the application cache, by namespace and result.",
+    ("namespace", "result"),
+)
+METRICS = {
+    metric.name: metric
+    for metric in (REQUESTS, LATENCY, COMPONENT_LATENCY, QUERIES)
+    + tuple(POOL_STATS.values())
+    + (HASHING_JOBS, HASHING_OUTCOMES, HASHING_LATENCY)
+    + (USER_CACHE_REQUESTS, USER_CACHE_EVICTIONS, USER_CACHE_INVALIDATIONS)
+    + (USER_CACHE_SIZE, CACHE_REQUESTS)
+}
+
+
+class RequestTimings:
+    """Time spent by the current request, by component."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.seconds = dict.fromkeys(COMPONENTS, 0.0)
+        self.queries = 0
+        self.rendering = []
+
+
+def _request_timings():
+    ctx = _request_ctx_stack.top
+    return getattr(ctx, "metrics_timings", None)
+
+
+@contextlib.contextmanager
+def timed(component):
+    """Add the time spent in the block to component of the current request.
+
+    :param component: One of :data:`COMPONENTS`
+    """
+    timings = _request_timings()
+    if timings is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.seconds[component] += time.perf_counter() - started_at
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_started_at = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = _request_timings()
+    started_at = getattr(context, "metrics_started_at", None)
+    if timings is not None and started_at is not None:
+        timings.seconds["db"] += time.perf_counter() - started_at
+        timings.queries += 1
+
+
+@before_render_template.connect
+def _before_render_template(sender, template, context, **extra):
+    timings = _request_timings()
+    if timings is not None:
+        timings.rendering.append(time.perf_counter())
+
+
+@template_rendered.connect
+def _template_rendered(sender, template, context, **extra):
+    timings = _request_timings()
+    if timings is not None and timings.rendering:
+        started_at = timings.rendering.pop()
+        # templates rendered while rendering another are counted once
+        if not timings.rendering:
+            timings.seconds["template"] += time.perf_counter() - started_at
+
+
+class Metrics:
+    """Flask extension recording request metrics and serving ``/metrics``.
+
+    Configuration:
+
+    - ``METRICS_ENABLED``: record nothing and serve no ``/metrics`` when False
+    - ``METRICS_DIR``: directory of the files of the workers, shared by the
+      workers of a host, defaults to a directory on ``/dev/shm``
+    - ``METRICS_TOKEN``: bearer token required by ``/metrics``, which is not
+      served when it is empty
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.directory = None
+        self.token = None
+        self._values = None
+        self._values_pid = None
+        self._worker_stats_at = 0.0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.close()
+        self.enabled = app.config.get("METRICS_ENABLED", True)
+        self.directory = app.config.get("METRICS_DIR") or default_shm_path(
+            "sampleapp-metrics"
+        )
+        self.token = app.config.get("METRICS_TOKEN")
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        app.before_request(self._start_request)
+        app.after_request(self._record_request)
+        app.add_url_rule("/metrics", "metrics", self.metrics_view)
+
+    @property
+    def values(self):
+        """The :class:`ValueFile` of the current process."""
+        # workers forked from a process that already recorded something get
+        # a file of their own
+        with self._lock:
+            if self._values is None or self._values_pid != os.getpid():
+                self._values = ValueFile(
+                    os.path.join(self.directory, f"worker-{os.getpid()}.db")
+                )
+                self._values_pid = os.getpid()
+            return self._values
+
+    def close(self):
+        values, self._values = self._values, None
+        if values is not None and self._values_pid == os.getpid():
+            values.close()
+
+    def observe(self, histogram, value, **labels):
+        """Add value to histogram, for observations made outside of
+        requests."""
+        if self.enabled:
+            histogram.observe(self.values, value, **labels)
+
+    def record_worker_stats(self):
+        """Write the gauges and counters of the database pools, the password
+        hashing and the caches of this worker."""
+        from .extensions import cache
+        from .extensions import db
+        from .extensions import hasher
+        from .extensions import user_cache
+
+        self._worker_stats_at = time.monotonic()
+        values = self.values
+        for bind, stats in db.pool_stats().items():
+            for stat, value in stats.items():
+                POOL_STATS[stat].set(values, value, bind=bind or "default")
+        stats = hasher.stats()
+        HASHING_JOBS.set(values, stats["in_flight"])
+        for outcome, stat in (
+            ("completed", "completed"),
+            ("rejected", "rejected"),
+            ("timeout", "timeouts"),
+        ):
+            HASHING_OUTCOMES.set(values, stats[stat], outcome=outcome)
+        stats = user_cache.stats()
+        USER_CACHE_REQUESTS.set(values, stats["hits"], result="hit")
+        USER_CACHE_REQUESTS.set(values, stats["misses"], result="miss")
+        USER_CACHE_EVICTIONS.set(values, stats["evictions"])
+        USER_CACHE_INVALIDATIONS.set(values, stats["invalidations"])
+        USER_CACHE_SIZE.set(values, stats["size"])
+        for namespace, stats in cache.stats().items():
+            CACHE_REQUESTS.set(values, stats["hits"], namespace=namespace, result="hit")
+            CACHE_REQUESTS.set(
+                values, stats["misses"], namespace=namespace, result="miss"
+            )
+
+    def collect(self):
+        """Return the values of all workers, by metric, as lists of
+        ``(suffix, labels, value)``."""
+        totals = collections.defaultdict(float)
+        gauges = {}
+        with open(os.path.join(self.directory, LOCK_FILE), "a") as lock:
+            # scrapes merging the same exited worker would count it twice
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._archive_exited_workers()
+            for filename in os.listdir(self.directory):
+                match = WORKER_FILE.match(filename)
+                if match is None and filename != ARCHIVE_FILE:
+                    continue
+                path = os.path.join(self.directory, filename)
+                for key, value in read_values(path).items():
+                    name = json.loads(key)[0]
+                    metric = METRICS.get(name)
+                    if isinstance(metric, Gauge):
+                        if metric.mode == "max":
+                            gauges[key] = max(gauges.get(key, value), value)
+                        else:
+                            gauges[key] = gauges.get(key, 0.0) + value
+                    elif metric is not None:
+                        totals[key] += value
+        samples = collections.defaultdict(list)
+        for key, value in list(totals.items()) + list(gauges.items()):
+            name, suffix, labels = json.loads(key)
+            samples[name].append((suffix, labels, value))
+        return samples
+
+    def expose(self):
+        """Return all metrics in the Prometheus text format."""
+        if self.enabled:
+            self.record_worker_stats()
+        samples = self.collect()
+        lines = []
+        for name, metric in METRICS.items():
+            if samples.get(name):
+                lines.extend(metric.expose(samples[name]))
+        return "\n".join(lines) + "\n"
+
+    def metrics_view(self):
+        if not self.token:
+            abort(404)
+        authorization = request.headers.get("Authorization", "")
+        scheme, _, token = authorization.partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(
+            token.encode("utf-8"), self.token.encode("utf-8")
+        ):
+            return Response(
+                "Unauthorized\n",
+                401,
+                {"WWW-Authenticate": 'Bearer realm="metrics"'},
+                mimetype="text/plain",
+            )
+        return Response(self.expose(), content_type=CONTENT_TYPE)
+
+    def _archive_exited_workers(self):
+        archive = None
+        try:
+            for filename in os.listdir(self.directory):
+                match = WORKER_FILE.match(filename)
+                if match is None or pid_alive(int(match.group(1))):
+                    continue
+                path = os.path.join(self.directory, filename)
+                if archive is None:
+                    archive = ValueFile(os.path.join(self.directory, ARCHIVE_FILE))
+                for key, value in read_values(path).items():
+                    if not isinstance(METRICS.get(json.loads(key)[0]), Gauge):
+                        archive.add(key, value)
+                os.remove(path)
+        finally:
+            if archive is not None:
+                archive.close()
+
+    def _start_request(self):
+        _request_ctx_stack.top.metrics_timings = RequestTimings()
+
+    def _record_request(self, response):
+        timings = _request_timings()
+        if timings is None:
+            return response
+        endpoint = request.endpoint or "unmatched"
+        values = self.values
+        REQUESTS.inc(values, endpoint=endpoint, status=str(response.status_code))
+        LATENCY.observe(
+            values, time.perf_counter() - timings.started_at, endpoint=endpoint
+        )
+        for component, seconds in timings.seconds.items():
+            COMPONENT_LATENCY.observe(
+                values, seconds, endpoint=endpoint, component=component
+            )
+        QUERIES.observe(values, timings.queries, endpoint=endpoint)
+        if time.monotonic() - self._worker_stats_at >= WORKER_STATS_INTERVAL_SECONDS:
+            self.record_worker_stats()
+        return response
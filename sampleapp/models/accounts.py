@@ -1,33 +1,111 @@
+import collections
 import datetime
 
+from flask import current_app
 from flask_login import UserMixin
+from flask_principal import UserNeed
+from sqlalchemy import and_
+from sqlalchemy import any_
+from sqlalchemy import bindparam
+from sqlalchemy import case
 from sqlalchemy import Column
+from sqlalchemy import event
 from sqlalchemy import func
+from sqlalchemy import inspect
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import column_property
 
-from ..extensions import bcrypt
 from ..extensions import db
+from ..extensions import hasher
+from ..extensions import user_cache
+from ..permissions import admin_role_need
 from .base import Model
+from .base import uuid7
+from .sharding import new_id
+from .sharding import shard_count
+from .sharding import shard_for_email
+from .sharding import shard_for_id
+from .stats import apply_deltas
+
+#: Columns copied into :class:`UserSnapshot`, changing any of them (or the
+#: password) invalidates the cached snapshot
+SNAPSHOT_COLUMNS = ("id", "email", "is_active", "is_admin", "reset_password_at")
+
+
+#: Flags rolled up in UserDailyStats, with the counter of users having them
+ROLLED_UP_FLAGS = (("is_active", "active_users"), ("is_admin", "admin_users"))
+
+#: Terms shorter than this only match the start of emails, shorter substrings
+#: have no trigram to look up in the ``ix_users_email_trgm`` index
+MIN_SUBSTRING_SEARCH_LENGTH = 3
+
+
+def escape_like(value):
+    """Escape the wildcards of value for a ``LIKE`` pattern."""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def normalize_email(email):
+    """Normalize email for case insensitive lookups, matches the
+    ``lower(email)`` index on users."""
+    return email.strip().lower()
 
 
 class User(UserMixin, Model):
     __tablename__ = "users"
+    # Generated here, so inserts need no RETURNING to learn them, and time
+    # ordered, so they append to the primary key index
     id = Column(
-        UUID(as_uuid=True), primary_key=True, server_default=func.gen_random_uuid()
+        UUID(as_uuid=True),
+        primary_key=True,
+        default=uuid7,
+        server_default=func.uuid_generate_v7(),
     )
     email = Column(db.String(80), unique=True, nullable=False)
     #: The hashed password
     password = Column(db.LargeBinary(128), nullable=True)
     created_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
-    is_active = Column(db.Boolean(), default=True, server_default="f", nullable=False)
-    is_admin = Column(db.Boolean(), default=False, server_default="f", nullable=False)
+    # active_history loads the previous values of changed flags, rolled up in
+    # UserDailyStats
+    is_active = column_property(
+        Column(db.Boolean(), default=True, server_default="f", nullable=False),
+        active_history=True,
+    )
+    is_admin = column_property(
+        Column(db.Boolean(), default=False, server_default="f", nullable=False),
+        active_history=True,
+    )
     # last time we sent reset password email
     sent_reset_password_at = Column(db.DateTime, nullable=True)
     # last time we reset password via reset link
     reset_password_at = Column(db.DateTime, nullable=True)
 
+    __table_args__ = (
+        # Backs case insensitive email lookups, see find_by_email
+        db.Index("ix_users_email_lower", func.lower(email), unique=True),
+        # Backs substring searches of emails, see email_search
+        db.Index(
+            "ix_users_email_trgm",
+            email,
+            postgresql_using="gin",
+            postgresql_ops={"email": "gin_trgm_ops"},
+        ),
+        # Backs the keyset pagination of the admin user list
+        db.Index("ix_users_created_at_id", created_at, id),
+        # Spread across USER_SHARD_URLS, see sampleapp.models.sharding
+        {"info": {"sharded": True}},
+    )
+
     def __init__(self, email, password=None, **kwargs):
         """Create instance."""
+        count = shard_count()
+        if count and "id" not in kwargs:
+            kwargs["id"] = new_id(shard_for_email(normalize_email(email), count))
         db.Model.__init__(self, email=email, **kwargs)
         if password:
             self.set_password(password)
@@ -36,11 +114,372 @@ class User(UserMixin, Model):
 
     def set_password(self, password):
         """Set password."""
-        self.password = bcrypt.generate_password_hash(password)
+        self.password = hasher.generate_password_hash(password)
 
     def check_password(self, value):
         """Check password."""
-        return bcrypt.check_password_hash(self.password, value)
+        return hasher.check_password_hash(self.password, value)
+
+    @classmethod
+    def shard_for_id(cls, user_id):
+        """Return the shard of the user with given id.
+
+        :raise ValueError: When user_id is not the id of a sharded user
+        """
+        return shard_for_id(user_id, shard_count())
+
+    @classmethod
+    def shard_options(cls, email=None, user_id=None):
+        """Return the execution options running a query on the shard of the
+        user with given email or id, none when users are not sharded.
+
+        :raise ValueError: When user_id is not the id of a sharded user
+        """
+        count = shard_count()
+        if not count:
+            return {}
+        if email is not None:
+            return dict(shard=shard_for_email(normalize_email(email), count))
+        return dict(shard=shard_for_id(user_id, count))
+
+    @classmethod
+    def find_by_email(cls, email, for_update=False):
+        """Find user by email case insensitively.
+
+        :param email: Email address as entered by the user
+        :param for_update: Lock the found row with ``SELECT ... FOR UPDATE``
+        :return: The user or None
+        """
+        query = cls.query.filter(func.lower(cls.email) == normalize_email(email))
+        query = query.execution_options(**cls.shard_options(email=email))
+        if for_update:
+            query = query.with_for_update()
+        return query.first()
+
+    @classmethod
+    def get_by_id(cls, user_id, for_update=False):
+        """Find user by id, on its shard.
+
+        :param user_id: Id of the user, as a UUID or a string
+        :param for_update: Lock the found row with ``SELECT ... FOR UPDATE``
+        :return: The user or None
+        """
+        try:
+            options = cls.shard_options(user_id=user_id)
+        except ValueError:
+            return None
+        query = cls.query.filter_by(id=user_id).execution_options(**options)
+        if for_update:
+            query = query.with_for_update()
+        return query.first()
+
+    @classmethod
+    def email_search(cls, term):
+        """Search users by a part of their email, case insensitively.
+
+        Matches are looked up in the trigram index on email. Emails starting
+        with term rank first, then by position of term and by length. Ranking
+        sorts every match, cap them first when term can be frequent, like the
+        admin searches do.
+
+        :param term: Searched part of the email
+        :return: The criterion and the ranking to order matches by
+        """
+        term = normalize_email(term)
+        pattern = escape_like(term)
+        prefix = cls.email.ilike(f"{pattern}%", escape="\\")
+        if len(term) < MIN_SUBSTRING_SEARCH_LENGTH:
+            criterion = prefix
+        else:
+            criterion = cls.email.ilike(f"%{pattern}%", escape="\\")
+        ranking = (
+            case([(prefix, 0)], else_=1),
+            func.strpos(func.lower(cls.email), term),
+            func.length(cls.email),
+            cls.email,
+        )
+        return criterion, ranking
+
+    @classmethod
+    def email_search_key(cls, term):
+        """Return a function giving the rank of a user matching term, in the
+        order of the ranking of :meth:`email_search`, to merge the matches
+        of several shards."""
+        term = normalize_email(term)
+
+        def key(user):
+            email = user.email
+            lower = email.lower()
+            return (
+                0 if lower.startswith(term) else 1,
+                lower.find(term) + 1,
+                len(email),
+                email,
+            )
+
+        return key
+
+    @classmethod
+    def mark_reset_password_sent(cls, email, now, cooldown_seconds):
+        """Set ``sent_reset_password_at`` of the user with given email to now,
+        unless a reset password email was sent within the cooldown period.
+
+        The check and the update are a single conditional ``UPDATE``, so the
+        row is never read under a lock and concurrent calls cannot both pass.
+
+        :param email: Email address as entered by the user
+        :param now: Current time, in UTC
+        :param cooldown_seconds: Minimum time between two emails, 0 to disable
+        :return: Row with the ``id`` and ``email`` of the updated user, or None
+            if the user does not exist or is still in cooldown
+        """
+        sent_at = now.replace(tzinfo=None)
+        criteria = [func.lower(cls.email) == normalize_email(email)]
+        if cooldown_seconds > 0:
+            criteria.append(
+                or_(
+                    cls.sent_reset_password_at.is_(None),
+                    cls.sent_reset_password_at
+                    <= sent_at - datetime.timedelta(seconds=cooldown_seconds),
+                )
+            )
+        statement = (
+            update(cls.__table__)
+            .where(and_(*criteria))
+            .values(sent_reset_password_at=sent_at)
+            .returning(cls.id, cls.email)
+            .execution_options(**cls.shard_options(email=email))
+        )
+        return db.session.execute(statement).first()
+
+    @classmethod
+    def update_many(cls, ids, values):
+        """Update the users with given ids in a single
+        ``UPDATE ... WHERE id = ANY(:ids)`` per shard, without loading
+        them.
+
+        Their cached snapshots are invalidated once the session commits, and
+        changes of ``is_active`` and ``is_admin`` are rolled up in
+        :class:`UserDailyStats`. Users already having the value given to one
+        of these flags are left untouched.
+
+        :param ids: Ids of the users to update
+        :param values: New values, by column name
+        :return: Ids of the updated users
+        """
+        table = cls.__table__
+        statement = update(table).where(
+            cls.id == any_(bindparam("ids", type_=ARRAY(UUID(as_uuid=True))))
+        )
+        flags = [(name, counter) for name, counter in ROLLED_UP_FLAGS if name in values]
+        for name, _ in flags:
+            if isinstance(values[name], bool):
+                statement = statement.where(
+                    table.c[name].is_distinct_from(values[name])
+                )
+        statement = statement.values(**values).returning(
+            table.c.id, table.c.created_at, *[table.c[name] for name, _ in flags]
+        )
+        ids_by_shard = collections.defaultdict(list)
+        for user_id in ids:
+            shard = cls.shard_options(user_id=user_id).get("shard")
+            ids_by_shard[shard].append(user_id)
+        updated = []
+        deltas = collections.defaultdict(collections.Counter)
+        for shard, shard_ids in ids_by_shard.items():
+            options = {} if shard is None else dict(shard=shard)
+            rows = db.session.execute(
+                statement.execution_options(**options), dict(ids=shard_ids)
+            )
+            for user_id, created_at, *flag_values in rows:
+                updated.append(user_id)
+                # every returned flag was changed, to its returned value
+                for (_, counter), value in zip(flags, flag_values):
+                    deltas[created_at.date()][counter] += 1 if value else -1
+        apply_deltas(db.session.connection(), deltas)
+        db.session.info.setdefault("stale_user_ids", set()).update(updated)
+        return updated
+
+    @classmethod
+    def load_snapshot(cls, user_id):
+        """Load a read-only :class:`UserSnapshot` of the user, without the
+        password hash or any ORM state."""
+        try:
+            options = cls.shard_options(user_id=user_id)
+        except ValueError:
+            return None
+        columns = [getattr(cls, name) for name in SNAPSHOT_COLUMNS]
+        row = (
+            db.session.query(*columns)
+            .filter(cls.id == user_id)
+            .execution_options(**options)
+            .first()
+        )
+        if row is None:
+            return None
+        return UserSnapshot(*row)
+
+    @classmethod
+    def move_to_shards(cls, batch_size=1000):
+        """Move the users left in the default database to their shards, see
+        the cutover in :mod:`sampleapp.models.sharding`.
+
+        Moved users get a new id embedding their shard, which signs them out
+        and voids their remember cookies and reset password links. Each batch
+        is committed on the shards before being deleted from the default
+        database: after a failure, rerunning deletes the users already
+        copied instead of copying them again.
+
+        :param batch_size: Users moved per transaction
+        :return: The number of moved users, and the emails of the users left
+            in the default database because their email is taken on their
+            shard
+        """
+        count = shard_count()
+        table = cls.__table__
+        engines = [
+            db.get_engine(bind=bind)
+            for bind in current_app.extensions["database_shards"]
+        ]
+        delete = table.delete().where(
+            cls.id == any_(bindparam("ids", type_=ARRAY(UUID(as_uuid=True))))
+        )
+        moved = 0
+        conflicts = []
+        last_id = None
+        while True:
+            statement = table.select().order_by(cls.id).limit(batch_size)
+            if last_id is not None:
+                statement = statement.where(cls.id > last_id)
+            with db.get_engine().begin() as connection:
+                rows = connection.execute(statement.with_for_update()).mappings().all()
+                if not rows:
+                    return moved, conflicts
+                last_id = rows[-1]["id"]
+                rows_by_shard = collections.defaultdict(list)
+                for row in rows:
+                    shard = shard_for_email(normalize_email(row["email"]), count)
+                    rows_by_shard[shard].append(row)
+                copied = []
+                for shard, shard_rows in rows_by_shard.items():
+                    with engines[shard].begin() as shard_connection:
+                        copied += cls._copy_to_shard(
+                            shard_connection, shard, shard_rows, conflicts
+                        )
+                connection.execute(delete, dict(ids=copied))
+            moved += len(copied)
+
+    @classmethod
+    def _copy_to_shard(cls, connection, shard, rows, conflicts):
+        """Insert rows of users of the default database into their shard,
+        with new ids. Return the old ids of the users now on the shard, add
+        the emails taken by other users to conflicts."""
+        table = cls.__table__
+        statement = (
+            insert(table)
+            .values([dict(row, id=new_id(shard)) for row in rows])
+            .on_conflict_do_nothing()
+            .returning(cls.email)
+        )
+        inserted = set(connection.execute(statement).scalars())
+        skipped = [row for row in rows if row["email"] not in inserted]
+        # copied by a run which failed before deleting them
+        existing = {}
+        if skipped:
+            emails = [normalize_email(row["email"]) for row in skipped]
+            existing = dict(
+                connection.execute(
+                    select(func.lower(cls.email), cls.created_at).where(
+                        func.lower(cls.email).in_(emails)
+                    )
+                ).all()
+            )
+        copied = []
+        for row in rows:
+            if row["email"] in inserted or (
+                existing.get(normalize_email(row["email"])) == row["created_at"]
+            ):
+                copied.append(row["id"])
+            else:
+                conflicts.append(row["email"])
+        return copied
 
     def __repr__(self):
         return f"<User({self.email!r})>"
+
+
+class UserSnapshot(UserMixin):
+    """Lean copy of a :class:`User` used as Flask-Login's current user."""
+
+    __slots__ = SNAPSHOT_COLUMNS + ("needs",)
+
+    def __init__(self, id, email, is_active, is_admin, reset_password_at):
+        self.id = id
+        self.email = email
+        self.is_active = is_active
+        self.is_admin = is_admin
+        self.reset_password_at = reset_password_at
+        #: Flask-Principal needs provided by this user
+        needs = {UserNeed(id)}
+        if is_admin:
+            needs.add(admin_role_need)
+        self.needs = frozenset(needs)
+
+    def __repr__(self):
+        return f"<UserSnapshot({self.email!r})>"
+
+
+@event.listens_for(db.session, "before_flush")
+def _collect_stale_user_snapshots(session, flush_context, instances):
+    stale = session.info.setdefault("stale_user_ids", set())
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            stale.add(obj.id)
+    for obj in session.dirty:
+        if not isinstance(obj, User):
+            continue
+        attrs = inspect(obj).attrs
+        if any(
+            attrs[name].history.has_changes()
+            for name in SNAPSHOT_COLUMNS + ("password",)
+        ):
+            stale.add(obj.id)
+
+
+@event.listens_for(db.session, "after_flush")
+def _roll_up_user_changes(session, flush_context):
+    deltas = collections.defaultdict(collections.Counter)
+    for sign, objs in ((1, session.new), (-1, session.deleted)):
+        for obj in objs:
+            if not isinstance(obj, User):
+                continue
+            counters = deltas[obj.created_at.date()]
+            counters["signups"] += sign
+            for name, counter in ROLLED_UP_FLAGS:
+                if getattr(obj, name):
+                    counters[counter] += sign
+    for obj in session.dirty:
+        if not isinstance(obj, User):
+            continue
+        attrs = inspect(obj).attrs
+        for name, counter in ROLLED_UP_FLAGS:
+            history = attrs[name].history
+            if history.added and history.deleted:
+                change = int(history.added[0]) - int(history.deleted[0])
+                deltas[obj.created_at.date()][counter] += change
+        reset_at = attrs.reset_password_at.history.added
+        if reset_at and reset_at[0] and attrs.password.history.has_changes():
+            deltas[reset_at[0].date()]["password_resets"] += 1
+    apply_deltas(session.connection(), deltas)
+
+
+@event.listens_for(db.session, "after_commit")
+def _invalidate_user_snapshots(session):
+    stale = session.info.pop("stale_user_ids", None)
+    if stale:
+        user_cache.invalidate(*stale)
+
+
+@event.listens_for(db.session, "after_soft_rollback")
+def _discard_stale_user_snapshots(session, previous_transaction):
+    session.info.pop("stale_user_ids", None)
@@ -0,0 +1,68 @@
+import datetime
+
+from flask_mail import Message
+from sqlalchemy import Column
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from ..extensions import db
+from .base import Model
+
+
+class OutboxMessage(Model):
+    """Email waiting to be delivered by the mail worker.
+
+    Rows are inserted in the same transaction as the change that triggered the
+    email, so an email is sent if and only if that change is committed. Sent
+    and failed rows are kept for ``MAIL_OUTBOX_RETENTION_DAYS``.
+    """
+
+    __tablename__ = "mail_outbox"
+    id = Column(db.BigInteger, primary_key=True)
+    subject = Column(db.Text, nullable=False)
+    sender = Column(db.Text, nullable=False)
+    recipients = Column(ARRAY(db.Text), nullable=False)
+    body = Column(db.Text, nullable=True)
+    html = Column(db.Text, nullable=True)
+    created_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    # when the worker should (re)try to send this message
+    next_attempt_at = Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+    attempts = Column(db.Integer, nullable=False, default=0, server_default="0")
+    last_error = Column(db.Text, nullable=True)
+    sent_at = Column(db.DateTime, nullable=True)
+    # when the worker gave up after MAIL_OUTBOX_MAX_ATTEMPTS
+    failed_at = Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        # Only pending messages are ever claimed by the worker
+        db.Index(
+            "ix_mail_outbox_due",
+            next_attempt_at,
+            postgresql_where=db.and_(sent_at.is_(None), failed_at.is_(None)),
+        ),
+    )
+
+    @classmethod
+    def from_message(cls, message):
+        """Create outbox row from a Flask-Mail message."""
+        return cls(
+            subject=message.subject,
+            sender=message.sender,
+            recipients=list(message.recipients),
+            body=message.body,
+            html=message.html,
+        )
+
+    def to_message(self):
+        """Build the Flask-Mail message to send."""
+        return Message(
+            self.subject,
+            sender=self.sender,
+            recipients=list(self.recipients),
+            body=self.body,
+            html=self.html,
+        )
+
+    def __repr__(self):
+        return f"<OutboxMessage({self.id!r}, {self.subject!r})>"
@@ -0,0 +1,107 @@
+"""Users sharded across several databases by email.
+
+With ``USER_SHARD_URLS``, every user is stored in one of the listed
+databases, picked by hashing their normalized email. The number of the shard
+is also embedded in the last byte of their id, so that users are found from
+their email or their id alone, without a lookup table:
+
+- :meth:`User.find_by_email` and :meth:`User.mark_reset_password_sent` run
+  on the shard of the email, :meth:`User.get_by_id`,
+  :meth:`User.load_snapshot` and :meth:`User.update_many` on the shards of
+  the ids
+- flushes write every user to its own shard
+- other queries of users run on every shard, one after the other, with
+  their rows concatenated. Use :func:`shards` to run them on each shard, and
+  :func:`merge_sorted` to merge ordered results, like the admin lists do
+
+Other tables stay in the default database, so a transaction changing users
+also commits the default database, without two-phase commit: ``flask
+rollups rebuild`` corrects the rollups of users if the second commit fails.
+Shard databases have the whole schema nonetheless, migrated like the default
+one with ``DATABASE_URL`` set to each of them.
+
+Shards are the hash modulo the number of shards, adding one would move most
+users: pick the number of shards with room to grow, several of them can
+share a server until they need their own.
+
+Without ``USER_SHARD_URLS``, users live in the default database and
+queries run there as usual. Sharded, users left there are not found, and
+their ids do not embed a shard. To cut over:
+
+1. create the shard databases and migrate their schema
+2. run ``flask shards migrate`` with ``USER_SHARD_URLS`` set, copying users
+   to their shards with new ids and deleting them from the default database
+3. deploy ``USER_SHARD_URLS`` to the application, restarting its workers
+4. run ``flask shards migrate`` again, for users who signed up in between
+
+New ids sign users out, voiding their remember cookies and their reset
+password links. Users signing up between steps 3
+and 4 with the email of a user not moved yet are reported by the second run,
+which leaves the older user in the default database.
+"""
+import hashlib
+import heapq
+import itertools
+import uuid
+
+from flask import current_app
+
+from .base import uuid7
+
+#: Shard numbers are embedded in the last byte of user ids
+MAX_SHARDS = 256
+
+
+def shard_count():
+    """Return the number of shards of the current app, 0 when users are not
+    sharded."""
+    return len(current_app.extensions["database_shards"])
+
+
+def shards():
+    """Return the execution options running a query on each shard, a single
+    empty one when users are not sharded.
+
+    ::
+
+        for options in shards():
+            query.execution_options(**options).all()
+    """
+    count = shard_count()
+    if not count:
+        return [{}]
+    return [dict(shard=shard) for shard in range(count)]
+
+
+def shard_for_email(email, count):
+    """Return the shard of a normalized email among count shards."""
+    digest = hashlib.blake2b(email.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def shard_for_id(user_id, count):
+    """Return the shard embedded in a user id.
+
+    :raise ValueError: When user_id is not a valid id of one of count shards
+    """
+    shard = uuid.UUID(str(user_id)).int & (MAX_SHARDS - 1)
+    if shard >= count:
+        raise ValueError(f"{user_id} is not an id of one of the {count} shards")
+    return shard
+
+
+def new_id(shard):
+    """Return a :func:`uuid7` embedding shard in place of random bits."""
+    return uuid.UUID(int=(uuid7().int & ~(MAX_SHARDS - 1)) | shard)
+
+
+def merge_sorted(streams, key, reverse=False, limit=None):
+    """Merge the rows of several shards into one list.
+
+    :param streams: Rows of each shard, sorted by key
+    :param key: Function returning the sort key of a row
+    :param reverse: Whether the streams are sorted in descending order
+    :param limit: Maximum number of merged rows, None for all of them
+    """
+    merged = heapq.merge(*streams, key=key, reverse=reverse)
+    return list(itertools.islice(merged, limit))
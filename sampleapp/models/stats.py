@@ -0,0 +1,148 @@
+import collections
+import datetime
+
+from sqlalchemy import cast
+from sqlalchemy import Column
+from sqlalchemy import Date
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
+from ..extensions import db
+from .base import Model
+from .sharding import shards
+
+#: Columns of :class:`UserDailyStats` counting users by signup day
+USER_COUNTERS = ("signups", "active_users", "admin_users")
+COUNTERS = USER_COUNTERS + ("password_resets",)
+
+
+class UserDailyStats(Model):
+    """Rollup of users per day, read by the admin dashboard.
+
+    Users are counted on the day they signed up: ``signups`` counts the
+    existing users who signed up that day, ``active_users`` and
+    ``admin_users`` the active ones and the admins among them. Totals are
+    sums over days, read in O(days) instead of scanning users.
+    ``password_resets`` counts the passwords reset through a reset link that
+    day.
+
+    Rows are updated by the transactions changing users, see
+    :func:`apply_deltas`, and can be recomputed with ``flask rollups
+    rebuild``.
+    """
+
+    __tablename__ = "user_daily_stats"
+    day = Column(db.Date, primary_key=True)
+    signups = Column(db.Integer, nullable=False, default=0, server_default="0")
+    active_users = Column(db.Integer, nullable=False, default=0, server_default="0")
+    admin_users = Column(db.Integer, nullable=False, default=0, server_default="0")
+    password_resets = Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    @classmethod
+    def summary(cls, days=30, today=None):
+        """Return the user totals and the counters of the last days.
+
+        :param days: Number of days listed
+        :param today: Last listed day, defaults to the current UTC day
+        :return: Dict with ``users``, ``active_users``, ``inactive_users`` and
+            ``admin_users`` totals, and ``days``, a list of rows with
+            ``day``, ``signups`` and ``password_resets``, most recent first
+        """
+        today = today or datetime.datetime.utcnow().date()
+        users, active_users, admin_users = db.session.query(
+            *[func.coalesce(func.sum(getattr(cls, name)), 0) for name in USER_COUNTERS]
+        ).one()
+        first_day = today - datetime.timedelta(days=days - 1)
+        rows = {
+            row.day: row
+            for row in db.session.query(cls.day, cls.signups, cls.password_resets)
+            .filter(cls.day.between(first_day, today))
+            .all()
+        }
+        return dict(
+            users=users,
+            active_users=active_users,
+            inactive_users=users - active_users,
+            admin_users=admin_users,
+            days=[
+                dict(
+                    day=day,
+                    signups=rows[day].signups if day in rows else 0,
+                    password_resets=rows[day].password_resets if day in rows else 0,
+                )
+                for day in (today - datetime.timedelta(days=i) for i in range(days))
+            ],
+        )
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute the user counters from the users table.
+
+        Changes made without going through the models, like raw SQL, are
+        not rolled up, run this to correct them. Password resets cannot be
+        recomputed and are kept. Concurrent writes to the rollup wait until
+        the rebuild is committed.
+
+        Users are counted on each of their shards, in one row per day.
+        """
+        from .accounts import User
+
+        table = cls.__table__
+        db.session.execute(text(f"LOCK TABLE {table.name} IN SHARE ROW EXCLUSIVE MODE"))
+        db.session.execute(table.update().values({name: 0 for name in USER_COUNTERS}))
+        day = cast(User.created_at, Date)
+        counts = select(
+            day,
+            func.count(),
+            func.count().filter(User.is_active),
+            func.count().filter(User.is_admin),
+        ).group_by(day)
+        totals = collections.defaultdict(lambda: [0] * len(USER_COUNTERS))
+        for options in shards():
+            for row_day, *values in db.session.execute(
+                counts.execution_options(**options)
+            ):
+                day_totals = totals[row_day]
+                for index, value in enumerate(values):
+                    day_totals[index] += value
+        if totals:
+            rows = [
+                dict(zip(USER_COUNTERS, values), day=row_day)
+                for row_day, values in sorted(totals.items())
+            ]
+            statement = insert(table).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.day],
+                set_={name: statement.excluded[name] for name in USER_COUNTERS},
+            )
+            db.session.execute(statement)
+        db.session.execute(
+            table.delete().where(*[table.c[name] == 0 for name in COUNTERS])
+        )
+
+
+def apply_deltas(connection, deltas):
+    """Add deltas to the counters of :class:`UserDailyStats`.
+
+    :param connection: Connection of the transaction making the changes
+    :param deltas: Mapping of days to a mapping of counter names to the
+        value to add
+    """
+    rows = []
+    for day in sorted(deltas):
+        changes = {name: delta for name, delta in deltas[day].items() if delta}
+        if changes:
+            rows.append(dict({name: 0 for name in COUNTERS}, day=day, **changes))
+    if not rows:
+        return
+    table = UserDailyStats.__table__
+    # rows are locked in the order of days, so concurrent transactions
+    # cannot deadlock on them
+    statement = insert(table).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.day],
+        set_={name: table.c[name] + statement.excluded[name] for name in COUNTERS},
+    )
+    connection.execute(statement)
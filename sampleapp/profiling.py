@@ -0,0 +1,328 @@
+"""On demand sampling profiler of live workers.
+
+An admin starts a profile from the admin dashboard for a number of seconds,
+optionally for a fraction of the requests only. The profile is announced to
+every worker of the host through a small memory mapped control file, read at
+the start of each request. While it runs, a thread of each worker records the
+stack of the requests it sampled every ``PROFILER_INTERVAL_MS``, and writes
+them when the profile ends, as collapsed stacks (``frame;frame;frame count``)
+in a directory of the profile. The admin view merges the files of all workers
+into a flame graph.
+
+When no profile runs, requests only read the control file, no thread runs
+and nothing is sampled.
+"""
+import collections
+import datetime
+import json
+import mmap
+import os
+import random
+import re
+import shutil
+import struct
+import sys
+import threading
+import time
+
+from flask import _request_ctx_stack
+
+from .shm import default_shm_path
+
+#: Id, end time and sampled fraction of requests of the current profile
+_CONTROL = struct.Struct("<ddd")
+
+CONTROL_FILE = "control"
+METADATA_FILE = "profile.json"
+WORKER_FILE = re.compile(r"^worker-(\d+)\.txt$")
+PROFILE_ID = re.compile(r"^\d+$")
+
+#: Stacks deeper than this are cut, keeping their outermost frames
+MAX_DEPTH = 256
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', code.co_filename)}:{code.co_name}"
+
+
+def collapse(frame):
+    """Return the stack of frame, outermost frame first, separated by ``;``."""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names[-MAX_DEPTH:]))
+
+
+def read_collapsed(path):
+    """Return the sample counts of the collapsed stacks file at path, by
+    stack."""
+    counts = collections.Counter()
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if stack:
+                counts[stack] += int(count)
+    return counts
+
+
+def flame_graph(counts, min_fraction=0.001):
+    """Return the frames of a flame graph of counts, outermost first.
+
+    :param counts: Sample counts by collapsed stack
+    :param min_fraction: Frames with a smaller share of the samples are left
+        out
+    :return: List of dicts with the ``name``, ``depth``, ``samples``, and the
+        ``left`` offset and ``width`` of the frame, as fractions of the
+        samples
+    """
+    root = dict(samples=0, children={})
+    for stack, count in counts.items():
+        node = root
+        node["samples"] += count
+        for name in stack.split(";"):
+            node = node["children"].setdefault(name, dict(samples=0, children={}))
+            node["samples"] += count
+    total = root["samples"]
+    frames = []
+    pending = [(root, 0.0, -1)]
+    while pending:
+        node, left, depth = pending.pop()
+        for name, child in sorted(node["children"].items()):
+            width = child["samples"] / total
+            if width >= min_fraction:
+                frames.append(
+                    dict(
+                        name=name,
+                        depth=depth + 1,
+                        samples=child["samples"],
+                        left=left,
+                        width=width,
+                    )
+                )
+                pending.append((child, left, depth + 1))
+            left += width
+    frames.sort(key=lambda frame: (frame["depth"], frame["left"]))
+    return frames
+
+
+class Sampler(threading.Thread):
+    """Thread recording the stacks of the sampled requests of a worker until
+    the end of a profile."""
+
+    def __init__(self, profiler, profile_id, until):
+        super().__init__(name=f"profiler-{profile_id:.0f}", daemon=True)
+        self.profiler = profiler
+        self.profile_id = profile_id
+        self.until = until
+        self.pid = os.getpid()
+        #: Ids of the threads handling sampled requests
+        self.threads = set()
+        self.counts = collections.Counter()
+
+    def run(self):
+        interval = self.profiler.interval
+        while time.time() < self.until:
+            control = self.profiler.control()
+            if control is None or control[0] != self.profile_id:
+                # stopped or replaced by another profile
+                break
+            frames = sys._current_frames()
+            for thread_id in list(self.threads):
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self.counts[collapse(frame)] += 1
+            del frames
+            time.sleep(interval)
+        self.profiler.write_samples(self)
+
+
+class Profiler:
+    """Flask extension sampling the stacks of requests on demand.
+
+    Configuration:
+
+    - ``PROFILER_ENABLED``: no profile can be started when False
+    - ``PROFILER_DIR``: directory of the profiles, shared by the workers of a
+      host, defaults to a directory on ``/dev/shm``
+    - ``PROFILER_INTERVAL_MS``: time between two samples of a request
+    - ``PROFILER_MAX_SECONDS``: longest profile allowed
+    - ``PROFILER_KEEP``: number of profiles kept, older ones are deleted
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.directory = None
+        self.interval = 0.01
+        self.max_seconds = 300
+        self.keep = 20
+        self._control = None
+        self._sampler = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get("PROFILER_ENABLED", True)
+        self.directory = app.config.get("PROFILER_DIR") or default_shm_path(
+            "sampleapp-profiles"
+        )
+        self.interval = app.config.get("PROFILER_INTERVAL_MS", 10) / 1000.0
+        self.max_seconds = app.config.get("PROFILER_MAX_SECONDS", 300)
+        self.keep = app.config.get("PROFILER_KEEP", 20)
+        self._control = None
+        self._sampler = None
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(
+            os.path.join(self.directory, CONTROL_FILE), os.O_RDWR | os.O_CREAT, 0o600
+        )
+        try:
+            if os.fstat(fd).st_size < _CONTROL.size:
+                os.ftruncate(fd, _CONTROL.size)
+            self._control = mmap.mmap(fd, _CONTROL.size)
+        finally:
+            os.close(fd)
+        app.before_request(self._start_request)
+        app.teardown_request(self._end_request)
+
+    def control(self):
+        """Return id, end time and sampled fraction of the running profile,
+        or None."""
+        if self._control is None:
+            return None
+        profile_id, until, fraction = _CONTROL.unpack_from(self._control)
+        if until <= time.time():
+            return None
+        return profile_id, until, fraction
+
+    def start(self, seconds, fraction=1.0, started_by=None):
+        """Profile the requests of all workers for seconds.
+
+        :param seconds: Duration of the profile, up to ``PROFILER_MAX_SECONDS``
+        :param fraction: Share of the requests sampled, between 0 and 1
+        :param started_by: Who started the profile, shown with it
+        :return: Id of the profile
+        """
+        if not self.enabled:
+            raise RuntimeError("The profiler is disabled")
+        if not 0 < seconds <= self.max_seconds:
+            raise ValueError(f"Profiles last between 0 and {self.max_seconds}s")
+        if not 0 < fraction <= 1:
+            raise ValueError("The sampled fraction is between 0 and 1")
+        now = time.time()
+        profile_id = float(int(now * 1000))
+        while True:
+            directory = self._profile_dir(profile_id)
+            try:
+                os.makedirs(directory)
+                break
+            except FileExistsError:
+                profile_id += 1
+        with open(os.path.join(directory, METADATA_FILE), "w") as f:
+            json.dump(
+                dict(
+                    started_at=now,
+                    seconds=seconds,
+                    fraction=fraction,
+                    interval=self.interval,
+                    started_by=started_by,
+                ),
+                f,
+            )
+        _CONTROL.pack_into(self._control, 0, profile_id, now + seconds, fraction)
+        self._delete_old_profiles()
+        return f"{profile_id:.0f}"
+
+    def stop(self):
+        """End the running profile, workers write their samples right away."""
+        if self._control is not None:
+            _CONTROL.pack_into(self._control, 0, 0, 0, 0)
+
+    def profiles(self):
+        """Return the metadata of the kept profiles, most recent first."""
+        profiles = []
+        if not self.directory or not os.path.isdir(self.directory):
+            return profiles
+        for profile_id in os.listdir(self.directory):
+            metadata = self.profile(profile_id)
+            if metadata is not None:
+                profiles.append(metadata)
+        profiles.sort(key=lambda profile: profile["started_at"], reverse=True)
+        return profiles
+
+    def profile(self, profile_id):
+        """Return the metadata of a profile, None if there is no such
+        profile."""
+        if not PROFILE_ID.match(profile_id):
+            return None
+        directory = os.path.join(self.directory, profile_id)
+        try:
+            with open(os.path.join(directory, METADATA_FILE)) as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            return None
+        control = self.control()
+        metadata.update(
+            id=profile_id,
+            started=datetime.datetime.utcfromtimestamp(metadata["started_at"]),
+            running=control is not None and f"{control[0]:.0f}" == profile_id,
+            workers=sum(1 for name in os.listdir(directory) if WORKER_FILE.match(name)),
+        )
+        return metadata
+
+    def samples(self, profile_id):
+        """Return the sample counts of a profile by collapsed stack, summed
+        over all workers."""
+        counts = collections.Counter()
+        directory = os.path.join(self.directory, profile_id)
+        for name in os.listdir(directory):
+            if WORKER_FILE.match(name):
+                counts.update(read_collapsed(os.path.join(directory, name)))
+        return counts
+
+    def write_samples(self, sampler):
+        directory = self._profile_dir(sampler.profile_id)
+        if not os.path.isdir(directory):
+            return
+        path = os.path.join(directory, f"worker-{sampler.pid}.txt")
+        with open(f"{path}.tmp", "w") as f:
+            for stack, count in sampler.counts.items():
+                f.write(f"{stack} {count}\n")
+        os.replace(f"{path}.tmp", path)
+
+    def _profile_dir(self, profile_id):
+        return os.path.join(self.directory, f"{profile_id:.0f}")
+
+    def _delete_old_profiles(self):
+        for profile in self.profiles()[self.keep :]:
+            shutil.rmtree(os.path.join(self.directory, profile["id"]), True)
+
+    def _start_request(self):
+        control = self.control()
+        if control is None:
+            return
+        profile_id, until, fraction = control
+        if fraction < 1 and random.random() >= fraction:
+            return
+        with self._lock:
+            sampler = self._sampler
+            if (
+                sampler is None
+                or sampler.profile_id != profile_id
+                or sampler.pid != os.getpid()
+            ):
+                sampler = self._sampler = Sampler(self, profile_id, until)
+                sampler.start()
+            elif not sampler.is_alive():
+                # the samples of this worker are already written
+                return
+        sampler.threads.add(threading.get_ident())
+        _request_ctx_stack.top.profiler_sampler = sampler
+
+    def _end_request(self, exc):
+        sampler = getattr(_request_ctx_stack.top, "profiler_sampler", None)
+        if sampler is not None:
+            sampler.threads.discard(threading.get_ident())
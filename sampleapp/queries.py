@@ -0,0 +1,249 @@
+"""Observe the SQL statements of requests.
+
+:class:`QueryInspector` hooks into every engine and:
+
+- logs statements slower than ``SLOW_QUERY_MS``, with the plan of the
+  statement from ``EXPLAIN (ANALYZE, BUFFERS)`` when ``SLOW_QUERY_EXPLAIN``
+  is set, outside of production since it runs the statement a second time.
+  Statements locking rows, ``FOR UPDATE`` or ``FOR SHARE``, only get a plain
+  ``EXPLAIN``, running them again would lock more rows until the commit
+- logs statements executed ``N_PLUS_ONE_THRESHOLD`` times or more by one
+  request, the sign of a query in a loop. Statements are compared by their
+  text, whatever their parameters
+- checks the number of statements of each request against the budget of its
+  endpoint, declared with :func:`query_budget` or ``QUERY_BUDGETS``. Requests
+  over budget are logged, or fail with :class:`QueryBudgetExceeded` when
+  ``QUERY_BUDGETS_ENFORCED`` is set, like in the tests.
+
+Tests can also bound the statements run by a block with :func:`max_queries`.
+"""
+import collections
+import contextlib
+import logging
+import re
+import threading
+import time
+
+from flask import _request_ctx_stack
+from flask import current_app
+from flask import has_app_context
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_collectors = threading.local()
+
+#: Locking clauses of SELECT statements
+LOCKING_CLAUSE = re.compile(
+    r"\bFOR\s+(?:UPDATE|NO\s+KEY\s+UPDATE|SHARE|KEY\s+SHARE)\b", re.IGNORECASE
+)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when more statements than budgeted are executed."""
+
+
+def query_budget(max_queries):
+    """Decorator declaring the most SQL statements a view may execute.
+
+    Views of Flask-Admin and other extensions are given their budget by
+    endpoint with ``QUERY_BUDGETS``.
+    """
+
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+
+    return decorator
+
+
+class QueryCollector:
+    """Statements executed by the current thread while collecting."""
+
+    def __init__(self):
+        self.statements = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def repeated(self, threshold):
+        """Return the statements executed at least threshold times, with
+        their count."""
+        counts = collections.Counter(self.statements)
+        return [(sql, count) for sql, count in counts.items() if count >= threshold]
+
+
+def _start_collecting():
+    collector = QueryCollector()
+    active = getattr(_collectors, "active", None)
+    if active is None:
+        active = _collectors.active = []
+    active.append(collector)
+    return collector
+
+
+def _stop_collecting(collector):
+    _collectors.active.remove(collector)
+
+
+@contextlib.contextmanager
+def collect_queries():
+    """Collect the statements executed by the current thread in the block."""
+    collector = _start_collecting()
+    try:
+        yield collector
+    finally:
+        _stop_collecting(collector)
+
+
+@contextlib.contextmanager
+def max_queries(limit):
+    """Fail with :class:`QueryBudgetExceeded` when the block executes more
+    than limit statements."""
+    with collect_queries() as collector:
+        yield collector
+    if len(collector) > limit:
+        raise QueryBudgetExceeded(_budget_message(collector, limit, "the block"))
+
+
+def _budget_message(collector, limit, what):
+    statements = "\n".join(collector.statements)
+    return f"{len(collector)} queries executed by {what}, over {limit}:\n{statements}"
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started_at = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    for collector in getattr(_collectors, "active", ()):
+        collector.statements.append(statement)
+    started_at = getattr(context, "query_started_at", None)
+    if started_at is None or not has_app_context():
+        return
+    inspector = current_app.extensions.get("query_inspector")
+    if inspector is None:
+        return
+    elapsed_ms = (time.perf_counter() - started_at) * 1000
+    if inspector.slow_query_ms and elapsed_ms >= inspector.slow_query_ms:
+        inspector.log_slow_query(conn, statement, parameters, executemany, elapsed_ms)
+
+
+class QueryInspector:
+    """Flask extension logging slow statements, N+1 queries and requests
+    over their query budget.
+
+    Configuration:
+
+    - ``SLOW_QUERY_MS``: statements taking longer are logged, 0 logs none
+    - ``SLOW_QUERY_EXPLAIN``: log the plan of slow ``SELECT`` statements,
+      running them again with ``EXPLAIN (ANALYZE, BUFFERS)`` unless they lock
+      rows
+    - ``N_PLUS_ONE_THRESHOLD``: log statements executed this many times by a
+      request, 0 logs none
+    - ``QUERY_BUDGETS``: most statements executed by the requests of an
+      endpoint, by endpoint, for views not using :func:`query_budget`
+    - ``QUERY_BUDGETS_ENFORCED``: fail requests over their budget instead of
+      logging them
+    """
+
+    def __init__(self, app=None):
+        self.slow_query_ms = 0
+        self.explain = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.slow_query_ms = app.config.get("SLOW_QUERY_MS", 0)
+        self.explain = app.config.get("SLOW_QUERY_EXPLAIN", False)
+        app.extensions["query_inspector"] = self
+        app.before_request(self._start_request)
+        app.after_request(self._check_request)
+        app.teardown_request(self._end_request)
+
+    def budget(self, endpoint):
+        """Return the query budget of endpoint, None if it has none."""
+        view = current_app.view_functions.get(endpoint)
+        budget = getattr(view, "query_budget", None)
+        if budget is None:
+            budget = (current_app.config.get("QUERY_BUDGETS") or {}).get(endpoint)
+        return budget
+
+    def log_slow_query(self, conn, statement, parameters, executemany, elapsed_ms):
+        plan = None
+        if (
+            self.explain
+            and not executemany
+            and statement.lstrip()[:6].upper() == "SELECT"
+        ):
+            plan = self._explain(conn, statement, parameters)
+        logger.warning(
+            "Slow query, %.1fms: %s\nParameters: %r%s",
+            elapsed_ms,
+            statement,
+            parameters,
+            f"\n{plan}" if plan else "",
+        )
+
+    def _explain(self, conn, statement, parameters):
+        # on a cursor of its own, the results of the statement are not
+        # fetched yet, and in a savepoint, a failure does not abort the
+        # transaction of the request
+        dbapi_connection = conn.connection
+        in_transaction = not getattr(dbapi_connection, "autocommit", False)
+        cursor = dbapi_connection.cursor()
+        try:
+            if in_transaction:
+                cursor.execute("SAVEPOINT slow_query_explain")
+            explain = "EXPLAIN (ANALYZE, BUFFERS)"
+            if LOCKING_CLAUSE.search(statement):
+                explain = "EXPLAIN"
+            try:
+                cursor.execute(f"{explain} {statement}", parameters)
+                return "\n".join(row[0] for row in cursor.fetchall())
+            except Exception:
+                logger.exception("Could not explain slow query")
+                if in_transaction:
+                    cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                return None
+            finally:
+                if in_transaction:
+                    cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        finally:
+            cursor.close()
+
+    def _start_request(self):
+        _request_ctx_stack.top.query_collector = _start_collecting()
+
+    def _check_request(self, response):
+        collector = getattr(_request_ctx_stack.top, "query_collector", None)
+        if collector is None:
+            return response
+        config = current_app.config
+        endpoint = request.endpoint
+        threshold = config.get("N_PLUS_ONE_THRESHOLD", 0)
+        if threshold:
+            for statement, count in collector.repeated(threshold):
+                logger.warning(
+                    "Possible N+1 query, executed %d times by %s: %s",
+                    count,
+                    endpoint,
+                    statement,
+                )
+        budget = self.budget(endpoint) if endpoint else None
+        if budget is not None and len(collector) > budget:
+            message = _budget_message(collector, budget, endpoint)
+            if config.get("QUERY_BUDGETS_ENFORCED"):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+    def _end_request(self, exc):
+        collector = getattr(_request_ctx_stack.top, "query_collector", None)
+        if collector is not None:
+            _stop_collecting(collector)
@@ -0,0 +1,162 @@
+"""Token bucket rate limiting.
+
+Each (scope, key) pair, for example ``("login-ip", "203.0.113.7")``, owns a
+bucket holding up to ``burst`` tokens that refills at ``per_minute`` tokens a
+minute. Every hit takes one token, and a hit finding the bucket empty is
+rejected.
+
+Bucket state lives in a pluggable backend:
+
+- ``memory``: a dict in the current process, for tests and development
+- ``shm``: a :class:`~sampleapp.shm.SharedTable` shared by all workers on
+  the host
+- a dotted path (``package.module:Class``) to a custom
+  :class:`RateLimitBackend`, for example one backed by a central store
+"""
+import struct
+import threading
+import time
+
+from werkzeug.utils import import_string
+
+from .shm import default_shm_path
+from .shm import SharedTable
+
+
+class RateLimitBackend:
+    """Storage of token buckets.
+
+    Backends are created with the application config.
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    def take(self, key, rate, burst, now):
+        """Take a token from the bucket of key.
+
+        :param key: Bucket key
+        :param rate: Refill rate, in tokens per second
+        :param burst: Bucket capacity
+        :param now: Current UNIX timestamp
+        :return: True if a token was taken, False if the bucket is empty
+        """
+        raise NotImplementedError()
+
+    def clear(self):
+        """Reset all buckets."""
+        raise NotImplementedError()
+
+
+def refill(tokens, updated_at, rate, burst, now):
+    """Take a token from a bucket in given state.
+
+    :return: Tuple of (allowed, tokens left)
+    """
+    tokens = min(burst, tokens + max(now - updated_at, 0) * rate)
+    if tokens >= 1:
+        return True, tokens - 1
+    return False, tokens
+
+
+class MemoryBackend(RateLimitBackend):
+    """Buckets in a dict, only shared by the threads of one process."""
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            allowed, tokens = refill(tokens, updated_at, rate, burst, now)
+            self._buckets[key] = (tokens, now)
+            return allowed
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SharedMemoryBackend(RateLimitBackend):
+    """Buckets in a memory mapped table shared by all workers on the host.
+
+    Configured by ``RATELIMIT_SHM_PATH`` (defaults to a file on
+    ``/dev/shm``) and ``RATELIMIT_SHM_SLOTS``. A key hashing to the slot of
+    another key evicts it, so collisions can only reset a bucket to full,
+    never make the limiter stricter.
+    """
+
+    bucket = struct.Struct("<dd")
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.table = SharedTable(
+            config.get("RATELIMIT_SHM_PATH") or default_shm_path("sampleapp-ratelimit"),
+            slots=config["RATELIMIT_SHM_SLOTS"],
+            payload_size=self.bucket.size,
+        )
+
+    def take(self, key, rate, burst, now):
+        result = []
+
+        def update(payload):
+            if payload is None:
+                tokens, updated_at = burst, now
+            else:
+                tokens, updated_at = self.bucket.unpack(payload)
+            allowed, tokens = refill(tokens, updated_at, rate, burst, now)
+            result.append(allowed)
+            return self.bucket.pack(tokens, now)
+
+        self.table.update(key, update)
+        return result[0]
+
+    def clear(self):
+        self.table.clear()
+
+
+BACKENDS = dict(memory=MemoryBackend, shm=SharedMemoryBackend)
+
+
+class RateLimiter:
+    """Flask extension checking hits against token buckets.
+
+    Configuration:
+
+    - ``RATELIMIT_ENABLED``: turn all limits off when False
+    - ``RATELIMIT_BACKEND``: ``memory``, ``shm`` or a dotted path to a
+      :class:`RateLimitBackend` subclass
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get("RATELIMIT_ENABLED", True)
+        backend = app.config.get("RATELIMIT_BACKEND", "memory")
+        backend_cls = BACKENDS.get(backend) or import_string(backend)
+        self.backend = backend_cls(app.config)
+
+    def hit(self, scope, key, per_minute, burst):
+        """Record a hit for key in scope.
+
+        :param scope: Name of the limit, buckets of different scopes are
+            independent
+        :param key: What is limited, for example an IP address
+        :param per_minute: Sustained number of hits allowed per minute
+        :param burst: Number of hits allowed at once
+        :return: True if the hit is allowed, False if it is over the limit
+        """
+        if not self.enabled:
+            return True
+        return self.backend.take(
+            f"{scope}:{key}", per_minute / 60.0, burst, time.time()
+        )
+
+    def reset(self):
+        self.backend.clear()
@@ -3,6 +3,7 @@ import os
 from .utils import asbool
 
 DEFAULT_SECRET_KEY = "DEFAULT_SECRET_KEY"
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 
 
 class Config(object):
@@ -10,14 +11,103 @@ class Config(object):
 
     SECRET_KEY = os.environ.get("SECRET_KEY", DEFAULT_SECRET_KEY)
     BCRYPT_LOG_ROUNDS = 13
+    # Number of processes hashing passwords for each worker, 0 hashes in the
+    # request thread. The cores are shared by the WEB_CONCURRENCY workers
+    # gunicorn starts
+    HASHING_POOL_SIZE = int(
+        os.environ.get(
+            "HASHING_POOL_SIZE",
+            max((os.cpu_count() or 1) // int(os.environ.get("WEB_CONCURRENCY", 1)), 1),
+        )
+    )
+    # How many hashing jobs can wait for a free process before we return 503
+    HASHING_QUEUE_SIZE = int(os.environ.get("HASHING_QUEUE_SIZE", 8))
+    # Running and waiting hashing jobs of all the workers of a host, past
+    # which we return 503 too, 0 only bounds each worker
+    HASHING_HOST_SLOTS = int(
+        os.environ.get("HASHING_HOST_SLOTS", (os.cpu_count() or 1) + HASHING_QUEUE_SIZE)
+    )
+    HASHING_SHM_PATH = os.environ.get("HASHING_SHM_PATH")
+    # How long a request waits for its hashing job before giving up with 503
+    HASHING_TIMEOUT_SECONDS = float(os.environ.get("HASHING_TIMEOUT_SECONDS", 5))
     DEBUG_TB_ENABLED = False  # Disable Debug toolbar
     DEBUG_TB_INTERCEPT_REDIRECTS = False
-    CACHE_TYPE = "simple"  # Can be "memcached", "redis", etc.
+    # Application cache, "simple" (LRU per worker), "shm" (shared by the
+    # workers of a host), "filesystem", "memcached" or "null"
+    CACHE_TYPE = os.environ.get("CACHE_TYPE", "simple")
+    CACHE_DEFAULT_TIMEOUT = int(os.environ.get("CACHE_DEFAULT_TIMEOUT", 300))
+    CACHE_KEY_PREFIX = os.environ.get("CACHE_KEY_PREFIX", "sampleapp:")
+    # Maximum number of entries of the "simple" and "filesystem" backends
+    CACHE_THRESHOLD = int(os.environ.get("CACHE_THRESHOLD", 1000))
+    CACHE_DIR = os.environ.get("CACHE_DIR")
+    CACHE_SHM_PATH = os.environ.get("CACHE_SHM_PATH")
+    # The "shm" table takes slots * (value size + 24) bytes of /dev/shm, 16 MiB
+    # by default, Docker gives containers 64 MiB unless run with --shm-size
+    CACHE_SHM_SLOTS = int(os.environ.get("CACHE_SHM_SLOTS", 1024))
+    # Larger values are not cached by the "shm" backend
+    CACHE_SHM_VALUE_SIZE = int(os.environ.get("CACHE_SHM_VALUE_SIZE", 16384))
+    CACHE_MEMCACHED_SERVERS = os.environ.get(
+        "MEMCACHED_SERVERS", "127.0.0.1:11211"
+    ).split(",")
+    # How long workers wait for another one computing a missing value
+    CACHE_LOCK_TIMEOUT_SECONDS = int(os.environ.get("CACHE_LOCK_TIMEOUT_SECONDS", 10))
+    # Cache of public pages rendered to anonymous visitors
+    PAGE_CACHE_ENABLED = asbool(os.environ.get("PAGE_CACHE_ENABLED", "true"))
+    PAGE_CACHE_TIMEOUT = int(os.environ.get("PAGE_CACHE_TIMEOUT", 600))
+    # 0 makes browsers revalidate pages with If-None-Match on every visit
+    PAGE_CACHE_MAX_AGE = int(os.environ.get("PAGE_CACHE_MAX_AGE", 0))
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_DATABASE_URI = os.getenv(
         "DATABASE_URL", "postgresql://localhost/sampleapp"
     )
+    # Connections of each process, see sampleapp.database for sizing
+    DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 5))
+    DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", 5))
+    DATABASE_POOL_TIMEOUT = float(os.environ.get("DATABASE_POOL_TIMEOUT", 10))
+    DATABASE_POOL_RECYCLE = int(os.environ.get("DATABASE_POOL_RECYCLE", 30 * 60))
+    DATABASE_POOL_PRE_PING = asbool(os.environ.get("DATABASE_POOL_PRE_PING", "true"))
+    # 0 lets statements run for as long as they need
+    DATABASE_STATEMENT_TIMEOUT_MS = int(
+        os.environ.get("DATABASE_STATEMENT_TIMEOUT_MS", 30 * 1000)
+    )
+    # Connect through PgBouncer in transaction pooling mode
+    DATABASE_PGBOUNCER = asbool(os.environ.get("DATABASE_PGBOUNCER", "false"))
+    # Read replicas, comma separated, reads go to the primary when empty
+    DATABASE_REPLICA_URLS = os.environ.get("DATABASE_REPLICA_URLS", "").split(",")
+    # Reads of a browser go to the primary this long after it wrote something
+    DATABASE_REPLICA_STICKY_SECONDS = float(
+        os.environ.get("DATABASE_REPLICA_STICKY_SECONDS", 5)
+    )
+    DATABASE_REPLICA_MAX_LAG_SECONDS = float(
+        os.environ.get("DATABASE_REPLICA_MAX_LAG_SECONDS", 10)
+    )
+    DATABASE_REPLICA_CHECK_SECONDS = float(
+        os.environ.get("DATABASE_REPLICA_CHECK_SECONDS", 5)
+    )
+    # Seconds to wait for a replica to accept a connection
+    DATABASE_REPLICA_CONNECT_TIMEOUT = int(
+        os.environ.get("DATABASE_REPLICA_CONNECT_TIMEOUT", 2)
+    )
+    # Databases users are sharded across by email, comma separated, users
+    # live in the default database when empty. Fixed once users are stored
+    USER_SHARD_URLS = os.environ.get("USER_SHARD_URLS", "").split(",")
     SITE_NAME = "Sampleapp"
+    # Template bytecode written by `flask templates compile`, loaded at startup
+    # when the directory exists
+    TEMPLATE_CACHE_DIR = os.environ.get(
+        "TEMPLATE_CACHE_DIR", os.path.join(PROJECT_ROOT, ".template-cache")
+    )
+    # Fingerprinted and compressed static files written by `flask assets
+    # build`, served instead of the static folder when the directory exists
+    ASSETS_DIST_DIR = os.environ.get(
+        "ASSETS_DIST_DIR", os.path.join(PROJECT_ROOT, "dist", "static")
+    )
+    ASSETS_MAX_AGE = int(os.environ.get("ASSETS_MAX_AGE", 365 * 24 * 60 * 60))
+
+    # Per-worker cache of logged in users, invalidation only reaches the
+    # worker making the change, others pick it up when the entry expires
+    USER_CACHE_TTL_SECONDS = int(os.environ.get("USER_CACHE_TTL_SECONDS", 30))
+    USER_CACHE_MAX_SIZE = int(os.environ.get("USER_CACHE_MAX_SIZE", 10000))
 
     ADMIN_DASHBOARD_PREFIX = os.environ.get("ADMIN_DASHBOARD_PREFIX", "/__admin")
     FLASK_ADMIN_SWATCH = "cosmo"
@@ -31,6 +121,105 @@ class Config(object):
     MAIL_USE_TLS = asbool(os.environ.get("MAIL_USE_TLS", "true"))
     MAIL_DEBUG = asbool(os.environ.get("MAIL_DEBUG", "false"))
 
+    # Mail outbox, delivered by `flask mail-worker`
+    MAIL_OUTBOX_BATCH_SIZE = int(os.environ.get("MAIL_OUTBOX_BATCH_SIZE", 50))
+    MAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get("MAIL_OUTBOX_MAX_ATTEMPTS", 8))
+    # Retry delay doubles after each failed attempt, up to the max
+    MAIL_OUTBOX_RETRY_BASE_SECONDS = int(
+        os.environ.get("MAIL_OUTBOX_RETRY_BASE_SECONDS", 30)
+    )
+    MAIL_OUTBOX_RETRY_MAX_SECONDS = int(
+        os.environ.get("MAIL_OUTBOX_RETRY_MAX_SECONDS", 60 * 60)
+    )
+    MAIL_WORKER_POLL_SECONDS = float(os.environ.get("MAIL_WORKER_POLL_SECONDS", 2))
+    # Sent and failed messages are deleted from the outbox after this many days
+    MAIL_OUTBOX_RETENTION_DAYS = int(os.environ.get("MAIL_OUTBOX_RETENTION_DAYS", 7))
+
+    # Number of proxies in front of the app appending the client address to
+    # X-Forwarded-For, 1 for the Heroku router
+    TRUSTED_PROXY_COUNT = int(os.environ.get("TRUSTED_PROXY_COUNT", 1))
+
+    # Rate limits, "shm" shares them between the workers of a host
+    RATELIMIT_ENABLED = asbool(os.environ.get("RATELIMIT_ENABLED", "true"))
+    RATELIMIT_BACKEND = os.environ.get("RATELIMIT_BACKEND", "shm")
+    RATELIMIT_SHM_PATH = os.environ.get("RATELIMIT_SHM_PATH")
+    RATELIMIT_SHM_SLOTS = int(os.environ.get("RATELIMIT_SHM_SLOTS", 65536))
+    # Login attempts allowed per client IP and per email address
+    LOGIN_RATELIMIT_IP_PER_MINUTE = int(
+        os.environ.get("LOGIN_RATELIMIT_IP_PER_MINUTE", 30)
+    )
+    LOGIN_RATELIMIT_IP_BURST = int(os.environ.get("LOGIN_RATELIMIT_IP_BURST", 10))
+    LOGIN_RATELIMIT_EMAIL_PER_MINUTE = int(
+        os.environ.get("LOGIN_RATELIMIT_EMAIL_PER_MINUTE", 5)
+    )
+    LOGIN_RATELIMIT_EMAIL_BURST = int(os.environ.get("LOGIN_RATELIMIT_EMAIL_BURST", 5))
+
+    # Records of all loggers go through a bounded queue written to stdout by
+    # a thread of each worker, the oldest are dropped when it is full
+    LOGGING_ENABLED = asbool(os.environ.get("LOGGING_ENABLED", "true"))
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+    # json, or text for humans
+    LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+    LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+    # Log a record by request, with its timing breakdown, instead of the
+    # access log of gunicorn
+    ACCESS_LOG_ENABLED = asbool(os.environ.get("ACCESS_LOG_ENABLED", "true"))
+
+    # Unhandled exceptions are reported to Bugsnag, sampled by fingerprint
+    ERROR_REPORTER_API_KEY = os.environ.get("BUGSNAG_API_KEY")
+    ERROR_REPORTER_URL = os.environ.get(
+        "ERROR_REPORTER_URL", "https://notify.bugsnag.com"
+    )
+    # Reports of an error by minute, after a burst, other occurrences are
+    # counted and sent every ERROR_REPORTER_FLUSH_SECONDS
+    ERROR_REPORTER_SAMPLES_PER_MINUTE = float(
+        os.environ.get("ERROR_REPORTER_SAMPLES_PER_MINUTE", 1)
+    )
+    ERROR_REPORTER_BURST = int(os.environ.get("ERROR_REPORTER_BURST", 3))
+    ERROR_REPORTER_FLUSH_SECONDS = int(
+        os.environ.get("ERROR_REPORTER_FLUSH_SECONDS", 60)
+    )
+    # Reports waiting to be sent by each worker, more are dropped
+    ERROR_REPORTER_QUEUE_SIZE = int(os.environ.get("ERROR_REPORTER_QUEUE_SIZE", 100))
+    ERROR_REPORTER_MAX_FINGERPRINTS = int(
+        os.environ.get("ERROR_REPORTER_MAX_FINGERPRINTS", 1000)
+    )
+    ERROR_REPORTER_TIMEOUT = int(os.environ.get("ERROR_REPORTER_TIMEOUT", 5))
+
+    # Request metrics of all workers of a host, served on /metrics to
+    # requests carrying METRICS_TOKEN as a bearer token
+    METRICS_ENABLED = asbool(os.environ.get("METRICS_ENABLED", "true"))
+    METRICS_DIR = os.environ.get("METRICS_DIR")
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+    # Statements slower than this are logged, 0 logs none
+    SLOW_QUERY_MS = int(os.environ.get("SLOW_QUERY_MS", 500))
+    # Log the plan of slow queries, running them again, keep it out of prod
+    SLOW_QUERY_EXPLAIN = asbool(os.environ.get("SLOW_QUERY_EXPLAIN", "false"))
+    # Log statements executed this many times by one request
+    N_PLUS_ONE_THRESHOLD = int(os.environ.get("N_PLUS_ONE_THRESHOLD", 5))
+    # Most statements of the requests of endpoints, besides the budgets of
+    # views decorated with sampleapp.queries.query_budget
+    QUERY_BUDGETS = {}
+    # Fail requests over their budget instead of logging them
+    QUERY_BUDGETS_ENFORCED = False
+
+    # Sampling profiler started from the admin dashboard, profiles are
+    # shared by the workers of a host through PROFILER_DIR
+    PROFILER_ENABLED = asbool(os.environ.get("PROFILER_ENABLED", "true"))
+    PROFILER_DIR = os.environ.get("PROFILER_DIR")
+    PROFILER_INTERVAL_MS = int(os.environ.get("PROFILER_INTERVAL_MS", 10))
+    PROFILER_MAX_SECONDS = int(os.environ.get("PROFILER_MAX_SECONDS", 300))
+    PROFILER_KEEP = int(os.environ.get("PROFILER_KEEP", 20))
+
+    # Trace allocations of workers with tracemalloc and report the sites
+    # growing between snapshots, slows requests down, enable to hunt leaks
+    MEMORY_TRACKING_ENABLED = asbool(os.environ.get("MEMORY_TRACKING_ENABLED", "false"))
+    MEMORY_DIR = os.environ.get("MEMORY_DIR")
+    MEMORY_SNAPSHOT_SECONDS = int(os.environ.get("MEMORY_SNAPSHOT_SECONDS", 300))
+    MEMORY_TRACEBACK_FRAMES = int(os.environ.get("MEMORY_TRACEBACK_FRAMES", 10))
+    MEMORY_TOP = int(os.environ.get("MEMORY_TOP", 20))
+
     # Cooldown time limit for forgot password email
     FORGOT_PASSWORD_COOLDOWN_TIME_SECONDS = int(
         os.environ.get("FORGOT_PASSWORD_COOLDOWN_TIME_SECONDS", 60 * 30)
@@ -55,7 +244,9 @@ class DevConfig(Config):
     ENV = "dev"
     DEBUG = True
     DEBUG_TB_ENABLED = True
-    CACHE_TYPE = "simple"  # Can be "memcached", "redis", etc.
+    CACHE_TYPE = "simple"
+    SLOW_QUERY_EXPLAIN = asbool(os.environ.get("SLOW_QUERY_EXPLAIN", "true"))
+    LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
 
 
 class TestConfig(Config):
@@ -69,6 +260,18 @@ class TestConfig(Config):
 
     # For faster tests; needs at least 4 to avoid "ValueError: Invalid rounds"
     BCRYPT_LOG_ROUNDS = 4
+    HASHING_POOL_SIZE = 0
+    HASHING_HOST_SLOTS = 0
+    RATELIMIT_BACKEND = "memory"
+    LOGGING_ENABLED = False
+    ERROR_REPORTER_API_KEY = None
+    METRICS_ENABLED = False
+    PROFILER_ENABLED = False
+    MEMORY_TRACKING_ENABLED = False
+    QUERY_BUDGETS_ENFORCED = True
+    CACHE_TYPE = "simple"
+    TEMPLATE_CACHE_DIR = None
+    ASSETS_DIST_DIR = None
     WTF_CSRF_ENABLED = False  # Allows form testing
     # https://github.com/jarus/flask-testing/issues/21
     PRESERVE_CONTEXT_ON_EXCEPTION = False
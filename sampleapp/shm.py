@@ -0,0 +1,141 @@
+"""Hash table in a memory mapped file, shared by all workers on a host.
+
+Gunicorn workers are separate processes, so anything kept in a Python dict is
+per worker. :class:`SharedTable` maps a file (ideally on ``/dev/shm``) into
+every worker and stores small fixed size records in it. Lookups and updates
+are a hash, a byte range lock and a memory copy, no round-trip to another
+service.
+
+The table is direct mapped: every key has exactly one slot, and a key hashing
+to an occupied slot replaces the previous entry. That makes it a good fit for
+counters and caches that can afford to lose an entry now and then, size the
+table so collisions are rare.
+
+Files of the workers of a host, like the metrics and diagnostics of each
+worker, also go to :func:`default_shm_path`, and :func:`pid_alive` tells which
+of them belong to exited workers.
+"""
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+#: Slot header, hash of the key and length of the payload
+_HEADER = struct.Struct("<QI")
+
+
+def default_shm_path(name):
+    """Path of a shared memory file, on ``/dev/shm`` when available."""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, name)
+
+
+def pid_alive(pid):
+    """Whether the process pid is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _key_hash(key):
+    if isinstance(key, str):
+        key = key.encode("utf-8")
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    # 0 marks an empty slot
+    return int.from_bytes(digest, "little") or 1
+
+
+class SharedTable:
+    """Fixed size table of ``slots`` records, each holding up to
+    ``payload_size`` bytes, stored in the file at ``path``.
+
+    Every process opening the same path with the same dimensions shares the
+    same table. Slots are locked individually with ``fcntl.lockf``, which also
+    serializes processes, and a thread lock serializes threads of one process.
+    """
+
+    def __init__(self, path, slots, payload_size):
+        self.path = path
+        self.slots = slots
+        self.payload_size = payload_size
+        # keep slots 8 bytes aligned
+        self.slot_size = (_HEADER.size + payload_size + 7) // 8 * 8
+        size = self.slot_size * slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._mmap = mmap.mmap(self._fd, size)
+        self._thread_lock = threading.Lock()
+
+    def get(self, key):
+        """Return payload stored for key, or None."""
+        key_hash = _key_hash(key)
+        offset = key_hash % self.slots * self.slot_size
+        with self._locked(offset, self.slot_size, fcntl.LOCK_SH):
+            return self._read(offset, key_hash)
+
+    def update(self, key, func):
+        """Replace the payload of key by ``func(current_payload)`` atomically.
+
+        ``current_payload`` is None if the key is not in the table. When
+        ``func`` returns None the key is removed.
+
+        :return: The value returned by ``func``
+        """
+        key_hash = _key_hash(key)
+        offset = key_hash % self.slots * self.slot_size
+        with self._locked(offset, self.slot_size, fcntl.LOCK_EX):
+            payload = func(self._read(offset, key_hash))
+            if payload is None:
+                if self._read(offset, key_hash) is not None:
+                    self._mmap[offset : offset + _HEADER.size] = bytes(_HEADER.size)
+            else:
+                if len(payload) > self.payload_size:
+                    raise ValueError(
+                        f"Payload of {len(payload)} bytes does not fit in "
+                        f"{self.payload_size} bytes"
+                    )
+                end = offset + _HEADER.size + len(payload)
+                self._mmap[offset + _HEADER.size : end] = payload
+                _HEADER.pack_into(self._mmap, offset, key_hash, len(payload))
+            return payload
+
+    def set(self, key, payload):
+        self.update(key, lambda current: payload)
+
+    def delete(self, key):
+        self.update(key, lambda current: None)
+
+    def clear(self):
+        """Remove all entries from the table."""
+        size = self.slot_size * self.slots
+        with self._locked(0, size, fcntl.LOCK_EX):
+            self._mmap[:] = bytes(size)
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+
+    def _read(self, offset, key_hash):
+        stored_hash, length = _HEADER.unpack_from(self._mmap, offset)
+        if stored_hash != key_hash:
+            return None
+        start = offset + _HEADER.size
+        return self._mmap[start : start + length]
+
+    @contextlib.contextmanager
+    def _locked(self, offset, length, mode):
+        with self._thread_lock:
+            fcntl.lockf(self._fd, mode, length, offset, os.SEEK_SET)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset, os.SEEK_SET)
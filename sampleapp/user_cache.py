@@ -0,0 +1,116 @@
+"""Per-worker cache of logged in users.
+
+Flask-Login loads the current user on every authenticated request. Instead of
+hitting the database each time, :class:`UserCache` keeps small read-only user
+snapshots in an LRU map with a TTL. Writes to the cached columns invalidate the
+entry in the worker that made them.
+
+When the application cache is shared between workers (any ``CACHE_TYPE`` but
+``simple`` and ``null``), every user also has a namespace there, and
+invalidating a user replaces its generation. Workers compare it with the
+generation their entry was loaded at on every hit, so they all see the change
+on their next request. Otherwise other workers see it once their entry
+expires, so keep ``USER_CACHE_TTL_SECONDS`` short; the admin dashboard never
+relies on cached users for that reason, see :func:`sampleapp.app.load_user`.
+"""
+import collections
+import threading
+import time
+
+
+class UserCache:
+    """Flask extension holding a TTL + LRU cache keyed by user id.
+
+    Configuration:
+
+    - ``USER_CACHE_TTL_SECONDS``: how long a snapshot can be served, 0
+      disables the cache
+    - ``USER_CACHE_MAX_SIZE``: maximum number of cached users per worker
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 0
+        self.max_size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._reset_stats()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get("USER_CACHE_TTL_SECONDS", 0)
+        self.max_size = app.config.get("USER_CACHE_MAX_SIZE", 0)
+        self.clear()
+        self._reset_stats()
+
+    def get(self, user_id, loader):
+        """Get the cached value for given user id, or load it with
+        ``loader(user_id)`` and cache it. ``None`` results are not cached.
+        """
+        key = str(user_id)
+        if not self.ttl:
+            return loader(user_id)
+        now = time.monotonic()
+        generation = self._generation(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, entry_generation, value = entry
+                if expires_at > now and entry_generation == generation:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return value
+                del self._entries[key]
+            self._stats["misses"] += 1
+
+        value = loader(user_id)
+        if value is None:
+            return value
+        with self._lock:
+            self._entries[key] = (now + self.ttl, generation, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+        return value
+
+    def invalidate(self, *user_ids):
+        """Drop cached entries of given user ids, in every worker when the
+        application cache is shared."""
+        with self._lock:
+            for user_id in user_ids:
+                if self._entries.pop(str(user_id), None) is not None:
+                    self._stats["invalidations"] += 1
+        cache = self._shared_cache() if self.ttl else None
+        if cache is not None:
+            for user_id in user_ids:
+                cache.invalidate(_namespace(str(user_id)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return hit, miss, eviction and invalidation counters."""
+        with self._lock:
+            return dict(self._stats, size=len(self._entries))
+
+    def _shared_cache(self):
+        from .extensions import cache
+
+        return cache if cache.shared else None
+
+    def _generation(self, key):
+        """Return the generation of the user in the shared cache, None when
+        there is none."""
+        cache = self._shared_cache()
+        if cache is None:
+            return None
+        return cache.generation(_namespace(key))
+
+    def _reset_stats(self):
+        self._stats = dict(hits=0, misses=0, evictions=0, invalidations=0)
+
+
+def _namespace(key):
+    return f"users:{key}"
@@ -37,6 +37,22 @@ def is_safe_url(target):
     return test_url.scheme in ("http", "https") and ref_url.netloc == test_url.netloc
 
 
+def client_ip():
+    """Address of the client, as seen by the closest trusted proxy.
+
+    Proxies append the address they received the request from to
+    X-Forwarded-For, so only the last ``TRUSTED_PROXY_COUNT`` entries can be
+    trusted, anything before them is set by the client.
+    """
+    trusted = current_app.config["TRUSTED_PROXY_COUNT"]
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if trusted and forwarded_for:
+        addresses = [address.strip() for address in forwarded_for.split(",")]
+        if len(addresses) >= trusted:
+            return addresses[-trusted]
+    return request.remote_addr
+
+
 def login_user(user, remember=True):
     flask_login.login_user(user, remember=remember)
     flask_principal.identity_changed.send(
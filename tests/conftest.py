@@ -1,6 +1,10 @@
 import pytest
 from flask_webtest import TestApp
 from pytest_factoryboy import register
+from sqlalchemy import create_engine
+from sqlalchemy import exc
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
 
 from . import factories
 from sampleapp.app import create_app
@@ -12,6 +16,41 @@ register(factories.UserFactory)
 register(factories.UserFactory, "admin_user", is_admin=True)
 register(factories.UserFactory, "inactive_user", is_active=False)
 
+SHARD_COUNT = 2
+
+
+def shard_urls():
+    """Databases of the user shards, next to the test database."""
+    url = make_url(TestConfig.SQLALCHEMY_DATABASE_URI)
+    return [
+        str(url.set(database=f"{url.database}_shard{shard}"))
+        for shard in range(SHARD_COUNT)
+    ]
+
+
+class ShardConfig(TestConfig):
+    USER_SHARD_URLS = shard_urls()
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers",
+        "sharded: run the test with users sharded across databases too, "
+        "only sharded with only=True",
+    )
+
+
+def pytest_generate_tests(metafunc):
+    marker = metafunc.definition.get_closest_marker("sharded")
+    if marker is not None and "sharding" in metafunc.fixturenames:
+        values = [True] if marker.kwargs.get("only") else [False, True]
+        metafunc.parametrize(
+            "sharding",
+            values,
+            ids=["sharded" if value else "unsharded" for value in values],
+            indirect=True,
+        )
+
 
 def pytest_sessionstart(session):
     _app = create_app(TestConfig)
@@ -24,14 +63,57 @@ def pytest_sessionstart(session):
         CREATE EXTENSION IF NOT EXISTS pgcrypto
         """
         )
+        _db.engine.execute(
+            """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm
+        """
+        )
 
     ctx.pop()
 
 
+@pytest.fixture(scope="session")
+def shard_databases():
+    """Create the databases of the user shards when missing."""
+    engine = create_engine(
+        TestConfig.SQLALCHEMY_DATABASE_URI, isolation_level="AUTOCOMMIT"
+    )
+    try:
+        with engine.connect() as connection:
+            for url in shard_urls():
+                name = make_url(url).database
+                exists = connection.execute(
+                    text("SELECT 1 FROM pg_database WHERE datname = :name"),
+                    dict(name=name),
+                ).scalar()
+                if not exists:
+                    connection.execute(text(f'CREATE DATABASE "{name}"'))
+    except exc.DBAPIError as e:
+        pytest.skip(f"Cannot create the shard databases: {e}")
+    finally:
+        engine.dispose()
+    for url in shard_urls():
+        engine = create_engine(url)
+        with engine.begin() as connection:
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS pgcrypto"))
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        engine.dispose()
+
+
 @pytest.fixture
-def app():
+def sharding(request):
+    """Whether users are sharded across databases, see the sharded marker."""
+    return getattr(request, "param", False)
+
+
+@pytest.fixture
+def app(request, sharding):
     """An application for the tests."""
-    _app = create_app(TestConfig)
+    config = TestConfig
+    if sharding:
+        request.getfixturevalue("shard_databases")
+        config = ShardConfig
+    _app = create_app(config)
     ctx = _app.test_request_context()
     ctx.push()
 
@@ -46,17 +128,34 @@ def testapp(app, db):
     return TestApp(app, db=db)
 
 
+@pytest.fixture
+def admin_testapp(testapp, admin_user):
+    """A Webtest app logged in as an admin."""
+    with testapp.session_transaction() as session:
+        session["_user_id"] = admin_user.id
+        session["identity.auth_type"] = None
+        session["identity.id"] = admin_user.id
+    return testapp
+
+
 @pytest.fixture
 def db(app):
     """A database for the tests."""
     _db.app = app
+    shard_engines = [
+        _db.get_engine(app, bind) for bind in app.extensions["database_shards"]
+    ]
     with app.app_context():
         _db.create_all()
+        for engine in shard_engines:
+            _db.Model.metadata.create_all(engine)
 
     yield _db
 
     # Explicitly close DB connection
     _db.session.close()
+    for engine in shard_engines:
+        _db.Model.metadata.drop_all(engine)
     _db.drop_all()
 
 
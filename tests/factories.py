@@ -34,3 +34,7 @@ class UserFactory(BaseFactory):
     @post_generation
     def init_password(obj, create, extracted, **kwargs):
         obj.set_password(extracted or USER_DEFAULT_PASSWORD)
+        if create:
+            # stored like the rest of the user, instead of being flushed by
+            # whatever runs next, like the queries of a request under test
+            db.session.commit()
@@ -1,9 +1,21 @@
+import csv
+import datetime
+import io
+import json
+
 import pytest
 from flask import url_for
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from sampleapp.admin import BaseModelView
+from sampleapp.admin import UserModelView
 
 ADMIN_ENDPOINTS = [
     "admin.index",
     "admin.user.index_view",
+    "admin.profiler.index",
+    "admin.memory.index",
 ]
 
 
@@ -30,3 +42,306 @@ def test_endpoints_with_admin_user(endpoint, testapp, admin_user):
         session["identity.auth_type"] = None
         session["identity.id"] = admin_user.id
     testapp.get(url_for(endpoint), status=200)
+
+
+@pytest.fixture
+def statements(db):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        statements.append((statement, context.execution_options))
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    yield statements
+    event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+def test_export_csv_streams_rows(admin_testapp, user_factory, statements):
+    users = user_factory.create_batch(5)
+    res = admin_testapp.get(url_for("admin.user.export", export_type="csv"))
+    assert res.content_type == "text/csv"
+    rows = list(csv.reader(io.StringIO(res.text)))
+    assert rows[0] == ["Email", "Plan Slug", "Created At", "Is Active", "Is Admin"]
+    assert {user.email for user in users} <= {row[0] for row in rows[1:]}
+    (statement,) = [
+        statement for statement, options in statements if options.get("stream_results")
+    ]
+    assert "users.password" not in statement
+    assert "users.email" in statement
+    # exports do not count rows
+    assert not [
+        statement
+        for statement, _ in statements
+        if "count(" in statement or "reltuples" in statement
+    ]
+
+
+def test_export_jsonl(admin_testapp, user_factory):
+    user = user_factory(email="exported@example.com", is_admin=True)
+    res = admin_testapp.get(url_for("admin.user.export", export_type="jsonl"))
+    assert res.content_type == "application/x-ndjson"
+    assert "attachment;filename=" in res.headers["Content-Disposition"]
+    records = [json.loads(line) for line in res.text.splitlines()]
+    (record,) = [record for record in records if record["email"] == user.email]
+    assert record["is_admin"] is True
+    assert "password" not in record
+    assert set(record) == {"email", "plan_slug", "created_at", "is_active", "is_admin"}
+
+
+def test_export_in_chunks(admin_testapp, user_factory, monkeypatch):
+    monkeypatch.setattr(BaseModelView, "export_chunk_size", 100)
+    monkeypatch.setattr(BaseModelView, "export_batch_size", 2)
+    user_factory.create_batch(10)
+    res = admin_testapp.get(url_for("admin.user.export", export_type="csv"))
+    assert len(res.text.splitlines()) == 12
+
+
+def listed_emails(res):
+    return [cell.get_text(strip=True) for cell in res.html.select("td.col-email")]
+
+
+def pager_links(res):
+    prev_link, next_link = res.html.select("ul.pagination li a")
+    return [
+        None if link["href"] == "javascript:void(0)" else link["href"]
+        for link in (prev_link, next_link)
+    ]
+
+
+@pytest.mark.sharded
+def test_keyset_pagination(admin_testapp, admin_user, user_factory, monkeypatch):
+    monkeypatch.setattr(BaseModelView, "page_size", 4)
+    created_at = datetime.datetime(2020, 1, 1)
+    users = [
+        # pairs of users created at the same time, ordered by id
+        user_factory(created_at=created_at - datetime.timedelta(days=i // 2))
+        for i in range(9)
+    ]
+    users.sort(key=lambda user: (user.created_at, user.id), reverse=True)
+    expected = [user.email for user in users] + [admin_user.email]
+    if admin_user.created_at > users[0].created_at:
+        expected = [admin_user.email] + expected[:-1]
+
+    pages = []
+    res = admin_testapp.get(url_for("admin.user.index_view"))
+    while True:
+        pages.append(listed_emails(res))
+        prev_url, next_url = pager_links(res)
+        if next_url is None:
+            break
+        res = admin_testapp.get(next_url)
+    assert [len(page) for page in pages] == [4, 4, 2]
+    assert sum(pages, []) == expected
+
+    for page in reversed(pages[:-1]):
+        res = admin_testapp.get(prev_url)
+        assert listed_emails(res) == page
+        prev_url, _ = pager_links(res)
+    assert prev_url is None
+
+
+def test_keyset_pagination_ignores_invalid_cursor(admin_testapp, admin_user):
+    res = admin_testapp.get(url_for("admin.user.index_view", after="not,a-cursor"))
+    assert listed_emails(res) == [admin_user.email]
+
+
+@pytest.mark.sharded
+def test_sorted_list_pages_with_offset(admin_testapp, user_factory, monkeypatch):
+    monkeypatch.setattr(BaseModelView, "page_size", 2)
+    user_factory.create_batch(3)
+    res = admin_testapp.get(url_for("admin.user.index_view", sort=0))
+    assert len(listed_emails(res)) == 2
+    links = [link["href"] for link in res.html.select("ul.pagination li a")]
+    assert any("page=1" in link for link in links)
+
+
+def test_list_loads_listed_columns(admin_testapp, statements):
+    admin_testapp.get(url_for("admin.user.index_view"))
+    (statement,) = [statement for statement, _ in statements if "ORDER BY" in statement]
+    assert "users.password" not in statement
+    assert "users.email" in statement
+
+
+def test_estimated_count(admin_testapp, user_factory, db, monkeypatch):
+    user_factory.create_batch(3)
+    db.session.execute("ANALYZE users")
+    res = admin_testapp.get(url_for("admin.user.index_view"))
+    assert "List (4)" in res
+
+    monkeypatch.setattr(BaseModelView, "estimated_count_threshold", 2)
+    monkeypatch.setattr(BaseModelView, "_estimate_count", lambda self: 1000)
+    res = admin_testapp.get(url_for("admin.user.index_view"))
+    assert "List (1000)" in res
+    res = admin_testapp.get(url_for("admin.user.index_view", search="user"))
+    assert "List (" not in res
+
+
+@pytest.fixture
+def searched_users(user_factory):
+    emails = [
+        "alice.bob@example.com",
+        "robert@example.com",
+        "xbob@example.io",
+        "bob@example.com",
+        "a_b@example.com",
+        "axb@example.com",
+    ]
+    return [user_factory(email=email) for email in emails]
+
+
+@pytest.mark.sharded
+def test_search_ranks_matches(admin_testapp, searched_users):
+    res = admin_testapp.get(url_for("admin.user.index_view", search="BOB"))
+    assert listed_emails(res) == [
+        "bob@example.com",
+        "xbob@example.io",
+        "alice.bob@example.com",
+    ]
+    assert "List (3)" in res
+
+
+def test_search_escapes_wildcards(admin_testapp, searched_users):
+    res = admin_testapp.get(url_for("admin.user.index_view", search="a_b"))
+    assert listed_emails(res) == ["a_b@example.com"]
+
+
+def test_short_search_matches_prefix(admin_testapp, searched_users):
+    res = admin_testapp.get(url_for("admin.user.index_view", search="bo"))
+    assert listed_emails(res) == ["bob@example.com"]
+
+
+@pytest.mark.sharded
+def test_search_result_limit(admin_testapp, searched_users, monkeypatch):
+    monkeypatch.setattr(UserModelView, "search_result_limit", 2)
+    res = admin_testapp.get(url_for("admin.user.index_view", search="example"))
+    assert len(listed_emails(res)) == 2
+    assert "List (2)" in res
+
+
+@pytest.mark.sharded
+def test_autocomplete(admin_testapp, searched_users):
+    res = admin_testapp.get(url_for("admin.user.autocomplete", q="bob"))
+    assert [result["email"] for result in res.json["results"]] == [
+        "bob@example.com",
+        "xbob@example.io",
+        "alice.bob@example.com",
+    ]
+    res = admin_testapp.get(url_for("admin.user.autocomplete", q=" "))
+    assert res.json == dict(results=[])
+
+
+def test_autocomplete_ranks_capped_candidates(
+    admin_testapp, searched_users, monkeypatch
+):
+    monkeypatch.setattr(UserModelView, "search_result_limit", 1)
+    res = admin_testapp.get(url_for("admin.user.autocomplete", q="bob"))
+    assert len(res.json["results"]) == 1
+
+
+def test_autocomplete_requires_admin(testapp, user):
+    testapp.get(url_for("admin.user.autocomplete", q="bob"), status=302)
+
+
+def user_ids(users):
+    return [("rowid", str(user.id)) for user in users]
+
+
+@pytest.mark.sharded
+def test_action_on_selected_users(admin_testapp, admin_user, user_factory, db):
+    selected = user_factory.create_batch(3)
+    other = user_factory()
+    res = admin_testapp.post(
+        url_for("admin.user.action_view"),
+        [("action", "deactivate")] + user_ids(selected + [admin_user]),
+    ).follow()
+    assert "3 users deactivated." in res
+    db.session.expire_all()
+    assert [user.is_active for user in selected] == [False] * 3
+    # the logged in admin cannot lock themselves out
+    assert admin_user.is_active and other.is_active
+
+
+@pytest.mark.sharded
+def test_toggle_admin(admin_testapp, user_factory, db):
+    users = [user_factory(is_admin=False), user_factory(is_admin=True)]
+    admin_testapp.post(
+        url_for("admin.user.action_view"),
+        [("action", "toggle_admin")] + user_ids(users),
+    )
+    db.session.expire_all()
+    assert [user.is_admin for user in users] == [True, False]
+
+
+def test_force_password_reset(admin_testapp, user, default_password, db):
+    admin_testapp.post(
+        url_for("admin.user.action_view"),
+        [("action", "force_password_reset")] + user_ids([user]),
+    )
+    db.session.expire_all()
+    assert not user.check_password(default_password)
+    assert user.reset_password_at is not None
+    assert user.sent_reset_password_at is None
+
+
+def test_action_on_matching_users(
+    admin_testapp, searched_users, statements, monkeypatch, db
+):
+    monkeypatch.setattr(UserModelView, "bulk_update_chunk_size", 2)
+    db.session.commit()
+    invalidated = []
+    monkeypatch.setattr(
+        "sampleapp.models.accounts.user_cache.invalidate",
+        lambda *user_ids: invalidated.append(set(user_ids)),
+    )
+    res = admin_testapp.post(
+        url_for("admin.user.matching_action_view", search="bob"),
+        dict(action="deactivate"),
+    ).follow()
+    assert "3 users deactivated." in res
+    db.session.expire_all()
+    assert {user.email for user in searched_users if not user.is_active} == {
+        "bob@example.com",
+        "xbob@example.io",
+        "alice.bob@example.com",
+    }
+    updates = [statement for statement, _ in statements if "RETURNING" in statement]
+    assert len(updates) == 2
+    assert "WHERE users.id = ANY (" in updates[0]
+    # once per committed chunk
+    assert [len(user_ids) for user_ids in invalidated] == [2, 1]
+
+
+def test_dashboard_reads_rollups(admin_testapp, user_factory):
+    user_factory(is_active=False)
+    res = admin_testapp.get(url_for("admin.index"))
+    assert res.html.select_one(".stat-users").get_text() == "2"
+    assert res.html.select_one(".stat-inactive").get_text() == "1"
+    assert res.html.select_one(".stat-admins").get_text() == "1"
+    first_day = res.html.select("table.daily-stats tbody tr")[0]
+    assert [cell.get_text() for cell in first_day.select("td")][1] == "2"
+
+
+def test_action_failing_midway(admin_testapp, user_factory, monkeypatch, db):
+    from sampleapp.models.accounts import User
+
+    monkeypatch.setattr(UserModelView, "bulk_update_chunk_size", 2)
+    users = user_factory.create_batch(4)
+    db.session.commit()
+    update_many = User.update_many
+    calls = []
+
+    def failing_update_many(user_ids, values):
+        calls.append(user_ids)
+        if len(calls) == 2:
+            raise IntegrityError("UPDATE users", {}, Exception("conflict"))
+        return update_many(user_ids, values)
+
+    monkeypatch.setattr(User, "update_many", failing_update_many)
+    res = admin_testapp.post(
+        url_for("admin.user.action_view"),
+        [("action", "deactivate")] + user_ids(users),
+    ).follow()
+    assert "Failed to update users, 2 users deactivated before the failure." in res
+    assert not res.html.select(".alert-success")
+    db.session.expire_all()
+    assert sorted(user.is_active for user in users) == [False, False, True, True]
@@ -2,10 +2,13 @@ import datetime
 import re
 
 import jwt
+import pytest
 from flask import url_for
 from freezegun import freeze_time
 
 from sampleapp.extensions import mail
+from sampleapp.mailer import send_pending
+from sampleapp.models.accounts import User
 
 
 def test_forgot_password(testapp, user):
@@ -17,11 +20,16 @@ def test_forgot_password(testapp, user):
     form["email"] = user.email
     with mail.record_messages() as outbox:
         res = form.submit()
+        # mail is only queued in the outbox by the request
+        assert not outbox
+        assert send_pending() == (1, 0)
         assert len(outbox) == 1
         match = re.search("reset-password\\?token=([0-9a-zA-Z.\\-_]+)", outbox[0].body)
         raw_token = match.group(1)
         token = jwt.decode(
-            raw_token, key=testapp.app.config["SECRET_KEY"], algorithms=["HS256"],
+            raw_token,
+            key=testapp.app.config["SECRET_KEY"],
+            algorithms=["HS256"],
         )
         user_id = token["user_id"]
         expires_at = datetime.datetime.utcfromtimestamp(token["expires_at"])
@@ -33,6 +41,7 @@ def test_forgot_password(testapp, user):
     assert "Please check your mailbox for reset password email" in res
 
 
+@pytest.mark.sharded
 def test_forgot_password_cooldown_period(testapp, db, user):
     testapp.app.config["FORGOT_PASSWORD_COOLDOWN_TIME_SECONDS"] = 60 * 10
     testapp.app.config["RESET_PASSWORD_LINK_VALID_SECONDS"] = 123
@@ -54,14 +63,41 @@ def test_forgot_password_cooldown_period(testapp, db, user):
         now + datetime.timedelta(seconds=60 * 10)
     ), mail.record_messages() as outbox:
         form.submit()
+        send_pending()
         assert len(outbox) == 1
 
 
+def test_mark_reset_password_sent(db, user):
+    now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+    row = User.mark_reset_password_sent(user.email.upper(), now, 60)
+    assert row.id == user.id
+    assert row.email == user.email
+    # a second request within the cooldown period does not pass
+    assert User.mark_reset_password_sent(user.email, now, 60) is None
+    db.session.commit()
+    assert user.sent_reset_password_at == now.replace(tzinfo=None)
+    later = now + datetime.timedelta(seconds=60)
+    assert User.mark_reset_password_sent(user.email, later, 60) is not None
+    assert User.mark_reset_password_sent("unknown@example.com", now, 60) is None
+
+
+def test_forgot_password_unknown_email(testapp, user):
+    res = testapp.get(url_for("public.forgot_password"))
+    form = res.form
+    form["email"] = "unknown@example.com"
+    with mail.record_messages() as outbox:
+        res = form.submit()
+        send_pending()
+        assert not outbox
+    assert "Please check your mailbox" not in res
+
+
 def test_reset_password_invalid_token(testapp, user):
     res = testapp.get(url_for("public.reset_password", token="foobar")).follow()
     assert "Invalid token" in res
 
 
+@pytest.mark.sharded
 def test_reset_password(testapp, user, default_password):
     now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
     token = jwt.encode(
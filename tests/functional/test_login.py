@@ -1,3 +1,4 @@
+import pytest
 from flask import url_for
 
 
@@ -22,6 +23,7 @@ def test_can_login_with_different_email_case_in_returns_200(
     assert res.status_code == 200
 
 
+@pytest.mark.sharded
 def test_sees_alert_on_logout(testapp, user, default_password):
     res = testapp.get(url_for("public.login"))
     form = res.form
@@ -0,0 +1,32 @@
+import pytest
+from flask import url_for
+
+from sampleapp.app import create_app
+from sampleapp.extensions import memory
+from sampleapp.settings import TestConfig
+
+
+@pytest.fixture
+def app(tmp_path):
+    class MemoryConfig(TestConfig):
+        MEMORY_TRACKING_ENABLED = True
+        MEMORY_DIR = str(tmp_path)
+        MEMORY_SNAPSHOT_SECONDS = 3600
+
+    _app = create_app(MemoryConfig)
+    ctx = _app.test_request_context()
+    ctx.push()
+    yield _app
+    ctx.pop()
+    memory.stop()
+
+
+def test_report_worker(admin_testapp):
+    res = admin_testapp.get(url_for("admin.memory.index"))
+    assert "No worker reported yet." in res
+    res = res.form.submit().follow()
+    assert "is reported." in res
+    (worker,) = res.html.select(".worker")
+    assert worker.h4.text == f"Worker {memory.reports()[0]['pid']}"
+    endpoints = [row.td.text for row in worker.select(".endpoints tbody tr")]
+    assert "admin.memory.index" in endpoints
@@ -0,0 +1,133 @@
+import re
+
+import pytest
+from flask import url_for
+from flask_webtest import TestApp
+
+from sampleapp.app import create_app
+from sampleapp.extensions import metrics
+from sampleapp.settings import TestConfig
+
+SAMPLE = re.compile(r"^(\w+)(\{.*\})? (\S+)$")
+
+
+@pytest.fixture
+def config(tmp_path):
+    class MetricsConfig(TestConfig):
+        METRICS_ENABLED = True
+        METRICS_DIR = str(tmp_path)
+        METRICS_TOKEN = "scraper-token"
+
+    return MetricsConfig
+
+
+@pytest.fixture
+def app(config):
+    _app = create_app(config)
+    ctx = _app.test_request_context()
+    ctx.push()
+    yield _app
+    ctx.pop()
+    metrics.close()
+
+
+def scrape(testapp, token="scraper-token"):
+    res = testapp.get("/metrics", headers={"Authorization": f"Bearer {token}"})
+    assert res.content_type == "text/plain"
+    samples = {}
+    for line in res.text.splitlines():
+        if not line.startswith("#"):
+            name, labels, value = SAMPLE.match(line).groups()
+            samples[name + (labels or "")] = float(value)
+    return samples
+
+
+def test_records_login_breakdown(testapp, user, default_password):
+    res = testapp.get(url_for("public.login"))
+    form = res.form
+    form["email"] = user.email
+    form["password"] = default_password
+    form.submit().follow()
+
+    samples = scrape(testapp)
+    assert samples['http_requests_total{endpoint="public.login",status="200"}'] == 1
+    assert samples['http_requests_total{endpoint="public.login",status="302"}'] == 1
+    assert samples['http_request_duration_seconds_count{endpoint="public.login"}'] == 2
+    assert (
+        samples[
+            'http_request_duration_seconds_bucket{endpoint="public.login",le="+Inf"}'
+        ]
+        == 2
+    )
+
+    def component(name):
+        return samples[
+            "http_request_component_seconds_sum"
+            f'{{component="{name}",endpoint="public.login"}}'
+        ]
+
+    assert component("db") > 0
+    assert component("bcrypt") > 0
+    assert component("template") > 0
+    assert component("mail") == 0
+    assert samples['http_request_sql_queries_sum{endpoint="public.login"}'] > 0
+    assert samples['db_pool_size{bind="default"}'] > 0
+    assert samples['db_pool_checkouts_total{bind="default"}'] > 0
+    assert samples['db_pool_timeouts_total{bind="default"}'] == 0
+    assert samples["password_hashing_seconds_count"] >= 1
+    assert samples['password_hashing_seconds_bucket{le="+Inf"}'] >= 1
+    assert samples['password_hashing_jobs_total{outcome="completed"}'] >= 1
+    assert samples['password_hashing_jobs_total{outcome="rejected"}'] == 0
+    assert samples["password_hashing_jobs"] == 0
+
+
+def test_records_cache_stats(testapp, user, default_password):
+    testapp.get(url_for("public.home"))
+    testapp.get(url_for("public.home"))
+    res = testapp.get(url_for("public.login"))
+    res.form["email"] = user.email
+    res.form["password"] = default_password
+    res.form.submit().follow()
+    testapp.get(url_for("public.home"))
+
+    samples = scrape(testapp)
+    assert samples['cache_requests_total{namespace="pages",result="miss"}'] == 1
+    assert samples['cache_requests_total{namespace="pages",result="hit"}'] == 1
+    assert samples['user_cache_requests_total{result="miss"}'] >= 1
+    assert samples['user_cache_requests_total{result="hit"}'] >= 1
+    assert samples["user_cache_size"] == 1
+    assert samples["user_cache_evictions_total"] == 0
+
+
+def test_records_mail_time(testapp, user):
+    res = testapp.get(url_for("public.forgot_password"))
+    res.form["email"] = user.email
+    res.form.submit()
+    samples = scrape(testapp)
+    assert (
+        samples[
+            "http_request_component_seconds_sum"
+            '{component="mail",endpoint="public.forgot_password"}'
+        ]
+        > 0
+    )
+
+
+def test_unmatched_requests(testapp, db):
+    testapp.get("/no-such-page", status=404)
+    samples = scrape(testapp)
+    assert samples['http_requests_total{endpoint="unmatched",status="404"}'] == 1
+
+
+@pytest.mark.parametrize("token", ["", "wrong-token"])
+def test_requires_token(testapp, db, token):
+    res = testapp.get(
+        "/metrics", headers={"Authorization": f"Bearer {token}"}, status=401
+    )
+    assert res.headers["WWW-Authenticate"] == 'Bearer realm="metrics"'
+    testapp.get("/metrics", status=401)
+
+
+def test_not_served_without_token(db, config):
+    config.METRICS_TOKEN = None
+    TestApp(create_app(config), db=db).get("/metrics", status=404)
@@ -0,0 +1,72 @@
+from flask import url_for
+
+from sampleapp.caching.pages import purge
+from sampleapp.extensions import cache
+
+
+def login(testapp, user, password):
+    res = testapp.get(url_for("public.login"))
+    form = res.form
+    form["email"] = user.email
+    form["password"] = password
+    return form.submit().follow()
+
+
+def test_anonymous_page_is_cached(testapp, monkeypatch):
+    res = testapp.get(url_for("public.home"))
+    assert res.etag
+    assert res.headers["Cache-Control"] == "no-cache"
+    assert "Cookie" in res.headers["Vary"]
+    monkeypatch.setattr("sampleapp.blueprints.public.views.render_template", None)
+    cached = testapp.get(url_for("public.home"))
+    assert cached.body == res.body
+    assert cached.etag == res.etag
+
+
+def test_if_none_match_returns_304(testapp):
+    res = testapp.get(url_for("public.terms"))
+    res = testapp.get(
+        url_for("public.terms"), headers={"If-None-Match": f'"{res.etag}"'}, status=304
+    )
+    assert not res.body
+    testapp.get(
+        url_for("public.terms"), headers={"If-None-Match": '"other"'}, status=200
+    )
+
+
+def test_authenticated_page_is_not_shared(testapp, user, default_password):
+    anonymous = testapp.get(url_for("public.home"))
+    res = login(testapp, user, default_password)
+    assert user.email in res
+    res = testapp.get(
+        url_for("public.home"), headers={"If-None-Match": f'"{anonymous.etag}"'}
+    )
+    assert res.status_code == 200
+    assert user.email in res
+    assert not res.etag
+
+
+def test_flash_messages_bypass_cache(testapp, user, default_password):
+    testapp.get(url_for("public.home"))
+    login(testapp, user, default_password)
+    res = testapp.get(url_for("public.logout")).follow()
+    assert "You are logged out." in res
+    res = testapp.get(url_for("public.home"))
+    assert "You are logged out." not in res
+
+
+def test_purge(testapp):
+    testapp.get(url_for("public.home"))
+    assert cache.stats()["pages"]["misses"] == 1
+    testapp.get(url_for("public.home"))
+    assert cache.stats()["pages"]["hits"] == 1
+    purge()
+    testapp.get(url_for("public.home"))
+    assert cache.stats()["pages"]["misses"] == 2
+
+
+def test_cache_purge_command(app):
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["cache", "purge"])
+    assert result.exit_code == 0
+    assert "Page cache purged" in result.output
@@ -0,0 +1,85 @@
+import os
+
+import pytest
+from flask import url_for
+
+from sampleapp.app import create_app
+from sampleapp.extensions import profiler
+from sampleapp.settings import TestConfig
+
+
+@pytest.fixture
+def app(tmp_path):
+    class ProfilerConfig(TestConfig):
+        PROFILER_ENABLED = True
+        PROFILER_DIR = str(tmp_path)
+
+    _app = create_app(ProfilerConfig)
+    ctx = _app.test_request_context()
+    ctx.push()
+    yield _app
+    ctx.pop()
+    profiler.stop()
+
+
+def write_samples(profile_id, samples):
+    path = os.path.join(profiler.directory, profile_id, "worker-1.txt")
+    with open(path, "w") as f:
+        f.write(samples)
+
+
+def test_start_and_stop_profile(admin_testapp, admin_user):
+    res = admin_testapp.get(url_for("admin.profiler.index"))
+    assert "No profiles yet." in res
+    res.form["seconds"] = 60
+    res.form["fraction"] = 0.5
+    res = res.form.submit().follow()
+    assert "running" in res
+
+    (profile,) = profiler.profiles()
+    assert profile["running"]
+    assert profile["seconds"] == 60
+    assert profile["fraction"] == 0.5
+    assert profile["started_by"] == admin_user.email
+
+    res = admin_testapp.get(url_for("admin.profiler.index"))
+    res = res.forms[0].submit().follow()
+    assert "The profile is stopped." in res
+    assert not profiler.profile(profile["id"])["running"]
+
+
+def test_rejects_invalid_profile(admin_testapp):
+    res = admin_testapp.get(url_for("admin.profiler.index"))
+    res.form["seconds"] = profiler.max_seconds + 1
+    res = res.form.submit()
+    assert res.status_code == 200
+    assert not profiler.profiles()
+
+
+def test_flame_graph(admin_testapp):
+    profile_id = profiler.start(1)
+    profiler.stop()
+    write_samples(profile_id, "app:handle;hashing:_run 3\napp:handle;db:execute 1\n")
+
+    res = admin_testapp.get(
+        url_for("admin.profiler.profile_view", profile_id=profile_id)
+    )
+    assert "4 samples from 1 workers" in res
+    frames = res.html.select(".flame-graph .frame")
+    assert [frame.text for frame in frames] == [
+        "app:handle",
+        "db:execute",
+        "hashing:_run",
+    ]
+    assert frames[2]["title"] == "hashing:_run: 3 samples, 75.0%"
+
+    res = admin_testapp.get(
+        url_for("admin.profiler.collapsed_view", profile_id=profile_id)
+    )
+    assert res.text == "app:handle;db:execute 1\napp:handle;hashing:_run 3\n"
+
+
+def test_unknown_profile(admin_testapp):
+    admin_testapp.get(
+        url_for("admin.profiler.profile_view", profile_id="123"), status=404
+    )
@@ -0,0 +1,125 @@
+import logging
+
+import pytest
+from flask import url_for
+from sqlalchemy import text
+
+from sampleapp.app import create_app
+from sampleapp.extensions import db as _db
+from sampleapp.queries import max_queries
+from sampleapp.queries import query_budget
+from sampleapp.queries import QueryBudgetExceeded
+from sampleapp.settings import TestConfig
+
+
+class BudgetConfig(TestConfig):
+    # admin pages also load the logged in admin, see load_user
+    QUERY_BUDGETS = {
+        "admin.user.index_view": 4,
+        "admin.user.details_view": 3,
+        "over_budget_by_config": 0,
+    }
+    N_PLUS_ONE_THRESHOLD = 3
+    SLOW_QUERY_MS = 50
+    SLOW_QUERY_EXPLAIN = True
+
+
+@pytest.fixture
+def config():
+    return BudgetConfig
+
+
+@pytest.fixture
+def app(config):
+    _app = create_app(config)
+
+    @_app.route("/__over_budget__")
+    @query_budget(1)
+    def over_budget():
+        for _ in range(2):
+            _db.session.execute(text("SELECT 1"))
+        return "done"
+
+    @_app.route("/__over_budget_by_config__", endpoint="over_budget_by_config")
+    def over_budget_by_config():
+        _db.session.execute(text("SELECT 1"))
+        return "done"
+
+    @_app.route("/__loop__")
+    def loop():
+        for i in range(3):
+            _db.session.execute(text("SELECT :i"), dict(i=i))
+        return "done"
+
+    @_app.route("/__slow__")
+    def slow():
+        _db.session.execute(text("SELECT pg_sleep(0.06)"))
+        # the transaction survives the EXPLAIN of the slow query
+        return str(_db.session.execute(text("SELECT 1")).scalar())
+
+    ctx = _app.test_request_context()
+    ctx.push()
+    yield _app
+    ctx.pop()
+
+
+def test_public_pages_within_budget(testapp, user, default_password):
+    with max_queries(0):
+        testapp.get(url_for("public.home"))
+    res = testapp.get(url_for("public.login"))
+    res.form["email"] = user.email
+    res.form["password"] = default_password
+    with max_queries(1):
+        res.form.submit()
+    with max_queries(1):
+        testapp.get(url_for("public.home"))
+
+
+def test_admin_pages_within_budget(admin_testapp, admin_user):
+    admin_testapp.get(url_for("admin.index"))
+    admin_testapp.get(url_for("admin.user.index_view"))
+    admin_testapp.get(url_for("admin.user.details_view", id=admin_user.id))
+
+
+@pytest.mark.parametrize("path", ["/__over_budget__", "/__over_budget_by_config__"])
+def test_over_budget_fails(testapp, db, path):
+    with pytest.raises(QueryBudgetExceeded, match="SELECT 1"):
+        testapp.get(path)
+
+
+def test_over_budget_is_logged_when_not_enforced(app, testapp, db, caplog):
+    app.config["QUERY_BUDGETS_ENFORCED"] = False
+    testapp.get("/__over_budget__")
+    assert "2 queries executed by over_budget, over 1" in caplog.text
+
+
+def test_max_queries(db):
+    with pytest.raises(QueryBudgetExceeded, match="2 queries executed by the block"):
+        with max_queries(1):
+            _db.session.execute(text("SELECT 1"))
+            _db.session.execute(text("SELECT 2"))
+
+
+def test_logs_repeated_queries(testapp, db, caplog):
+    testapp.get("/__loop__")
+    (record,) = [r for r in caplog.records if "N+1" in r.getMessage()]
+    assert record.levelno == logging.WARNING
+    assert record.getMessage() == (
+        "Possible N+1 query, executed 3 times by loop: SELECT %(i)s"
+    )
+
+
+def test_logs_slow_queries_with_plan(testapp, db, caplog):
+    assert testapp.get("/__slow__").text == "1"
+    (record,) = [r for r in caplog.records if "Slow query" in r.getMessage()]
+    message = record.getMessage()
+    assert "SELECT pg_sleep(0.06)" in message
+    assert "Execution Time" in message
+
+
+def test_slow_locking_queries_are_not_run_again(db, user, caplog):
+    db.session.execute(text("SELECT pg_sleep(0.06), id FROM users FOR UPDATE"))
+    (record,) = [r for r in caplog.records if "Slow query" in r.getMessage()]
+    message = record.getMessage()
+    assert "LockRows" in message
+    assert "Execution Time" not in message
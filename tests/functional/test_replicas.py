@@ -0,0 +1,187 @@
+import time
+
+import pytest
+from flask import session
+from flask import url_for
+from sqlalchemy import event
+from sqlalchemy import exc
+from sqlalchemy import inspect
+
+from sampleapp.app import create_app
+from sampleapp.database import STICKY_SESSION_KEY
+from sampleapp.extensions import db as _db
+from sampleapp.models.accounts import User
+from sampleapp.settings import TestConfig
+
+UNREACHABLE_URL = "postgresql://postgres@localhost:1/sampleapp_test"
+
+
+class ReplicaConfig(TestConfig):
+    # replicas of the test database are the test database itself
+    DATABASE_REPLICA_URLS = [TestConfig.SQLALCHEMY_DATABASE_URI] * 2
+
+
+@pytest.fixture
+def config():
+    return ReplicaConfig
+
+
+@pytest.fixture
+def app(config):
+    _app = create_app(config)
+    ctx = _app.test_request_context()
+    ctx.push()
+    yield _app
+    ctx.pop()
+    _app.extensions["database_replicas"].close()
+
+
+@pytest.fixture
+def routes(app, db):
+    """Names of the engines running users queries, in order."""
+    routes = []
+    engines = dict(primary=_db.get_engine(app))
+    for index, engine in enumerate(app.extensions["database_replicas"].engines):
+        engines[f"replica-{index}"] = engine
+    listeners = []
+    for name, engine in engines.items():
+
+        def before_cursor_execute(conn, cursor, statement, *args, name=name):
+            if "FROM users" in statement:
+                routes.append(name)
+
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        listeners.append((engine, before_cursor_execute))
+    yield routes
+    for engine, listener in listeners:
+        event.remove(engine, "before_cursor_execute", listener)
+
+
+@pytest.fixture
+def user_id(db, user):
+    """Id of a stored user, loaded before the queries are recorded."""
+    # the factory sets the password after committing the user
+    db.session.commit()
+    session.pop(STICKY_SESSION_KEY)
+    # reading the id of the expired user would refresh it from a replica
+    return inspect(user).identity[0]
+
+
+def test_reads_go_to_replicas_in_turn(user_id, routes):
+    for _ in range(3):
+        User.query.filter_by(id=user_id).all()
+    assert routes == ["replica-0", "replica-1", "replica-0"]
+
+
+def test_transaction_reads_its_writes_from_primary(user_id, routes, db):
+    User.query.filter_by(id=user_id).with_for_update().first()
+    User.query.filter_by(id=user_id).first()
+    db.session.commit()
+    # the commit made the test request stick to the primary
+    session.pop(STICKY_SESSION_KEY)
+    User.query.filter_by(id=user_id).first()
+    assert routes == ["primary", "primary", "replica-0"]
+
+
+def test_flushed_transaction_reads_from_primary(user_id, routes, db):
+    User.query.filter_by(id=user_id).update(dict(is_admin=True))
+    db.session.flush()
+    User.query.filter_by(id=user_id).first()
+    db.session.rollback()
+    User.query.filter_by(id=user_id).first()
+    assert routes[-2:] == ["primary", "replica-0"]
+
+
+def register(testapp, email):
+    res = testapp.get(url_for("public.register"))
+    form = res.form
+    form["email"] = email
+    form["password"] = "secret"
+    form["confirm"] = "secret"
+    form["agree_terms"] = "1"
+    return form.submit()
+
+
+def test_browser_reads_its_writes(testapp, routes):
+    register(testapp, "foo@bar.com").follow()
+    routes.clear()
+    res = register(testapp, "foo@bar.com")
+    assert "Email already registered" in res
+    assert set(routes) == {"primary"}
+
+    with testapp.session_transaction() as session:
+        session[STICKY_SESSION_KEY] = 0
+    routes.clear()
+    register(testapp, "foo@bar.com")
+    assert routes and all(route.startswith("replica-") for route in routes)
+
+
+class UnreachableReplicaConfig(TestConfig):
+    DATABASE_REPLICA_URLS = [UNREACHABLE_URL, TestConfig.SQLALCHEMY_DATABASE_URI]
+
+
+@pytest.mark.parametrize("config", [UnreachableReplicaConfig])
+def test_unreachable_replica_is_skipped(user_id, routes):
+    for _ in range(2):
+        User.query.filter_by(id=user_id).first()
+    assert routes == ["replica-1", "replica-1"]
+
+
+class FailingReplicaConfig(TestConfig):
+    DATABASE_REPLICA_URLS = [UNREACHABLE_URL]
+
+
+@pytest.fixture
+def failed_replica(app):
+    """The replica went down since its last check."""
+    replicas = app.extensions["database_replicas"]
+    # starts checking, the next check is in DATABASE_REPLICA_CHECK_SECONDS
+    replicas.pick()
+    replicas._healthy[0] = True
+    return replicas
+
+
+@pytest.mark.parametrize("config", [FailingReplicaConfig])
+def test_failed_replica_read_runs_on_primary(failed_replica, user_id, routes, caplog):
+    assert User.query.filter_by(id=user_id).one().id == user_id
+    assert routes == ["primary"]
+    assert not failed_replica.is_healthy(0)
+    assert "retrying on the primary" in caplog.text
+
+
+@pytest.mark.parametrize("config", [FailingReplicaConfig])
+def test_failed_replica_read_keeps_changes(failed_replica, user_id, db):
+    db.session.add(User(email="pending@example.com", password="secret"))
+    with db.session.no_autoflush, pytest.raises(exc.OperationalError):
+        User.query.filter_by(id=user_id).one()
+    assert [user.email for user in db.session.new] == ["pending@example.com"]
+
+
+def test_unhealthy_replica_is_skipped(app, user_id, routes):
+    replicas = app.extensions["database_replicas"]
+    replicas.pick()
+    replicas.mark_unhealthy(replicas.engines[0])
+    User.query.filter_by(id=user_id).first()
+    assert routes == ["replica-1"]
+
+
+def test_replicas_are_checked_in_the_background(app, user_id, monkeypatch):
+    replicas = app.extensions["database_replicas"]
+    monkeypatch.setattr(replicas, "check_interval", 0.01)
+    User.query.filter_by(id=user_id).first()
+    assert replicas.is_healthy(0)
+    monkeypatch.setattr("sampleapp.database.REPLICATION_LAG_SQL", "SELECT 60")
+    deadline = time.monotonic() + 5
+    while replicas.is_healthy(0) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not replicas.is_healthy(0)
+
+
+def test_lagging_replicas_are_skipped(user_id, routes, monkeypatch):
+    monkeypatch.setattr("sampleapp.database.REPLICATION_LAG_SQL", "SELECT 60")
+    User.query.filter_by(id=user_id).first()
+    assert routes == ["primary"]
+
+
+def test_pool_stats_of_replicas(app, db):
+    assert set(db.pool_stats()) == {None, "replica-0", "replica-1"}
@@ -0,0 +1,194 @@
+import datetime
+
+import pytest
+from flask import url_for
+from sqlalchemy import event
+from sqlalchemy import text
+
+from sampleapp.extensions import db as _db
+from sampleapp.models.accounts import normalize_email
+from sampleapp.models.accounts import User
+from sampleapp.models.sharding import shard_for_email
+from sampleapp.models.stats import UserDailyStats
+
+# the tests of the other modules marked sharded also run with sharded users
+pytestmark = pytest.mark.sharded(only=True)
+
+
+@pytest.fixture
+def shard_engines(app):
+    return [_db.get_engine(app, bind) for bind in app.extensions["database_shards"]]
+
+
+@pytest.fixture
+def shard_queries(shard_engines):
+    """Shards running users queries, in order."""
+    queries = []
+    listeners = []
+    for shard, engine in enumerate(shard_engines):
+
+        def before_cursor_execute(conn, cursor, statement, *args, shard=shard):
+            if "users" in statement:
+                queries.append(shard)
+
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        listeners.append((engine, before_cursor_execute))
+    yield queries
+    for engine, listener in listeners:
+        event.remove(engine, "before_cursor_execute", listener)
+
+
+def stored_emails(engine):
+    with engine.connect() as connection:
+        return {row[0] for row in connection.execute(text("SELECT email FROM users"))}
+
+
+def test_users_are_stored_on_the_shard_of_their_email(db, user_factory, shard_engines):
+    users = [user_factory(email=f"User{i}@example.com") for i in range(8)]
+    stored = [stored_emails(engine) for engine in shard_engines]
+    assert all(stored), "every shard has some of the users"
+    for user in users:
+        shard = shard_for_email(normalize_email(user.email), len(shard_engines))
+        assert user.email in stored[shard]
+        assert User.shard_for_id(user.id) == shard
+    # nothing is left in the default database
+    assert stored_emails(db.engine) == set()
+
+
+def test_lookups_query_one_shard(db, user_factory, shard_queries):
+    users = user_factory.create_batch(4)
+    db.session.commit()
+    for user in users:
+        shard = User.shard_for_id(user.id)
+        del shard_queries[:]
+        assert User.find_by_email(user.email.upper()).id == user.id
+        assert User.get_by_id(str(user.id)).id == user.id
+        assert User.load_snapshot(str(user.id)).email == user.email
+        db.session.expire(user)
+        assert user.email
+        assert set(shard_queries) == {shard}
+
+
+def test_unknown_ids_are_not_found(db):
+    unsharded_id = "00000000-0000-0000-0000-0000000000ff"
+    assert User.get_by_id(unsharded_id) is None
+    assert User.load_snapshot(unsharded_id) is None
+
+
+def test_queries_without_shard_run_on_every_shard(db, user_factory):
+    users = user_factory.create_batch(6)
+    assert {user.email for user in User.query.all()} == {user.email for user in users}
+
+
+def test_update_many_updates_every_shard(db, user_factory):
+    users = user_factory.create_batch(6)
+    updated = User.update_many([user.id for user in users], dict(is_active=False))
+    db.session.commit()
+    assert set(updated) == {user.id for user in users}
+    assert not any(user.is_active for user in User.query.all())
+
+
+def test_rollups_are_rebuilt_from_every_shard(db, user_factory):
+    day = datetime.datetime(2020, 1, 1, 12)
+    user_factory.create_batch(5, created_at=day)
+    UserDailyStats.query.delete()
+    UserDailyStats.rebuild()
+    db.session.commit()
+    stats = UserDailyStats.summary(days=1, today=day.date())
+    assert stats["users"] == 5
+    assert stats["days"][0]["signups"] == 5
+
+
+def test_register_and_login(testapp, db):
+    res = testapp.get(url_for("public.register"))
+    form = res.form
+    form["email"] = "Foo@Bar.com"
+    form["password"] = "secret"
+    form["confirm"] = "secret"
+    form["agree_terms"] = "1"
+    form.submit().follow()
+    testapp.get(url_for("public.logout")).follow()
+
+    res = testapp.get(url_for("public.login"))
+    form = res.form
+    form["email"] = "foo@bar.com"
+    form["password"] = "secret"
+    res = form.submit().follow()
+    assert "You are logged in." in res
+
+
+def test_admin_rejects_email_of_another_shard(
+    admin_testapp, user_factory, db, shard_engines
+):
+    user = user_factory(email="user0@example.com")
+    shard = User.shard_for_id(user.id)
+    email = next(
+        f"user{i}@example.com"
+        for i in range(1, 100)
+        if shard_for_email(f"user{i}@example.com", len(shard_engines)) != shard
+    )
+    res = admin_testapp.get(url_for("admin.user.edit_view", id=user.id))
+    form = res.forms[0]
+    form["email"] = email
+    res = form.submit()
+    assert "The email belongs to another shard of users." in res
+    db.session.expire_all()
+    assert user.email == "user0@example.com"
+
+
+def insert_unsharded_users(db, *emails):
+    """Insert users in the default database, as before setting
+    USER_SHARD_URLS."""
+    with db.engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [dict(email=e) for e in emails])
+    with db.engine.connect() as connection:
+        return dict(connection.execute(text("SELECT email, id FROM users")).all())
+
+
+def test_migrate_moves_users_to_their_shard(app, db, shard_engines):
+    emails = [f"user{i}@example.com" for i in range(6)]
+    old_ids = insert_unsharded_users(db, *emails)
+    assert User.find_by_email(emails[0]) is None
+
+    result = app.test_cli_runner().invoke(
+        args=["shards", "migrate", "--batch-size", "4"]
+    )
+
+    assert result.exit_code == 0, result.output
+    assert "Moved 6 users to 2 shards" in result.output
+    assert stored_emails(db.engine) == set()
+    for email in emails:
+        user = User.find_by_email(email)
+        assert user.id != old_ids[email]
+        assert User.shard_for_id(user.id) == shard_for_email(email, len(shard_engines))
+        assert User.get_by_id(user.id) is user
+        # remember cookies and sessions carry the old id
+        assert User.load_snapshot(old_ids[email]) is None
+
+
+def test_migrate_after_a_failure(app, db, shard_engines):
+    insert_unsharded_users(db, "copied@example.com")
+    shard = shard_for_email("copied@example.com", len(shard_engines))
+    # copied, but not deleted from the default database
+    with db.engine.connect() as connection:
+        rows = connection.execute(User.__table__.select()).mappings().all()
+    with shard_engines[shard].begin() as connection:
+        connection.execute(User.__table__.insert(), [dict(row) for row in rows])
+
+    assert User.move_to_shards() == (1, [])
+    assert stored_emails(db.engine) == set()
+    assert stored_emails(shard_engines[shard]) == {"copied@example.com"}
+
+
+def test_migrate_leaves_taken_emails(app, db, user_factory):
+    insert_unsharded_users(db, "Taken@example.com", "free@example.com")
+    user_id = user_factory(email="taken@example.com").id
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["shards", "migrate"])
+
+    assert result.exit_code == 1
+    assert "Left Taken@example.com in the default database" in result.output
+    assert stored_emails(db.engine) == {"Taken@example.com"}
+    assert User.find_by_email("taken@example.com").id == user_id
+    assert User.find_by_email("free@example.com")
@@ -1,5 +1,9 @@
 import pytest
 from flask import url_for
+from jinja2 import FileSystemBytecodeCache
+
+from sampleapp.app import create_app
+from sampleapp.settings import TestConfig
 
 
 def test_default_security_token_in_prod(testapp):
@@ -24,3 +28,26 @@ def test_security_token_pass_in_prod(testapp):
 def test_raise_error(testapp):
     with pytest.raises(RuntimeError):
         testapp.get(url_for("public.raise_error"))
+
+
+def test_compiled_templates_are_loaded(app, tmp_path):
+    cache_dir = str(tmp_path / "templates")
+    result = app.test_cli_runner().invoke(
+        args=["templates", "compile", "--directory", cache_dir]
+    )
+    assert result.exit_code == 0, result.output
+    assert "Compiled" in result.output
+
+    class CompiledConfig(TestConfig):
+        TEMPLATE_CACHE_DIR = cache_dir
+
+    env = create_app(CompiledConfig).jinja_env
+    assert isinstance(env.bytecode_cache, FileSystemBytecodeCache)
+    for name in ("public/home.html", "admin/model/list.html"):
+        source, filename, _ = env.loader.get_source(env, name)
+        bucket = env.bytecode_cache.get_bucket(env, name, filename, source)
+        assert bucket.code is not None
+
+
+def test_template_cache_dir_missing(app):
+    assert app.jinja_env.bytecode_cache is None
@@ -0,0 +1,88 @@
+import gzip
+import os
+
+import pytest
+from flask import url_for
+
+from sampleapp.app import create_app
+from sampleapp.assets import build
+from sampleapp.assets import hashed_name
+from sampleapp.settings import PROJECT_ROOT
+from sampleapp.settings import TestConfig
+
+STATIC_FOLDER = os.path.join(PROJECT_ROOT, "sampleapp", "static")
+STYLE = os.path.join(STATIC_FOLDER, "css", "style.css")
+
+
+@pytest.fixture(scope="module")
+def dist_dir(tmp_path_factory):
+    dist_dir = str(tmp_path_factory.mktemp("dist"))
+    build(STATIC_FOLDER, dist_dir)
+    return dist_dir
+
+
+@pytest.fixture
+def assets_app(dist_dir):
+    class AssetsConfig(TestConfig):
+        ASSETS_DIST_DIR = dist_dir
+
+    app = create_app(AssetsConfig)
+    with app.test_request_context():
+        yield app
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_build(dist_dir):
+    hashed = hashed_name("css/style.css", "0" * 64)
+    assert hashed == "css/style.000000000000.css"
+    assert os.path.exists(os.path.join(dist_dir, "manifest.json"))
+    assert read(os.path.join(dist_dir, "css", "style.css")) == read(STYLE)
+
+
+def test_url_for_uses_hashed_name(assets_app):
+    url = url_for("static", filename="css/style.css")
+    assert url.startswith("/static/css/style.")
+    assert url != "/static/css/style.css"
+    # files missing from the manifest keep their name
+    assert url_for("static", filename="missing.css") == "/static/missing.css"
+
+
+def test_url_for_without_manifest(app):
+    assert url_for("static", filename="css/style.css") == "/static/css/style.css"
+
+
+def test_serves_precompressed_immutable(assets_app):
+    # WebTest decodes gzip responses, test the raw ones
+    client = assets_app.test_client()
+    url = url_for("static", filename="vendor/bootstrap4/css/bootstrap.min.css")
+    res = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert res.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    assert "Accept-Encoding" in res.headers["Vary"]
+    assert res.mimetype == "text/css"
+    original = read(
+        os.path.join(STATIC_FOLDER, "vendor", "bootstrap4", "css", "bootstrap.min.css")
+    )
+    assert gzip.decompress(res.data) == original
+
+    res = client.get(url, headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in res.headers
+    assert res.data == original
+
+
+def test_unhashed_name_is_not_immutable(assets_app):
+    res = assets_app.test_client().get("/static/css/style.css")
+    assert res.data == read(STYLE)
+    assert "immutable" not in res.headers["Cache-Control"]
+
+
+def test_admin_css_goes_through_manifest(assets_app):
+    view = assets_app.extensions["admin"][0]._views[1]
+    (css,) = view.extra_css
+    assert css.startswith("/static/vendor/fontawesome-free-5.14.0-web/css/all.min.")
+    assert css.endswith(".css")
+    assert css != "/static/vendor/fontawesome-free-5.14.0-web/css/all.min.css"
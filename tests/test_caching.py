@@ -0,0 +1,202 @@
+import socketserver
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+from sampleapp.caching import Cache
+from sampleapp.caching.backends import FileSystemBackend
+from sampleapp.caching.backends import LRUBackend
+from sampleapp.extensions import cache as app_cache
+
+
+class MemcachedHandler(socketserver.StreamRequestHandler):
+    """Enough of the memcached text protocol for the tests."""
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, *args = line.split()
+            if command in (b"set", b"add"):
+                key, _, _, length = args
+                value = self.rfile.read(int(length) + 2)[:-2]
+                if command == b"add" and key in store:
+                    self.wfile.write(b"NOT_STORED\r\n")
+                else:
+                    store[key] = value
+                    self.wfile.write(b"STORED\r\n")
+            elif command == b"get":
+                if args[0] in store:
+                    value = store[args[0]]
+                    self.wfile.write(
+                        b"VALUE %s 0 %d\r\n%s\r\n" % (args[0], len(value), value)
+                    )
+                self.wfile.write(b"END\r\n")
+            elif command == b"delete":
+                found = store.pop(args[0], None) is not None
+                self.wfile.write(b"DELETED\r\n" if found else b"NOT_FOUND\r\n")
+            elif command == b"flush_all":
+                store.clear()
+                self.wfile.write(b"OK\r\n")
+
+
+@pytest.fixture
+def memcached_server():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), MemcachedHandler)
+    server.daemon_threads = True
+    server.store = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "%s:%s" % server.server_address
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=["simple", "shm", "filesystem", "memcached"])
+def cache(request, tmp_path):
+    app = Flask(__name__)
+    app.config.update(
+        CACHE_TYPE=request.param,
+        CACHE_THRESHOLD=3,
+        CACHE_DIR=str(tmp_path / "cache"),
+        CACHE_SHM_PATH=str(tmp_path / "shm"),
+        # keep slot collisions, which evict entries, unlikely
+        CACHE_SHM_SLOTS=65536,
+        CACHE_SHM_VALUE_SIZE=256,
+        CACHE_LOCK_TIMEOUT_SECONDS=1,
+    )
+    if request.param == "memcached":
+        app.config["CACHE_MEMCACHED_SERVERS"] = [
+            request.getfixturevalue("memcached_server")
+        ]
+    return Cache(app)
+
+
+def test_get_set_delete(cache):
+    assert cache.get("key") is None
+    cache.set("key", {"a": [1, 2]})
+    assert cache.get("key") == {"a": [1, 2]}
+    cache.set("none", None)
+    assert cache.get("none", default="missing") is None
+    cache.delete("key")
+    assert cache.get("key", default="missing") == "missing"
+
+
+def test_namespace_invalidation(cache):
+    cache.set("key", 1, namespace="users")
+    cache.set("key", 2, namespace="pages")
+    cache.invalidate("users")
+    assert cache.get("key", namespace="users") is None
+    assert cache.get("key", namespace="pages") == 2
+    cache.set("key", 3, namespace="users")
+    assert cache.get("key", namespace="users") == 3
+
+
+def test_memoize(cache):
+    calls = []
+
+    @cache.memoize()
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    assert [square(2), square(2), square(3)] == [4, 4, 9]
+    assert calls == [2, 3]
+    square.invalidate()
+    assert square(2) == 4
+    assert calls == [2, 3, 2]
+    stats = cache.stats()[f"{__name__}.test_memoize.<locals>.square"]
+    assert stats["hits"] == 1
+    assert stats["misses"] == 3
+    assert stats["hit_rate"] == 0.25
+
+
+def test_stampede_protection(cache):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.1)
+        return "value"
+
+    threads = [
+        threading.Thread(target=cache.get_or_set, args=("key", compute))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert cache.get("key") == "value"
+
+
+def test_waits_for_other_process_lock(cache):
+    full_key = cache._make_key("default", "key")
+    assert cache.backend.add(f"{full_key}:lock", b"1", 1)
+
+    def other_process():
+        time.sleep(0.1)
+        cache.set("key", "from other process")
+
+    threading.Thread(target=other_process).start()
+    assert cache.get_or_set("key", lambda: "computed") == "from other process"
+
+
+def test_ttl():
+    backend = LRUBackend(dict(CACHE_THRESHOLD=10))
+    backend.set("key", b"value", 0.05)
+    assert backend.get("key") == b"value"
+    time.sleep(0.1)
+    assert backend.get("key") is None
+    assert backend.add("key", b"new", 0)
+    assert not backend.add("key", b"newer", 0)
+
+
+def test_lru_size_bound():
+    backend = LRUBackend(dict(CACHE_THRESHOLD=2))
+    backend.set("a", b"1", 0)
+    backend.set("b", b"2", 0)
+    backend.get("a")
+    backend.set("c", b"3", 0)
+    assert backend.get("a") == b"1"
+    assert backend.get("b") is None
+
+
+def test_cached_view(app):
+    app.config["CACHE_TYPE"] = "simple"
+    cache = Cache(app)
+    calls = []
+
+    @app.route("/cached")
+    @cache.cached()
+    def cached_view():
+        calls.append(1)
+        return "hello %d" % len(calls)
+
+    client = app.test_client()
+    assert client.get("/cached").data == b"hello 1"
+    assert client.get("/cached").data == b"hello 1"
+    assert client.get("/cached?page=2").data == b"hello 2"
+    cache.invalidate("views")
+    assert client.get("/cached").data == b"hello 3"
+
+
+def test_filesystem_prune(tmp_path):
+    backend = FileSystemBackend(dict(CACHE_DIR=str(tmp_path), CACHE_THRESHOLD=2))
+    for key in ("a", "b", "c"):
+        backend.set(key, key.encode(), 0)
+        time.sleep(0.01)
+    backend.prune()
+    assert backend.get("a") is None
+    assert backend.get("c") == b"c"
+
+
+def test_extension_configured(app):
+    assert isinstance(app_cache.backend, LRUBackend)
+    app_cache.set("key", "value")
+    assert app_cache.get("key") == "value"
@@ -0,0 +1,94 @@
+import os
+
+import pytest
+from sqlalchemy import exc
+
+from sampleapp.app import create_app
+from sampleapp.database import InstrumentedQueuePool
+from sampleapp.extensions import db
+from sampleapp.settings import TestConfig
+
+
+@pytest.fixture
+def make_app():
+    apps = []
+
+    def make_app(**config):
+        app = create_app(type("DatabaseConfig", (TestConfig,), config))
+        apps.append(app)
+        return app
+
+    yield make_app
+    for app in apps:
+        db.get_engine(app).dispose()
+
+
+@pytest.fixture
+def make_engine(make_app):
+    return lambda **config: db.get_engine(make_app(**config))
+
+
+def scalar(connection, sql):
+    return connection.exec_driver_sql(sql).scalar()
+
+
+def test_pool_configured_from_settings(make_engine):
+    engine = make_engine(
+        DATABASE_POOL_SIZE=3,
+        DATABASE_MAX_OVERFLOW=2,
+        DATABASE_STATEMENT_TIMEOUT_MS=1500,
+    )
+    assert isinstance(engine.pool, InstrumentedQueuePool)
+    assert engine.pool.size() == 3
+    assert engine.pool._max_overflow == 2
+    with engine.connect() as connection:
+        assert scalar(connection, "SHOW statement_timeout") == "1500ms"
+
+
+def test_pgbouncer_sets_statement_timeout_per_transaction(make_engine):
+    engine = make_engine(DATABASE_PGBOUNCER=True, DATABASE_STATEMENT_TIMEOUT_MS=1500)
+    with engine.connect() as connection:
+        with connection.begin():
+            assert scalar(connection, "SHOW statement_timeout") == "1500ms"
+        # nothing is left on the server connection for the next client
+        assert scalar(connection, "SHOW statement_timeout") != "1500ms"
+
+
+def test_pool_stats(make_app):
+    app = make_app(
+        DATABASE_POOL_SIZE=1, DATABASE_MAX_OVERFLOW=1, DATABASE_POOL_TIMEOUT=0.1
+    )
+    engine = db.get_engine(app)
+    first = engine.connect()
+    second = engine.connect()
+    with pytest.raises(exc.TimeoutError):
+        engine.connect()
+    stats = db.pool_stats(app)[None]
+    assert stats["checked_out"] == 2
+    assert stats["overflow"] == 1
+    assert stats["checkouts"] == 3
+    assert stats["timeouts"] == 1
+    assert stats["max_wait_seconds"] >= 0.1
+    first.close()
+    second.close()
+    assert db.pool_stats(app)[None]["checked_in"] == 1
+
+
+def test_forked_process_does_not_use_parent_connections(make_engine):
+    engine = make_engine()
+    with engine.connect() as connection:
+        parent_pid = scalar(connection, "SELECT pg_backend_pid()")
+
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        try:
+            with engine.connect() as connection:
+                child_pid = scalar(connection, "SELECT pg_backend_pid()")
+            os._exit(0 if child_pid != parent_pid else 1)
+        except BaseException:
+            os._exit(2)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    # the connection of the parent survived the child
+    with engine.connect() as connection:
+        assert scalar(connection, "SELECT pg_backend_pid()") == parent_pid
@@ -0,0 +1,186 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+import pytest
+
+from sampleapp.app import create_app
+from sampleapp.errors import extract_frames
+from sampleapp.errors import fingerprint
+from sampleapp.extensions import error_reporter
+from sampleapp.settings import TestConfig
+
+
+class FakeEndpoint(HTTPServer):
+    """Local endpoint recording the payloads it receives."""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeEndpointHandler)
+        self.payloads = []
+        self.headers = []
+        self.requested = threading.Event()
+        self.open = threading.Event()
+        self.open.set()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/"
+
+    @property
+    def events(self):
+        return [event for payload in self.payloads for event in payload["events"]]
+
+
+class FakeEndpointHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.server.requested.set()
+        self.server.open.wait(5)
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.payloads.append(json.loads(body))
+        self.server.headers.append(dict(self.headers))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def endpoint():
+    server = FakeEndpoint()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.open.set()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def config(endpoint):
+    class ErrorReporterConfig(TestConfig):
+        PROPAGATE_EXCEPTIONS = False
+        ERROR_REPORTER_API_KEY = "test-key"
+        ERROR_REPORTER_URL = endpoint.url
+        ERROR_REPORTER_BURST = 2
+        ERROR_REPORTER_SAMPLES_PER_MINUTE = 0.001
+        ERROR_REPORTER_FLUSH_SECONDS = 3600
+
+    return ErrorReporterConfig
+
+
+@pytest.fixture
+def app(config):
+    _app = create_app(config)
+    ctx = _app.test_request_context()
+    ctx.push()
+    yield _app
+    ctx.pop()
+
+
+def raise_error(message):
+    raise RuntimeError(message)
+
+
+def raise_other_error(message):
+    raise RuntimeError(message)
+
+
+def capture(function, *args):
+    try:
+        function(*args)
+    except Exception as e:
+        return e
+
+
+def test_fingerprint():
+    def key(exc):
+        return fingerprint(type(exc), extract_frames(exc))
+
+    first = capture(raise_error, "first")
+    assert key(first) == key(capture(raise_error, "second"))
+    assert key(first) != key(capture(raise_other_error, "first"))
+
+
+def test_fingerprint_does_not_depend_on_install_directory():
+    frames = extract_frames(capture(raise_error, "first"))
+    assert frames[-1][2:] == ("raise_error", __name__)
+    moved = [
+        (filename.replace("/", "/releases/v2/", 1), lineno, function, module)
+        for filename, lineno, function, module in frames
+    ]
+    assert fingerprint(RuntimeError, moved) == fingerprint(RuntimeError, frames)
+
+
+def test_exception_storm_is_sampled(app, endpoint):
+    client = app.test_client()
+    for _ in range(20):
+        assert client.get("/__raise_error__").status_code == 500
+    error_reporter.flush()
+
+    first, second, summary = endpoint.events
+    assert [event["metaData"]["occurrences"]["count"] for event in endpoint.events] == [
+        1,
+        1,
+        18,
+    ]
+    assert len({event["groupingHash"] for event in endpoint.events}) == 1
+    (exception,) = first["exceptions"]
+    assert exception["errorClass"] == "RuntimeError"
+    assert exception["message"] == "failed"
+    frame = exception["stacktrace"][0]
+    assert (frame["file"], frame["method"], frame["inProject"]) == (
+        "sampleapp/blueprints/public/views.py",
+        "raise_error",
+        True,
+    )
+    assert first["context"] == "public.raise_error"
+    assert first["metaData"]["request"]["url"] == "http://localhost/__raise_error__"
+    assert endpoint.payloads[0]["apiKey"] == "test-key"
+    assert endpoint.headers[0]["Bugsnag-Api-Key"] == "test-key"
+
+
+def test_fingerprints_are_sampled_separately(app, endpoint):
+    for _ in range(3):
+        error_reporter.report(capture(raise_error, "first"))
+        error_reporter.report(capture(raise_other_error, "second"))
+    error_reporter.flush()
+
+    counts = {}
+    for event in endpoint.events:
+        message = event["exceptions"][0]["message"]
+        counts[message] = (
+            counts.get(message, 0) + event["metaData"]["occurrences"]["count"]
+        )
+    assert counts == dict(first=3, second=3)
+    assert len(endpoint.events) == 6
+
+
+def test_full_queue_drops_reports(endpoint, config):
+    class SmallQueueConfig(config):
+        ERROR_REPORTER_BURST = 100
+        ERROR_REPORTER_QUEUE_SIZE = 1
+
+    create_app(SmallQueueConfig)
+    endpoint.open.clear()
+    error_reporter.report(capture(raise_error, "first"))
+    # the thread is blocked sending the first report
+    assert endpoint.requested.wait(5)
+    for _ in range(9):
+        error_reporter.report(capture(raise_error, "next"))
+    assert error_reporter.dropped == 8
+
+    endpoint.open.set()
+    error_reporter.flush()
+    counts = [event["metaData"]["occurrences"]["count"] for event in endpoint.events]
+    assert counts == [1, 1, 8]
+
+
+def test_disabled_without_api_key(endpoint):
+    _app = create_app(TestConfig)
+    _app.config["PROPAGATE_EXCEPTIONS"] = False
+    with _app.test_request_context():
+        assert _app.test_client().get("/__raise_error__").status_code == 500
+    assert error_reporter._thread is None
+    assert endpoint.payloads == []
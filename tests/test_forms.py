@@ -14,6 +14,17 @@ class TestRegisterForm:
         assert not form.validate()
         assert "Email already registered" in form.email.errors
 
+    def test_validate_email_already_registered_different_case(self, user):
+        form = RegisterForm(
+            email=user.email.upper(),
+            password="example",
+            confirm="example",
+            agree_terms="1",
+        )
+
+        assert not form.validate()
+        assert "Email already registered" in form.email.errors
+
     @pytest.mark.parametrize(
         "invalid_password", ["Example", "eXaMpLe", "EXAMPLE", "e", "example1", "foobar"]
     )
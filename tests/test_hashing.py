@@ -0,0 +1,116 @@
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import pytest
+from flask import url_for
+
+from sampleapp.extensions import hasher
+from sampleapp.hashing import HashingPoolSaturated
+from sampleapp.hashing import PasswordHasher
+
+
+@pytest.fixture
+def host_hasher(app, tmp_path):
+    """Hasher allowing a single job on the host, inline in each process."""
+    app.config["HASHING_POOL_SIZE"] = 0
+    app.config["HASHING_HOST_SLOTS"] = 1
+    app.config["HASHING_SHM_PATH"] = str(tmp_path / "hashing")
+    _hasher = PasswordHasher(app)
+    _hasher.rounds = 14
+    yield _hasher
+    _hasher.shutdown()
+
+
+def start_hashing_process(hasher):
+    """Hash a password in another process, return it once its job runs."""
+    process = multiprocessing.get_context("fork").Process(
+        target=hasher.generate_password_hash, args=("a",)
+    )
+    process.start()
+    deadline = time.monotonic() + 5
+    while not hasher._host_slots.in_flight():
+        assert time.monotonic() < deadline, "the hashing process did not start"
+        time.sleep(0.01)
+    return process
+
+
+@pytest.fixture
+def pool_hasher(app):
+    app.config["HASHING_POOL_SIZE"] = 1
+    app.config["HASHING_QUEUE_SIZE"] = 0
+    _hasher = PasswordHasher(app)
+    yield _hasher
+    _hasher.shutdown()
+
+
+def test_inline_hashing(app):
+    pw_hash = hasher.generate_password_hash("secret")
+    assert hasher.check_password_hash(pw_hash, "secret")
+    assert not hasher.check_password_hash(pw_hash, "Secret")
+    assert not hasher.check_password_hash(None, "secret")
+
+
+def test_pool_hashing(pool_hasher):
+    pw_hash = pool_hasher.generate_password_hash("secret")
+    assert pool_hasher.check_password_hash(pw_hash, "secret")
+    assert not pool_hasher.check_password_hash(pw_hash, "secret1")
+    stats = pool_hasher.stats()
+    assert stats["completed"] == 3
+    assert stats["in_flight"] == 0
+    assert stats["total_seconds"] > 0
+
+
+def test_pool_saturated(pool_hasher):
+    pool_hasher.rounds = 12
+    worker = threading.Thread(target=pool_hasher.generate_password_hash, args=("a",))
+    worker.start()
+    time.sleep(0.05)
+    with pytest.raises(HashingPoolSaturated):
+        pool_hasher.generate_password_hash("b")
+    worker.join()
+    assert pool_hasher.stats()["rejected"] == 1
+
+
+def test_host_saturated(host_hasher):
+    process = start_hashing_process(host_hasher)
+    with pytest.raises(HashingPoolSaturated):
+        host_hasher.generate_password_hash("b")
+    process.join()
+    assert process.exitcode == 0
+    assert host_hasher._host_slots.in_flight() == 0
+    host_hasher.rounds = 4
+    assert host_hasher.generate_password_hash("b")
+    assert host_hasher.stats()["rejected"] == 1
+
+
+def test_host_slots_of_exited_workers_are_dropped(host_hasher):
+    process = start_hashing_process(host_hasher)
+    os.kill(process.pid, signal.SIGKILL)
+    process.join()
+    host_hasher.rounds = 4
+    assert host_hasher.generate_password_hash("b")
+    assert host_hasher._host_slots.in_flight() == 0
+
+
+def test_pool_timeout(pool_hasher):
+    pool_hasher.rounds = 12
+    pool_hasher.timeout = 0.01
+    with pytest.raises(HashingPoolSaturated):
+        pool_hasher.generate_password_hash("secret")
+    assert pool_hasher.stats()["timeouts"] == 1
+
+
+def test_login_when_pool_saturated(testapp, user, default_password, monkeypatch):
+    def saturated(*args, **kwargs):
+        raise HashingPoolSaturated()
+
+    monkeypatch.setattr(hasher, "check_password_hash", saturated)
+    res = testapp.get(url_for("public.login"))
+    form = res.form
+    form["email"] = user.email
+    form["password"] = default_password
+    res = form.submit(status=503)
+    assert "We are receiving too many requests" in res
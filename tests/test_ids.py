@@ -0,0 +1,52 @@
+import time
+import uuid
+
+from sqlalchemy import event
+from sqlalchemy import text
+
+from sampleapp.models.accounts import User
+from sampleapp.models.base import uuid7
+
+
+def timestamp_ms(value):
+    return value.int >> 80
+
+
+def test_uuid7_layout():
+    before = time.time_ns() // 1_000_000
+    value = uuid7()
+    after = time.time_ns() // 1_000_000
+    assert value.version == 7
+    assert value.variant == uuid.RFC_4122
+    assert before <= timestamp_ms(value) <= after + 1
+
+
+def test_uuid7_is_ordered_within_a_millisecond():
+    values = [uuid7() for _ in range(10_000)]
+    assert values == sorted(values)
+    assert len(set(values)) == len(values)
+
+
+def test_server_default_is_uuid7(db):
+    value = db.session.execute(text("SELECT uuid_generate_v7()")).scalar()
+    assert value.version == 7
+    assert value.variant == uuid.RFC_4122
+    assert abs(timestamp_ms(value) - time.time() * 1000) < 60_000
+
+
+def test_user_id_is_generated_before_insert(db):
+    statements = []
+
+    @event.listens_for(db.engine, "before_cursor_execute")
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    try:
+        user = User(email="foo@example.com")
+        db.session.add(user)
+        db.session.flush()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+    assert user.id.version == 7
+    (insert,) = [sql for sql in statements if sql.startswith("INSERT INTO users")]
+    assert "RETURNING" not in insert
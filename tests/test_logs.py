@@ -0,0 +1,150 @@
+import io
+import json
+import logging
+import queue
+import sys
+
+import pytest
+from flask import url_for
+
+from sampleapp.app import create_app
+from sampleapp.extensions import hasher
+from sampleapp.extensions import logs as _logs
+from sampleapp.logs import DroppingQueueHandler
+from sampleapp.logs import DropReportingListener
+from sampleapp.logs import JsonFormatter
+from sampleapp.settings import TestConfig
+
+
+@pytest.fixture
+def app():
+    class LoggingConfig(TestConfig):
+        LOGGING_ENABLED = True
+
+    _app = create_app(LoggingConfig)
+    ctx = _app.test_request_context()
+    ctx.push()
+
+    @_app.route("/hash")
+    def hash_view():
+        logging.getLogger("sampleapp.tests").warning("hashing %s", "password")
+        hasher.generate_password_hash("password")
+        return "hashed"
+
+    @_app.route("/fail")
+    def fail_view():
+        raise ValueError("failed")
+
+    yield _app
+    ctx.pop()
+
+
+@pytest.fixture
+def logs(app):
+    _logs.handler.setStream(io.StringIO())
+    yield _logs
+    _logs.stop()
+
+
+def records(logs):
+    """Stop the listener and return the records it wrote."""
+    logs.stop()
+    return [json.loads(line) for line in logs.handler.stream.getvalue().splitlines()]
+
+
+def make_record(message, **extra):
+    return logging.makeLogRecord(
+        dict(name="test", levelno=logging.INFO, levelname="INFO", msg=message, **extra)
+    )
+
+
+def test_json_formatter():
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = make_record("user %s", args=("joe",), exc_info=sys.exc_info(), count=3)
+
+    fields = json.loads(JsonFormatter().format(record))
+    assert fields["logger"] == "test"
+    assert fields["message"] == "user joe"
+    assert fields["count"] == 3
+    assert fields["time"].endswith("Z")
+    assert "ValueError: boom" in fields["exception"]
+
+
+def test_full_queue_drops_oldest_records():
+    handler = DroppingQueueHandler(queue.Queue(2))
+    for index in range(5):
+        handler.handle(make_record(f"record {index}"))
+    assert handler.dropped == 3
+
+    stream = io.StringIO()
+    target = logging.StreamHandler(stream)
+    listener = DropReportingListener(handler, target)
+    listener.start()
+    listener.stop()
+    assert stream.getvalue().splitlines() == [
+        "3 log records dropped, the log queue is full",
+        "record 3",
+        "record 4",
+    ]
+
+
+def test_access_record(app, logs):
+    res = app.test_client().get("/hash?next=1", headers={"X-Request-Id": "abc-123"})
+    assert res.headers["X-Request-Id"] == "abc-123"
+
+    warning, access = [
+        record for record in records(logs) if record["logger"].startswith("sampleapp.")
+    ]
+    assert warning["message"] == "hashing password"
+    assert warning["request_id"] == "abc-123"
+    assert warning["endpoint"] == "hash_view"
+    assert warning["user_id"] is None
+
+    assert access["logger"] == "sampleapp.access"
+    assert access["request_id"] == "abc-123"
+    assert access["method"] == "GET"
+    assert access["path"] == "/hash?next=1"
+    assert access["status"] == 200
+    assert access["bytes"] == len(b"hashed")
+    assert access["bcrypt_ms"] > 0
+    assert access["duration_ms"] >= access["bcrypt_ms"]
+    assert access["message"].startswith("GET /hash?next=1 200 ")
+
+
+def test_generates_request_ids(app, logs):
+    client = app.test_client()
+    first = client.get("/hash", headers={"X-Request-Id": "not valid"})
+    second = client.get("/hash")
+    assert len(first.headers["X-Request-Id"]) == 32
+    assert first.headers["X-Request-Id"] != second.headers["X-Request-Id"]
+
+
+def test_access_record_of_failed_request(app, logs):
+    app.config["PROPAGATE_EXCEPTIONS"] = False
+    app.test_client().get("/fail")
+
+    error, access = [
+        record for record in records(logs) if record["logger"].startswith("sampleapp")
+    ]
+    assert "ValueError: failed" in error["exception"]
+    assert error["request_id"] == access["request_id"]
+    assert access["status"] == 500
+
+
+def test_logs_of_logged_in_user(testapp, logs, user, default_password):
+    res = testapp.get(url_for("public.login"))
+    res.form["email"] = user.email
+    res.form["password"] = default_password
+    res.form.submit().follow()
+    testapp.get("/hash")
+    access = records(logs)[-1]
+    assert access["path"] == "/hash"
+    assert access["user_id"] == str(user.id)
+
+
+def test_disabled(logs):
+    create_app(TestConfig)
+    assert _logs.listener is None
+    assert _logs.queue_handler not in logging.getLogger().handlers
@@ -0,0 +1,116 @@
+import datetime
+
+from flask_mail import Message
+from freezegun import freeze_time
+
+from sampleapp.extensions import db
+from sampleapp.extensions import mail
+from sampleapp.mailer import purge_outbox
+from sampleapp.mailer import queue_mail
+from sampleapp.mailer import run_worker
+from sampleapp.mailer import send_pending
+from sampleapp.models.mail import OutboxMessage
+
+
+def make_message(subject="Hello"):
+    return Message(
+        subject, sender="test@example.com", recipients=["user@example.com"], body="Hi"
+    )
+
+
+def test_queue_mail_sends_after_commit(db):
+    with mail.record_messages() as outbox:
+        queue_mail(make_message())
+        assert not outbox
+        db.session.commit()
+        assert send_pending() == (1, 0)
+        assert send_pending() == (0, 0)
+    assert len(outbox) == 1
+    assert outbox[0].subject == "Hello"
+    assert outbox[0].recipients == ["user@example.com"]
+    record = OutboxMessage.query.one()
+    assert record.sent_at is not None
+    assert record.attempts == 1
+
+
+def test_rolled_back_mail_is_not_sent(db):
+    queue_mail(make_message())
+    db.session.rollback()
+    with mail.record_messages() as outbox:
+        assert send_pending() == (0, 0)
+    assert not outbox
+
+
+def test_retry_with_backoff(app, db, monkeypatch):
+    app.config["MAIL_OUTBOX_RETRY_BASE_SECONDS"] = 10
+    app.config["MAIL_OUTBOX_MAX_ATTEMPTS"] = 2
+    queue_mail(make_message())
+    db.session.commit()
+    now = OutboxMessage.query.one().next_attempt_at
+
+    def fail(self, message):
+        raise ConnectionError("boom")
+
+    monkeypatch.setattr("flask_mail.Connection.send", fail)
+    with freeze_time(now):
+        assert send_pending() == (0, 1)
+    record = OutboxMessage.query.one()
+    assert record.attempts == 1
+    assert "boom" in record.last_error
+    assert record.next_attempt_at == now + datetime.timedelta(seconds=10)
+
+    with freeze_time(now + datetime.timedelta(seconds=9)):
+        assert send_pending() == (0, 0)
+    with freeze_time(now + datetime.timedelta(seconds=10)):
+        assert send_pending() == (0, 1)
+    # Give up after MAIL_OUTBOX_MAX_ATTEMPTS
+    record = OutboxMessage.query.one()
+    assert record.attempts == 2
+    assert record.failed_at == now + datetime.timedelta(seconds=10)
+    with freeze_time(now + datetime.timedelta(days=1)):
+        assert send_pending() == (0, 0)
+
+
+def test_purge_outbox(app, db):
+    app.config["MAIL_OUTBOX_RETENTION_DAYS"] = 7
+    now = datetime.datetime.utcnow()
+    for subject, sent_at, failed_at in [
+        ("Old sent", now - datetime.timedelta(days=8), None),
+        ("Old failed", None, now - datetime.timedelta(days=8)),
+        ("Recent sent", now - datetime.timedelta(days=6), None),
+        ("Pending", None, None),
+    ]:
+        record = queue_mail(make_message(subject))
+        record.created_at = now - datetime.timedelta(days=30)
+        record.sent_at = sent_at
+        record.failed_at = failed_at
+    db.session.commit()
+
+    assert purge_outbox() == 2
+    assert sorted(record.subject for record in OutboxMessage.query) == [
+        "Pending",
+        "Recent sent",
+    ]
+
+
+def test_skip_locked_rows(db):
+    queue_mail(make_message("Locked"))
+    db.session.commit()
+    with db.engine.connect() as other:
+        transaction = other.begin()
+        other.execute("SELECT id FROM mail_outbox FOR UPDATE")
+        with mail.record_messages() as outbox:
+            assert send_pending() == (0, 0)
+        transaction.rollback()
+    assert not outbox
+
+
+def test_run_worker_once(db):
+    for i in range(5):
+        queue_mail(make_message(f"Hello {i}"))
+    db.session.commit()
+    with mail.record_messages() as outbox:
+        run_worker(batch_size=2, once=True)
+    assert sorted(message.subject for message in outbox) == [
+        f"Hello {i}" for i in range(5)
+    ]
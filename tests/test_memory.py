@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+
+import pytest
+
+from sampleapp.app import create_app
+from sampleapp.extensions import memory as _memory
+from sampleapp.settings import TestConfig
+
+leaked = []
+
+
+@pytest.fixture
+def app(tmp_path):
+    class MemoryConfig(TestConfig):
+        MEMORY_TRACKING_ENABLED = True
+        MEMORY_DIR = str(tmp_path)
+        MEMORY_SNAPSHOT_SECONDS = 3600
+
+    _app = create_app(MemoryConfig)
+
+    @_app.route("/leak")
+    def leak_view():
+        leaked.append([object() for _ in range(1000)])
+        return "leaked"
+
+    @_app.route("/noop")
+    def noop_view():
+        return "done"
+
+    return _app
+
+
+@pytest.fixture
+def memory(app):
+    yield _memory
+    _memory.stop()
+    leaked.clear()
+
+
+def test_tracks_worker_on_first_request(app, memory):
+    assert not memory.tracking
+    app.test_client().get("/noop")
+    assert memory.tracking
+
+
+def test_reports_growing_allocation_sites(app, memory):
+    client = app.test_client()
+    # the first requests start tracking and warm caches up
+    client.get("/noop")
+    client.get("/leak")
+    before = memory.snapshot()
+    for _ in range(5):
+        client.get("/leak")
+        client.get("/noop")
+
+    report = memory.snapshot()
+    assert report["pid"] == os.getpid()
+    assert report["snapshots"] == 2
+    assert report["rss_bytes"] > report["traced_bytes"] > 0
+    top = report["growers_since_last"][0]
+    assert top["traceback"][-1].startswith(f"{__file__}:")
+    assert top["count_diff"] >= 5000
+    assert report["growers_since_start"][0]["count_diff"] >= 6000
+
+    def retained(endpoint):
+        requests, retained_bytes = (
+            report["endpoints"][endpoint][name] - before["endpoints"][endpoint][name]
+            for name in ("requests", "retained_bytes")
+        )
+        assert requests == 5
+        return retained_bytes
+
+    leak = retained("leak_view")
+    assert leak >= 5 * 1000 * 16
+    assert report["endpoints"]["leak_view"]["max_retained_bytes"] >= 1000 * 16
+    assert retained("noop_view") < leak / 10
+    assert memory.reports() == [report]
+
+
+def test_requests_end_while_taking_a_snapshot(app, memory, monkeypatch):
+    client = app.test_client()
+    client.get("/noop")
+    taking, release = threading.Event(), threading.Event()
+    take_snapshot = memory._take_snapshot
+
+    def slow_snapshot():
+        taking.set()
+        release.wait(10)
+        return take_snapshot()
+
+    monkeypatch.setattr(memory, "_take_snapshot", slow_snapshot)
+    snapshot = threading.Thread(target=memory.snapshot)
+    snapshot.start()
+    try:
+        assert taking.wait(10)
+        request = threading.Thread(target=client.get, args=("/noop",))
+        request.start()
+        request.join(2)
+        assert not request.is_alive()
+    finally:
+        release.set()
+        snapshot.join()
+    assert memory.reports()[0]["endpoints"]["noop_view"]["requests"] == 2
+
+
+def test_reports_of_exited_workers_are_deleted(app, memory):
+    path = os.path.join(memory.directory, "worker-999999999.json")
+    with open(path, "w") as f:
+        json.dump(dict(pid=999999999), f)
+    assert memory.reports() == []
+    assert not os.path.exists(path)
+
+
+def test_not_tracking_when_disabled(memory):
+    create_app(TestConfig).test_client().get("/")
+    assert not memory.tracking
+    assert memory.reports() == []
+
+
+def test_report_command(app, memory):
+    client = app.test_client()
+    client.get("/noop")
+    client.get("/leak")
+    memory.snapshot()
+
+    result = app.test_cli_runner().invoke(args=["memory", "report", "--top", "3"])
+    assert result.exit_code == 0, result.output
+    lines = result.output.splitlines()
+    assert lines[0].startswith(f"Worker {os.getpid()}: ")
+    assert f"{__file__}:" in lines[1]
+    assert "1 requests  leak_view" in result.output
+
+
+def test_report_command_without_reports(app, memory):
+    result = app.test_cli_runner().invoke(args=["memory", "report"])
+    assert result.output == f"No worker reported in {memory.directory}\n"
@@ -0,0 +1,111 @@
+import json
+import multiprocessing
+import os
+
+import pytest
+
+from sampleapp.metrics import ARCHIVE_FILE
+from sampleapp.metrics import Counter
+from sampleapp.metrics import Gauge
+from sampleapp.metrics import Histogram
+from sampleapp.metrics import Metrics
+from sampleapp.metrics import read_values
+from sampleapp.metrics import ValueFile
+
+HITS = Counter("test_hits_total", "Hits.", ("page",))
+SIZE = Gauge("test_size", "Size.")
+
+
+@pytest.fixture
+def metrics(tmp_path, monkeypatch):
+    monkeypatch.setattr("sampleapp.metrics.METRICS", {HITS.name: HITS, SIZE.name: SIZE})
+    _metrics = Metrics()
+    _metrics.directory = str(tmp_path)
+    yield _metrics
+    _metrics.close()
+
+
+def test_value_file_grows_and_reopens(tmp_path):
+    path = str(tmp_path / "values.db")
+    values = ValueFile(path)
+    keys = [f"key-{i}" * 10 for i in range(2000)]
+    for key in keys:
+        values.add(key, 1)
+        values.add(key, 0.5)
+    values.set("gauge", 3)
+    assert values.get(keys[0]) == 1.5
+    assert os.path.getsize(path) > ValueFile.initial_size
+    values.close()
+
+    stored = read_values(path)
+    assert len(stored) == len(keys) + 1
+    assert stored[keys[-1]] == 1.5
+    values = ValueFile(path)
+    values.add(keys[-1], 1)
+    assert values.get(keys[-1]) == 2.5
+    values.close()
+
+
+def test_histogram_exposition(metrics):
+    latency = Histogram("test_seconds", "Latency.", ("page",), (0.1, 1))
+    for value in (0.05, 0.1, 0.5, 5):
+        latency.observe(metrics.values, value, page="home")
+    samples = []
+    for key, value in read_values(metrics.values.path).items():
+        _, suffix, labels = json.loads(key)
+        samples.append((suffix, labels, value))
+    assert latency.expose(samples) == [
+        "# HELP test_seconds Latency.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{le="0.1",page="home"} 2',
+        'test_seconds_bucket{le="1",page="home"} 3',
+        'test_seconds_bucket{le="+Inf",page="home"} 4',
+        'test_seconds_sum{page="home"} 5.65',
+        'test_seconds_count{page="home"} 4',
+    ]
+
+
+def record_in_child(metrics):
+    HITS.inc(metrics.values, page="home")
+    SIZE.set(metrics.values, 7)
+
+
+def set_in_child(metrics):
+    HITS.set(metrics.values, 5, page="home")
+
+
+def test_collects_all_workers(metrics):
+    HITS.inc(metrics.values, 2, page="home")
+    SIZE.set(metrics.values, 1)
+    child = multiprocessing.get_context("fork").Process(
+        target=record_in_child, args=(metrics,)
+    )
+    child.start()
+    child.join()
+    assert sorted(os.listdir(metrics.directory)) == [
+        f"worker-{os.getpid()}.db",
+        f"worker-{child.pid}.db",
+    ]
+
+    samples = metrics.collect()
+    # the exited worker is archived, without its gauges
+    assert samples[HITS.name] == [("", {"page": "home"}, 3)]
+    assert samples[SIZE.name] == [("", {}, 1)]
+    assert not os.path.exists(os.path.join(metrics.directory, f"worker-{child.pid}.db"))
+    assert os.path.exists(os.path.join(metrics.directory, ARCHIVE_FILE))
+
+    HITS.inc(metrics.values, page="home")
+    assert metrics.collect()[HITS.name] == [("", {"page": "home"}, 4)]
+
+
+def test_set_counters_of_exited_workers_are_archived(metrics):
+    HITS.set(metrics.values, 2, page="home")
+    HITS.set(metrics.values, 3, page="home")
+    child = multiprocessing.get_context("fork").Process(
+        target=set_in_child, args=(metrics,)
+    )
+    child.start()
+    child.join()
+    assert metrics.collect()[HITS.name] == [("", {"page": "home"}, 8)]
+    HITS.set(metrics.values, 4, page="home")
+    assert metrics.collect()[HITS.name] == [("", {"page": "home"}, 9)]
@@ -0,0 +1,115 @@
+import sys
+import time
+
+import pytest
+
+from sampleapp.app import create_app
+from sampleapp.extensions import profiler as _profiler
+from sampleapp.profiling import collapse
+from sampleapp.profiling import flame_graph
+from sampleapp.settings import TestConfig
+
+
+@pytest.fixture
+def app(tmp_path):
+    class ProfilerConfig(TestConfig):
+        PROFILER_ENABLED = True
+        PROFILER_DIR = str(tmp_path)
+        PROFILER_INTERVAL_MS = 1
+        PROFILER_KEEP = 2
+
+    _app = create_app(ProfilerConfig)
+
+    @_app.route("/slow")
+    def slow_view():
+        time.sleep(0.1)
+        return "done"
+
+    return _app
+
+
+@pytest.fixture
+def profiler(app):
+    yield _profiler
+    _profiler.stop()
+    if _profiler._sampler is not None:
+        _profiler._sampler.join()
+
+
+def profile_requests(app, profiler, fraction=1.0, requests=1):
+    profile_id = profiler.start(5, fraction)
+    client = app.test_client()
+    for _ in range(requests):
+        client.get("/slow")
+    profiler.stop()
+    if profiler._sampler is not None:
+        profiler._sampler.join()
+    return profile_id
+
+
+def test_collapse():
+    def inner():
+        return collapse(sys._getframe())
+
+    stack = inner().split(";")
+    assert stack[-2:] == [f"{__name__}:test_collapse", f"{__name__}:inner"]
+
+
+def test_flame_graph():
+    frames = flame_graph({"a;b": 3, "a;c": 1, "d": 996})
+    assert [(f["name"], f["depth"], f["samples"]) for f in frames] == [
+        ("a", 0, 4),
+        ("d", 0, 996),
+        ("b", 1, 3),
+        ("c", 1, 1),
+    ]
+    assert frames[1]["left"] == pytest.approx(0.004)
+    assert frames[3]["left"] == pytest.approx(0.003)
+    # frames under min_fraction are left out
+    assert [f["name"] for f in flame_graph({"a;b": 3, "a;c": 1, "d": 996}, 0.002)] == [
+        "a",
+        "d",
+        "b",
+    ]
+
+
+def test_samples_requests(app, profiler):
+    profile_id = profile_requests(app, profiler)
+    samples = profiler.samples(profile_id)
+    assert sum(samples.values()) > 10
+    assert any("tests.test_profiling:slow_view" in stack for stack in samples)
+    profile = profiler.profile(profile_id)
+    assert profile["workers"] == 1
+    assert not profile["running"]
+
+
+def test_samples_fraction_of_requests(app, profiler, monkeypatch):
+    monkeypatch.setattr("random.random", lambda: 0.5)
+    profile_id = profile_requests(app, profiler, fraction=0.4)
+    assert profiler.profile(profile_id)["workers"] == 0
+    profile_id = profile_requests(app, profiler, fraction=0.6)
+    assert profiler.samples(profile_id)
+
+
+def test_costs_nothing_when_off(app, profiler):
+    app.test_client().get("/slow")
+    assert profiler.control() is None
+    assert profiler._sampler is None
+
+
+def test_keeps_last_profiles(app, profiler):
+    first = profiler.start(1)
+    profiler.start(1)
+    profiler.start(1)
+    assert profiler.profile(first) is None
+    assert len(profiler.profiles()) == 2
+
+
+def test_rejects_invalid_profiles(app, profiler):
+    with pytest.raises(ValueError):
+        profiler.start(0)
+    with pytest.raises(ValueError):
+        profiler.start(profiler.max_seconds + 1)
+    with pytest.raises(ValueError):
+        profiler.start(1, fraction=0)
+    assert profiler.profile("../etc") is None
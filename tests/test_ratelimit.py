@@ -0,0 +1,122 @@
+import multiprocessing
+
+import pytest
+from flask import url_for
+
+from sampleapp.extensions import limiter
+from sampleapp.ratelimit import MemoryBackend
+from sampleapp.ratelimit import SharedMemoryBackend
+from sampleapp.shm import SharedTable
+from sampleapp.utils import client_ip
+
+
+@pytest.fixture(params=["memory", "shm"])
+def backend(request, tmp_path):
+    config = dict(
+        RATELIMIT_SHM_PATH=str(tmp_path / "ratelimit"), RATELIMIT_SHM_SLOTS=64
+    )
+    if request.param == "memory":
+        return MemoryBackend(config)
+    return SharedMemoryBackend(config)
+
+
+def test_token_bucket(backend):
+    # 1 token per second, burst of 3
+    assert [backend.take("key", 1, 3, 100) for _ in range(4)] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+    assert not backend.take("key", 1, 3, 100.5)
+    assert backend.take("key", 1, 3, 101.5)
+    assert not backend.take("key", 1, 3, 101.5)
+    # other keys have their own bucket
+    assert backend.take("other", 1, 3, 101.5)
+    # refill never exceeds the burst
+    assert [backend.take("key", 1, 3, 1000) for _ in range(4)] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+    backend.clear()
+    assert backend.take("key", 1, 3, 1000)
+
+
+def _take_all(path):
+    backend = SharedMemoryBackend(dict(RATELIMIT_SHM_PATH=path, RATELIMIT_SHM_SLOTS=64))
+    for _ in range(5):
+        backend.take("key", 0, 5, 100)
+
+
+def test_shared_between_processes(tmp_path):
+    path = str(tmp_path / "ratelimit")
+    backend = SharedMemoryBackend(dict(RATELIMIT_SHM_PATH=path, RATELIMIT_SHM_SLOTS=64))
+    process = multiprocessing.get_context("fork").Process(
+        target=_take_all, args=(path,)
+    )
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert not backend.take("key", 0, 5, 100)
+
+
+def test_shared_table(tmp_path):
+    table = SharedTable(str(tmp_path / "table"), slots=8, payload_size=16)
+    assert table.get("a") is None
+    table.set("a", b"hello")
+    assert table.get("a") == b"hello"
+    assert table.update("a", lambda payload: payload + b"!") == b"hello!"
+    assert table.get("a") == b"hello!"
+    table.delete("a")
+    assert table.get("a") is None
+    with pytest.raises(ValueError):
+        table.set("a", b"x" * 17)
+
+
+def test_client_ip(app):
+    app.config["TRUSTED_PROXY_COUNT"] = 1
+    with app.test_request_context(
+        headers={"X-Forwarded-For": "10.0.0.1, 203.0.113.7"},
+        environ_base={"REMOTE_ADDR": "127.0.0.1"},
+    ):
+        assert client_ip() == "203.0.113.7"
+    app.config["TRUSTED_PROXY_COUNT"] = 0
+    with app.test_request_context(
+        headers={"X-Forwarded-For": "10.0.0.1, 203.0.113.7"},
+        environ_base={"REMOTE_ADDR": "127.0.0.1"},
+    ):
+        assert client_ip() == "127.0.0.1"
+
+
+def submit_login(testapp, email, password, ip, status="*"):
+    return testapp.post(
+        url_for("public.login"),
+        dict(email=email, password=password),
+        headers={"X-Forwarded-For": ip},
+        status=status,
+    )
+
+
+def test_login_rate_limited_per_ip(testapp, user, default_password):
+    testapp.app.config["LOGIN_RATELIMIT_IP_BURST"] = 2
+    for i in range(2):
+        submit_login(testapp, f"user{i}@example.com", "wrong", "203.0.113.7")
+    submit_login(testapp, user.email, default_password, "203.0.113.7", status=429)
+    submit_login(testapp, user.email, default_password, "203.0.113.8", status=302)
+
+
+def test_login_rate_limited_per_email(testapp, user, default_password):
+    testapp.app.config["LOGIN_RATELIMIT_EMAIL_BURST"] = 2
+    for i in range(2):
+        submit_login(testapp, user.email, "wrong", f"203.0.113.{i}")
+    res = submit_login(testapp, user.email.upper(), default_password, "203.0.113.9")
+    assert res.status_code == 429
+    assert "too many attempts" in res
+
+
+def test_login_rate_limit_disabled(testapp, user):
+    testapp.app.config["LOGIN_RATELIMIT_IP_BURST"] = 0
+    limiter.enabled = False
+    submit_login(testapp, user.email, "wrong", "203.0.113.7", status=200)
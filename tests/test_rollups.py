@@ -0,0 +1,97 @@
+import datetime
+
+from sampleapp.models.accounts import User
+from sampleapp.models.stats import UserDailyStats
+
+DAY = datetime.datetime(2020, 1, 1, 12)
+
+
+def summary(day=DAY):
+    return UserDailyStats.summary(days=2, today=day.date())
+
+
+def totals(stats):
+    return (stats["users"], stats["active_users"], stats["admin_users"])
+
+
+def test_new_users_are_rolled_up(db, user_factory):
+    user_factory(created_at=DAY)
+    user_factory(created_at=DAY, is_admin=True)
+    user_factory(created_at=DAY - datetime.timedelta(days=1), is_active=False)
+    stats = summary()
+    assert totals(stats) == (3, 2, 1)
+    assert stats["inactive_users"] == 1
+    assert [row["signups"] for row in stats["days"]] == [2, 1]
+
+
+def test_edits_are_rolled_up(db, user_factory):
+    user = user_factory(created_at=DAY)
+    user.is_active = False
+    user.is_admin = True
+    db.session.commit()
+    assert totals(summary()) == (1, 0, 1)
+    # unchanged flags are not counted twice
+    user.is_active = False
+    db.session.commit()
+    assert totals(summary()) == (1, 0, 1)
+    db.session.delete(user)
+    db.session.commit()
+    assert totals(summary()) == (0, 0, 0)
+
+
+def test_rolled_back_changes_are_not_counted(db, user_factory):
+    user = user_factory(created_at=DAY)
+    user.is_active = False
+    db.session.flush()
+    db.session.rollback()
+    assert totals(summary()) == (1, 1, 0)
+
+
+def test_bulk_updates_are_rolled_up(db, user_factory):
+    users = [user_factory(created_at=DAY), user_factory(created_at=DAY, is_admin=True)]
+    ids = [user.id for user in users]
+    # only the users actually changed are updated
+    assert User.update_many(ids, dict(is_active=True)) == []
+    User.update_many(ids, dict(is_active=False))
+    User.update_many(ids, dict(is_admin=~User.__table__.c.is_admin))
+    db.session.commit()
+    assert totals(summary()) == (2, 0, 1)
+
+
+def test_password_resets_are_rolled_up(db, user):
+    user.set_password("new password")
+    user.reset_password_at = DAY
+    db.session.commit()
+    assert summary()["days"][0]["password_resets"] == 1
+    # other changes of reset_password_at are not resets
+    user.reset_password_at = DAY
+    user.reset_password_at = DAY + datetime.timedelta(hours=1)
+    db.session.commit()
+    assert summary()["days"][0]["password_resets"] == 1
+
+
+def test_rebuild(db, user_factory):
+    user_factory(created_at=DAY, is_admin=True)
+    user = user_factory(created_at=DAY)
+    user.set_password("new password")
+    user.reset_password_at = DAY
+    db.session.commit()
+    db.session.execute(
+        "UPDATE users SET is_active = false; "
+        "INSERT INTO user_daily_stats (day, signups) VALUES ('2019-01-01', 5)"
+    )
+    UserDailyStats.rebuild()
+    db.session.commit()
+    stats = UserDailyStats.summary(days=400, today=DAY.date())
+    assert totals(stats) == (2, 0, 1)
+    assert stats["days"][0] == dict(day=DAY.date(), signups=2, password_resets=1)
+    assert UserDailyStats.query.count() == 1
+
+
+def test_rollups_rebuild_command(app, db, user):
+    db.session.execute("DELETE FROM user_daily_stats")
+    db.session.commit()
+    result = app.test_cli_runner().invoke(args=["rollups", "rebuild"])
+    assert result.exit_code == 0
+    assert "User rollups rebuilt" in result.output
+    assert UserDailyStats.summary()["users"] == 1
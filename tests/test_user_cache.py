@@ -0,0 +1,129 @@
+import pytest
+from flask import url_for
+from sqlalchemy import text
+
+from sampleapp.app import load_user
+from sampleapp.extensions import cache as app_cache
+from sampleapp.extensions import user_cache
+from sampleapp.models.accounts import UserSnapshot
+from sampleapp.user_cache import UserCache
+
+
+@pytest.fixture
+def cache(app):
+    app.config["USER_CACHE_TTL_SECONDS"] = 60
+    app.config["USER_CACHE_MAX_SIZE"] = 2
+    return UserCache(app)
+
+
+@pytest.fixture
+def shared_app_cache(app, tmp_path):
+    app.config["CACHE_TYPE"] = "shm"
+    app.config["CACHE_SHM_PATH"] = str(tmp_path / "cache")
+    app_cache.init_app(app)
+    return app_cache
+
+
+def test_cache_hit_and_miss(cache):
+    loaded = []
+
+    def loader(user_id):
+        loaded.append(user_id)
+        return user_id * 2
+
+    assert cache.get(1, loader) == 2
+    assert cache.get(1, loader) == 2
+    assert loaded == [1]
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+
+
+def test_cache_lru_eviction(cache):
+    for key in (1, 2, 1, 3):
+        cache.get(key, str)
+    assert cache.stats()["evictions"] == 1
+    assert cache.get(1, lambda key: "reloaded") == "1"
+    assert cache.get(2, lambda key: "reloaded") == "reloaded"
+
+
+def test_cache_does_not_store_none(cache):
+    assert cache.get(1, lambda key: None) is None
+    assert cache.get(1, str) == "1"
+
+
+def test_invalidate_reaches_other_workers(app, shared_app_cache):
+    worker, other_worker = UserCache(app), UserCache(app)
+    worker.max_size = other_worker.max_size = 2
+    worker.ttl = other_worker.ttl = 60
+    assert worker.get(1, lambda key: "loaded") == "loaded"
+    assert worker.get(1, lambda key: "reloaded") == "loaded"
+    other_worker.invalidate(1)
+    assert worker.get(1, lambda key: "reloaded") == "reloaded"
+    assert worker.get(1, lambda key: "reloaded again") == "reloaded"
+
+
+def test_evicted_generations_reload(app, shared_app_cache):
+    worker = UserCache(app)
+    worker.max_size = 2
+    worker.ttl = 60
+    assert worker.get(1, lambda key: "loaded") == "loaded"
+    shared_app_cache.clear()
+    assert worker.get(1, lambda key: "reloaded") == "reloaded"
+
+
+def test_admin_pages_load_users_from_the_database(app, db, user):
+    assert not load_user(str(user.id)).is_admin
+    # as if another worker had made the change
+    db.session.execute(
+        text("UPDATE users SET is_admin = true WHERE id = :id"), dict(id=user.id)
+    )
+    db.session.commit()
+    assert not load_user(str(user.id)).is_admin
+    with app.test_request_context(url_for("admin.user.index_view")):
+        assert load_user(str(user.id)).is_admin
+
+
+def test_load_user_snapshot(db, user):
+    snapshot = load_user(str(user.id))
+    assert isinstance(snapshot, UserSnapshot)
+    assert snapshot.email == user.email
+    assert snapshot.is_active
+    assert snapshot.get_id() == str(user.id)
+    assert load_user(str(user.id)) is snapshot
+
+
+def test_invalidate_on_commit(db, user):
+    assert load_user(str(user.id)).is_active
+    user.is_active = False
+    db.session.commit()
+    assert not load_user(str(user.id)).is_active
+    assert user_cache.stats()["invalidations"] == 1
+
+
+def test_invalidate_on_set_password(db, user):
+    load_user(str(user.id))
+    user.set_password("new password")
+    db.session.commit()
+    assert user_cache.stats()["invalidations"] == 1
+
+
+def test_rollback_does_not_invalidate(db, user):
+    load_user(str(user.id))
+    user.is_admin = True
+    db.session.flush()
+    db.session.rollback()
+    assert user_cache.stats()["invalidations"] == 0
+
+
+def test_invalidate_on_admin_edit(testapp, admin_user, user):
+    with testapp.session_transaction() as session:
+        session["_user_id"] = admin_user.id
+        session["identity.auth_type"] = None
+        session["identity.id"] = admin_user.id
+    assert not load_user(str(user.id)).is_admin
+    res = testapp.get(url_for("admin.user.edit_view", id=user.id))
+    form = res.forms[0]
+    form["is_admin"] = True
+    form.submit()
+    assert load_user(str(user.id)).is_admin